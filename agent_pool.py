@@ -0,0 +1,193 @@
+import contextlib
+import fcntl
+import json
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+from typing import Callable, Iterator, List, Optional
+
+# First host port of the pool, agent i listens on PAVE_AGENT_BASE_PORT + i
+PAVE_AGENT_BASE_PORT = int(os.environ.get("PAVE_AGENT_BASE_PORT", 8123))
+# One agent per core by default, the same count pave_agent_docker_command.sh starts (nproc --all)
+PAVE_AGENT_POOL_SIZE = int(os.environ.get("PAVE_AGENT_POOL_SIZE", os.cpu_count() or 1))
+# {index} and {port} are filled in, matches the container names in pave_agent_docker_command.sh
+PAVE_AGENT_RESTART_COMMAND = os.environ.get("PAVE_AGENT_RESTART_COMMAND", "sudo docker restart pave-agent-{index}")
+# When each agent was last restarted, shared by every process on the host
+PAVE_AGENT_RESTART_STATE = os.environ.get("PAVE_AGENT_RESTART_STATE", "/tmp/pave-agent-restarts.json")
+
+
+def _no_log(message: str, severity: str = "debug"):
+    pass
+
+
+def agent_urls_from_env() -> List[str]:
+    # PAVE_AGENT_URLS (comma separated) wins, e.g. to point the syncs at stub agents
+    if os.environ.get("PAVE_AGENT_URLS"):
+        return [url.strip().rstrip("/") for url in os.environ["PAVE_AGENT_URLS"].split(",") if url.strip()]
+
+    return [f"http://127.0.0.1:{PAVE_AGENT_BASE_PORT + i}" for i in range(max(1, PAVE_AGENT_POOL_SIZE))]
+
+
+class Agent:
+    def __init__(self, index: int, url: str):
+        self.index = index
+        self.url = url
+        self.in_flight = 0
+        self.healthy = True
+        self.failures = 0
+        self.uploads = 0
+
+    def __repr__(self):
+        return f"Agent({self.index}, {self.url!r}, in_flight={self.in_flight}, healthy={self.healthy})"
+
+'''
+    The pave-agent containers started by pave_agent_docker_command.sh. lease() hands out
+    the healthy agent with the fewest uploads in flight. A background thread checks
+    every agent each health_interval seconds. An upload that fails takes its agent out
+    of rotation until the next check passes, an agent that fails max_failures checks
+    in a row is restarted with restart_command. Restarts are coordinated through a
+    flock'd state file, so between every process on the host an agent is restarted at
+    most once per restart_cooldown seconds. Agents given through `urls` or
+    PAVE_AGENT_URLS aren't our containers and are never restarted.
+
+    If every agent is unhealthy lease() still hands out the least loaded one, an upload
+    that might fail beats stopping the sync.
+'''
+class PaveAgentPool:
+    def __init__(
+        self,
+        session,
+        urls: Optional[List[str]] = None,
+        health_interval: float = 30.0,
+        health_timeout: float = 5.0,
+        max_failures: int = 2,
+        restart_command: str = PAVE_AGENT_RESTART_COMMAND,
+        restart_cooldown: float = 120.0,
+        restart_state_path: str = PAVE_AGENT_RESTART_STATE,
+        log: Callable[[str, str], None] = _no_log,
+    ):
+        self.session = session
+        self.agents = [Agent(i, url.rstrip("/")) for i, url in enumerate(urls or agent_urls_from_env())]
+        self.health_timeout = health_timeout
+        self.max_failures = max_failures
+        manages_containers = urls is None and not os.environ.get("PAVE_AGENT_URLS")
+        self.restart_command = restart_command if manages_containers else ""
+        self.restart_cooldown = restart_cooldown
+        self.restart_state_path = restart_state_path
+        self.log = log
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._health_thread = None
+        if health_interval > 0:
+            self._health_thread = threading.Thread(
+                target=self._check_health_forever, args=(health_interval,), name="pave-agent-health", daemon=True
+            )
+            self._health_thread.start()
+
+    def __len__(self) -> int:
+        return len(self.agents)
+
+    @contextlib.contextmanager
+    def lease(self) -> Iterator[Agent]:
+        with self._lock:
+            candidates = [agent for agent in self.agents if agent.healthy] or self.agents
+            agent = min(candidates, key=lambda agent: (agent.in_flight, agent.uploads))
+            agent.in_flight += 1
+            agent.uploads += 1
+
+        try:
+            yield agent
+        finally:
+            with self._lock:
+                agent.in_flight -= 1
+
+    def report_failure(self, agent: Agent, reason: str):
+        # The error may be the token's, only failed health checks restart an agent
+        with self._lock:
+            agent.healthy = False
+
+        self.log(f"Pave agent {agent.url} failed: {reason}", "warning")
+
+    def check_health(self):
+        for agent in self.agents:
+            try:
+                # Any answer means the server is up, the agent has no dedicated health route
+                res = self.session.get(agent.url, timeout=self.health_timeout)
+                healthy = res.status_code < 500
+            except Exception:
+                healthy = False
+
+            with self._lock:
+                if healthy:
+                    if not agent.healthy:
+                        self.log(f"Pave agent {agent.url} is healthy again", "info")
+                    agent.failures = 0
+                    agent.healthy = True
+                else:
+                    agent.failures += 1
+                    agent.healthy = agent.failures < self.max_failures
+
+            if not healthy and agent.failures >= self.max_failures:
+                self._maybe_restart(agent)
+
+    def stats(self) -> List[dict]:
+        with self._lock:
+            return [
+                {"url": agent.url, "healthy": agent.healthy, "in_flight": agent.in_flight, "uploads": agent.uploads}
+                for agent in self.agents
+            ]
+
+    def close(self):
+        self._stop.set()
+        if self._health_thread is not None:
+            self._health_thread.join(timeout=self.health_timeout + 1)
+
+    def _check_health_forever(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.check_health()
+            except Exception as e:
+                self.log(f"Pave agent health check failed: {e}", "error")
+
+    def _maybe_restart(self, agent: Agent):
+        if not self.restart_command:
+            return
+
+        port = agent.url.rsplit(":", 1)[-1]
+        command = self.restart_command.format(index=agent.index, port=port)
+
+        # Held through the restart, a process waiting on it then sees the new restart time and skips
+        fd = os.open(self.restart_state_path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            raw = b""
+            while True:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                raw += chunk
+            try:
+                restarts = json.loads(raw) if raw else {}
+            except ValueError:
+                restarts = {}
+
+            if time.time() - restarts.get(agent.url, 0.0) < self.restart_cooldown:
+                return
+
+            self.log(f"Restarting pave agent {agent.url}: {command}", "warning")
+            try:
+                subprocess.run(shlex.split(command), check=True, capture_output=True, timeout=120)
+            except Exception as e:
+                self.log(f"Could not restart pave agent {agent.url}: {e}", "error")
+
+            restarts[agent.url] = time.time()
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, json.dumps(restarts).encode())
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
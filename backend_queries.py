@@ -0,0 +1,142 @@
+from itertools import groupby
+from typing import Iterable, Iterator, List, Tuple
+
+# Queries against the eql backend database shared by more than one sync
+
+# The accounts of the newest plaid_raw_transaction_sets row for every user, unpacked
+# and deduplicated by account_id inside postgres so the transactions in the raw set
+# never leave the database. Rows come ordered by user. Users without a plaid link come
+# back as a single row with a NULL link_id, users with links but no accounts as a
+# single row with a NULL account_id.
+LATEST_BALANCE_ACCOUNTS_PER_USER = """
+    WITH latest AS (
+        SELECT DISTINCT ON (users.id)
+            users.id AS user_id,
+            plaid_links.id AS link_id,
+            plaid_raw_transaction_sets.id AS raw_set_id
+        FROM public.users
+        LEFT JOIN public.plaid_links ON plaid_links.user_id = users.id
+        LEFT JOIN public.plaid_raw_transaction_sets ON plaid_raw_transaction_sets.link_id = plaid_links.id
+        ORDER BY users.id, plaid_raw_transaction_sets.end_date DESC NULLS LAST
+    )
+    SELECT DISTINCT ON (latest.user_id, account.value ->> 'account_id')
+        latest.user_id,
+        latest.link_id,
+        account.value ->> 'account_id' AS account_id,
+        jsonb_build_object(
+            'available', account.value -> 'balances' -> 'available',
+            'current', account.value -> 'balances' -> 'current',
+            'iso_currency_code', account.value -> 'balances' -> 'iso_currency_code',
+            'limit', account.value -> 'balances' -> 'limit',
+            'unofficial_currency_code', account.value -> 'balances' -> 'unofficial_currency_code'
+        ) AS balances,
+        account.value ->> 'mask' AS mask,
+        account.value ->> 'name' AS name,
+        account.value ->> 'official_name' AS official_name,
+        account.value ->> 'type' AS type,
+        account.value ->> 'subtype' AS subtype
+    FROM latest
+    LEFT JOIN public.plaid_raw_transaction_sets ON plaid_raw_transaction_sets.id = latest.raw_set_id
+    LEFT JOIN LATERAL jsonb_array_elements(plaid_raw_transaction_sets.data::jsonb)
+        WITH ORDINALITY AS item(value, item_index) ON TRUE
+    LEFT JOIN LATERAL jsonb_array_elements(item.value -> 'accounts')
+        WITH ORDINALITY AS account(value, account_index) ON TRUE
+    ORDER BY latest.user_id, account.value ->> 'account_id', item.item_index, account.account_index
+"""
+
+
+'''
+    Groups the LATEST_BALANCE_ACCOUNTS_PER_USER rows into (user_id, link_id, accounts)
+    where accounts is ready to POST to pave's /balances
+'''
+def iter_latest_balance_accounts(rows: Iterable) -> Iterator[Tuple[str, object, List[dict]]]:
+    for user_id, user_rows in groupby(rows, key=lambda row: str(row.user_id)):
+        user_rows = [row._mapping for row in user_rows]
+        # The query already keeps one row per (user, account_id)
+        accounts = [
+            {
+                "account_id": row["account_id"],
+                "balances": row["balances"],
+                "mask": row["mask"],
+                "name": row["name"],
+                "official_name": row["official_name"],
+                "type": row["type"],
+                "subtype": row["subtype"],
+            }
+            for row in user_rows
+            if row["account_id"] is not None
+        ]
+
+        yield user_id, user_rows[0]["link_id"], accounts
+
+
+# The raw sets of one user inside a date window, shared by the prism queries below
+_USER_RAW_SETS_IN_WINDOW = """
+    FROM public.plaid_raw_transaction_sets
+    JOIN public.plaid_links ON plaid_links.id = plaid_raw_transaction_sets.link_id
+    CROSS JOIN LATERAL jsonb_array_elements(plaid_raw_transaction_sets.data::jsonb) AS item(value)
+"""
+
+_USER_RAW_SETS_FILTER = """
+    WHERE plaid_links.user_id = :user_id
+    AND plaid_raw_transaction_sets.start_date >= CAST(:start_date AS date)
+    AND plaid_raw_transaction_sets.end_date <= CAST(:end_date AS date)
+"""
+
+# Every unique transaction of a user's raw sets in the window, only the fields prism
+# needs. Overlapping raw sets repeat transactions, the copy from the newest set wins.
+PRISM_TRANSACTIONS_FOR_USER = f"""
+    SELECT DISTINCT ON (transaction.value ->> 'transaction_id')
+        transaction.value ->> 'transaction_id' AS transaction_id,
+        transaction.value ->> 'account_id' AS account_id,
+        transaction.value ->> 'amount' AS amount,
+        transaction.value ->> 'date' AS date,
+        transaction.value -> 'category' AS category,
+        transaction.value -> 'personal_finance_category' AS personal_finance_category,
+        transaction.value ->> 'iso_currency_code' AS iso_currency_code,
+        transaction.value ->> 'authorized_date' AS authorized_date,
+        transaction.value ->> 'merchant_name' AS merchant_name,
+        transaction.value ->> 'payment_channel' AS payment_channel,
+        transaction.value ->> 'transaction_type' AS transaction_type
+    {_USER_RAW_SETS_IN_WINDOW}
+    CROSS JOIN LATERAL jsonb_array_elements(item.value -> 'transactions') AS transaction(value)
+    {_USER_RAW_SETS_FILTER}
+    ORDER BY transaction.value ->> 'transaction_id', plaid_raw_transaction_sets.created_at DESC
+"""
+
+# The newest snapshot of each of a user's accounts in the window whose subtype is in :subtypes
+PRISM_ACCOUNTS_FOR_USER = f"""
+    SELECT DISTINCT ON (account.value ->> 'account_id')
+        account.value ->> 'account_id' AS account_id,
+        account.value ->> 'subtype' AS subtype,
+        plaid_raw_transaction_sets.created_at AS balance_date,
+        account.value -> 'balances' -> 'available' AS available_balance,
+        account.value -> 'balances' -> 'current' AS current_balance,
+        account.value -> 'balances' ->> 'iso_currency_code' AS iso_currency_code,
+        item.value -> 'item' ->> 'institution_id' AS institution_id
+    {_USER_RAW_SETS_IN_WINDOW}
+    CROSS JOIN LATERAL jsonb_array_elements(item.value -> 'accounts') AS account(value)
+    {_USER_RAW_SETS_FILTER}
+    AND account.value ->> 'subtype' = ANY(CAST(:subtypes AS text[]))
+    ORDER BY account.value ->> 'account_id', plaid_raw_transaction_sets.created_at DESC
+"""
+
+# How many links a user has, how many of them have a raw transaction set and how many
+# accounts the newest set of each holds. Links whose sets hold no accounts give pave
+# nothing to ingest, links without a set yet can't be told apart from ones that will.
+USER_LINK_ACCOUNT_COUNTS = """
+    SELECT
+        COUNT(DISTINCT plaid_links.id) AS links,
+        COUNT(DISTINCT plaid_links.id) FILTER (WHERE latest.data IS NOT NULL) AS links_with_raw_sets,
+        COALESCE(SUM(jsonb_array_length(COALESCE(item.value -> 'accounts', '[]'::jsonb))), 0) AS accounts
+    FROM public.plaid_links
+    LEFT JOIN LATERAL (
+        SELECT plaid_raw_transaction_sets.data
+        FROM public.plaid_raw_transaction_sets
+        WHERE plaid_raw_transaction_sets.link_id = plaid_links.id
+        ORDER BY plaid_raw_transaction_sets.end_date DESC NULLS LAST
+        LIMIT 1
+    ) AS latest ON TRUE
+    LEFT JOIN LATERAL jsonb_array_elements(latest.data::jsonb) AS item(value) ON TRUE
+    WHERE plaid_links.user_id = :user_id
+"""
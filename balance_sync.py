@@ -1,3 +1,4 @@
+from backend_queries import LATEST_BALANCE_ACCOUNTS_PER_USER, iter_latest_balance_accounts
 from utils import *
 
 handler = RotatingFileHandler('/home/langston/pave-prism/logs/daily-balance-data-sync.log', 'a+', (1000**2)*200, 2)
@@ -12,57 +13,22 @@ log_this(f"Process start: {process_start}", "info")
 
 conn = get_backend_connection()
 mongo_db = get_pymongo_connection()[pave_table]
+store = PaveStore(mongo_db)
 
-rows = conn.execute(
-    "SELECT DISTINCT id FROM public.users"
-).fetchall()
+# Every user's accounts from their newest raw transaction set, unpacked in postgres and streamed
+rows = conn.execution_options(stream_results=True).execute(LATEST_BALANCE_ACCOUNTS_PER_USER)
 
-user_ids = [str(row[0]) for row in rows]
-
-# Get all user access tokens and upload transaction/balance them using the pave agent
-for user_id in tqdm(user_ids):
-    rows = conn.execute(
-        f"SELECT DISTINCT id FROM public.plaid_links WHERE user_id = '{user_id}'"
-    ).fetchall()
-    plaid_link_ids = [str(row[0]) for row in rows]
-
-    if len(plaid_link_ids) == 0:
+for user_id, link_id, accounts in tqdm(iter_latest_balance_accounts(rows)):
+    if link_id is None:
         log_this(f"\tNo plaid links for user {user_id}", "warning")
         continue
 
-    rows = conn.execute(
-        f"SELECT data FROM public.plaid_raw_transaction_sets WHERE link_id IN {str(tuple(plaid_link_ids)).replace(',)', ')')} ORDER BY end_date DESC LIMIT 1"
-    ).fetchall()
-
-    accounts = []
-    for row in rows:
-        row = row._asdict()['data']
-        for item in row:
-            _accounts = item["accounts"]
-            for account in _accounts:
-                if account["account_id"] not in [x["account_id"] for x in accounts]:
-                    accounts.append({
-                        "account_id": str(account["account_id"]),
-                        "balances": {
-                            "available": account["balances"]["available"],
-                            "current": account["balances"]["current"],
-                            "iso_currency_code": account["balances"]["iso_currency_code"],
-                            "limit": account["balances"]["limit"],
-                            "unofficial_currency_code": account["balances"]["unofficial_currency_code"]
-                        },
-                        "mask": account["mask"],
-                        "name": account["name"],
-                        "official_name": account["official_name"],
-                        "type": account["type"],
-                        "subtype": account["subtype"]
-                    })
-
     response = handle_pave_request(
         user_id=user_id,
         method="post",
-        endpoint=f"{pave_base_url}/{user_id}/balances",
+        endpoint=f"{pave_base_url()}/{user_id}/balances",
         payload={"run_timestamp": str(datetime.datetime.now()), "accounts": accounts},
-        headers=pave_headers,
+        headers=pave_headers(),
         params=None,
     )
     #####################################################################
@@ -79,37 +45,21 @@ for user_id in tqdm(user_ids):
         response = handle_pave_request(
             user_id=user_id,
             method="get",
-            endpoint=f"{pave_base_url}/{user_id}/balances",
+            endpoint=f"{pave_base_url()}/{user_id}/balances",
             payload=None,
-            headers=pave_headers,
+            headers=pave_headers(),
             params=params,
         )
 
         mongo_timer = datetime.datetime.now()
         try:
-            mongo_collection = mongo_db["balances"]
-            balances = response.json()["accounts_balances"]
+            balances = response_json(response)["accounts_balances"]
 
             if len(balances) > 0:
                 try:
                     for balance_obj in balances:
                         log_this(f"\tInserting {json.dumps(balance_obj['balances'])} into balances", "info")
-                        # Add each balance object that isn't already listed in the account @ balance_obj["account_id"]
-                        mongo_collection.update_one(
-                            {"user_id": str(user_id), "balances.accounts_balances": {"$elemMatch": {"account_id": balance_obj["account_id"]}}},
-                            {"$addToSet": {"balances.accounts_balances.$.balances": {"$each": balance_obj["balances"]}},
-                             "$set":{"balances.accounts_balances.$.days_negative": balance_obj["days_negative"],
-                                "balances.accounts_balances.$.days_single_digit": balance_obj["days_single_digit"],
-                                "balances.accounts_balances.$.days_double_digit": balance_obj["days_double_digit"],
-                                "balances.accounts_balances.$.median_balance": balance_obj["median_balance"]}}
-                        )
-
-                    # Update the end date to today
-                    mongo_collection.update_one(
-                        {"user_id": str(user_id)},
-                        {"$set": {"balances.to": end_date_str, "date": datetime.datetime.now()}},
-                        bypass_document_validation = True
-                    )
+                    store.write_balances(user_id, balances)
                 except Exception as e:
                     log_this(f"COULD NOT UPDATE BALANCE FOR USER {user_id} ON DAILY SYNC", "error")
                     log_this(f"{e}", "error")
@@ -128,5 +78,7 @@ for user_id in tqdm(user_ids):
         log_this("\tCould not upload balances to mongodb", "error")
 
 
+log_this(f"Pave request stats: {pave_client.stats()}", "info")
+log_this(f"Pave response cache: {response_cache.stats()}", "info")
 close_backend_connection()
 close_pymongo_connection()
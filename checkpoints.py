@@ -0,0 +1,119 @@
+import datetime
+
+from typing import Dict, List, Optional, Set
+
+# Runs a failed user/link is retried on before it is left in sync_retries as a dead letter
+MAX_RETRY_ATTEMPTS = 24
+
+
+def as_utc(value: datetime.datetime) -> datetime.datetime:
+    # Postgres timestamptz values come back aware, mongo and plain timestamps naive (UTC)
+    if value.tzinfo is None:
+        return value.replace(tzinfo=datetime.timezone.utc)
+    return value.astimezone(datetime.timezone.utc)
+
+'''
+    Durable high-water mark of a polling job, one document per job in sync_checkpoints.
+    A job reads everything strictly after load() plus the keys (users or links) in
+    retry_keys(), tells the checkpoint how each row went with observe(), and calls
+    commit() once its writes have gone through.
+
+    The mark always moves to the newest row the run read, so one bad row doesn't make
+    every later run read everything after it again. Keys that failed are kept in
+    sync_retries with the oldest failed watermark and retried on their own until they
+    succeed, or are left there as dead letters after max_attempts runs.
+
+    commit() goes through $max, an overlapping or late run never moves the mark back.
+    Every watermark is a UTC aware datetime.
+'''
+class SyncCheckpoint:
+    def __init__(
+        self,
+        mongo_db,
+        job: str,
+        initial_lookback: datetime.timedelta,
+        max_attempts: int = MAX_RETRY_ATTEMPTS,
+        collection_name: str = "sync_checkpoints",
+        retry_collection_name: str = "sync_retries",
+    ):
+        self.collection = mongo_db[collection_name]
+        self.retry_collection = mongo_db[retry_collection_name]
+        self.job = job
+        self.initial_lookback = initial_lookback
+        self.max_attempts = max_attempts
+
+        self.start: Optional[datetime.datetime] = None
+        self._newest: Optional[datetime.datetime] = None
+        self._failed: Dict[str, datetime.datetime] = {}
+        self._succeeded: Set[str] = set()
+        self._observed = 0
+
+    def load(self) -> datetime.datetime:
+        checkpoint = self.collection.find_one({"_id": self.job})
+        if checkpoint is not None and checkpoint.get("watermark") is not None:
+            self.start = as_utc(checkpoint["watermark"])
+        else:
+            # First run of the job, start from the window it used to poll
+            self.start = datetime.datetime.now(datetime.timezone.utc) - self.initial_lookback
+
+        return self.start
+
+    def retries(self) -> List[dict]:
+        return list(self.retry_collection.find({"job": self.job, "attempts": {"$lt": self.max_attempts}}))
+
+    def retry_keys(self) -> List[str]:
+        return [retry["key"] for retry in self.retries()]
+
+    def observe(self, watermark: datetime.datetime, ok: bool, key: Optional[str] = None):
+        watermark = as_utc(watermark)
+        self._observed += 1
+        if self._newest is None or watermark > self._newest:
+            self._newest = watermark
+
+        if key is None:
+            return
+
+        key = str(key)
+        if ok:
+            self._succeeded.add(key)
+        elif key not in self._failed or watermark < self._failed[key]:
+            self._failed[key] = watermark
+
+    def pending_watermark(self) -> Optional[datetime.datetime]:
+        if self._newest is None or (self.start is not None and self._newest <= self.start):
+            return None
+
+        return self._newest
+
+    def commit(self) -> Optional[datetime.datetime]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        for key, failed_at in self._failed.items():
+            self.retry_collection.update_one(
+                {"_id": f"{self.job}:{key}"},
+                {
+                    "$min": {"since": failed_at},
+                    "$inc": {"attempts": 1},
+                    "$set": {"last_failed_at": now},
+                    "$setOnInsert": {"job": self.job, "key": key, "first_failed_at": now},
+                },
+                upsert=True,
+            )
+
+        succeeded = [f"{self.job}:{key}" for key in self._succeeded - self._failed.keys()]
+        if succeeded:
+            self.retry_collection.delete_many({"_id": {"$in": succeeded}})
+
+        watermark = self.pending_watermark()
+        if watermark is None:
+            return None
+
+        self.collection.update_one(
+            {"_id": self.job},
+            {
+                "$max": {"watermark": watermark},
+                "$set": {"committed_at": now, "rows": self._observed, "failed": len(self._failed)},
+            },
+            upsert=True,
+        )
+        return watermark
@@ -0,0 +1,105 @@
+import asyncio
+import contextvars
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional
+
+from tqdm import tqdm
+
+# While a user is being processed concurrently its log lines are collected here
+# and written out in user order once every earlier user has finished
+log_buffer: contextvars.ContextVar = contextvars.ContextVar("log_buffer", default=None)
+
+
+class UserOutcome:
+    def __init__(self, user_id: str, result=None, error: Optional[BaseException] = None, skipped: bool = False):
+        self.user_id = user_id
+        self.result = result
+        self.error = error
+        self.skipped = skipped
+
+'''
+    Runs work(item) for every item (a user id, or a row keyed to one by `key`) as asyncio
+    tasks, at most `concurrency` at a time. Items are pulled lazily so a streamed query
+    result is never held in memory. The blocking Pave/Mongo/Postgres calls inside work
+    run on a thread pool sized to `concurrency` so they share the pooled sessions and
+    connection pools.
+
+    One user raising doesn't stop the others, the exception is logged and returned in
+    its UserOutcome. Once should_continue() returns False no new users are started.
+'''
+def run_concurrently(
+    work: Callable[[object], object],
+    items: Iterable,
+    concurrency: int,
+    log: Callable[[str, str], None],
+    should_continue: Callable[[], bool] = lambda: True,
+    key: Callable[[object], str] = str,
+    total: Optional[int] = None,
+) -> List[UserOutcome]:
+    if total is None and hasattr(items, "__len__"):
+        total = len(items)
+
+    return asyncio.run(_run_all(work, items, concurrency, log, should_continue, key, total))
+
+
+async def _run_all(work, items, concurrency, log, should_continue, key, total) -> List[UserOutcome]:
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="user-sync")
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+    outcomes: Dict[int, UserOutcome] = {}
+    finished_logs = {}
+    next_to_log = 0
+    progress = tqdm(total=total)
+
+    def run_buffered(user_id: str, item):
+        records = []
+        log_buffer.set(records)
+        try:
+            return UserOutcome(user_id, result=work(item)), records
+        except Exception as e:
+            records.append((f"Sync failed for user {user_id}: {e}\n{traceback.format_exc()}", "error"))
+            return UserOutcome(user_id, error=e), records
+
+    async def run_one(index: int, item):
+        nonlocal next_to_log
+
+        user_id = key(item)
+        try:
+            if should_continue():
+                outcome, records = await asyncio.to_thread(run_buffered, user_id, item)
+            else:
+                outcome, records = UserOutcome(user_id, skipped=True), []
+        finally:
+            semaphore.release()
+
+        outcomes[index] = outcome
+        finished_logs[index] = records
+        progress.update()
+
+        while next_to_log in finished_logs:
+            for message, severity in finished_logs.pop(next_to_log):
+                log(message, severity)
+            next_to_log += 1
+
+    tasks = []
+    iterator = iter(items)
+    try:
+        while True:
+            # Only pull the next item once there is a free slot for it
+            await semaphore.acquire()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                semaphore.release()
+                break
+
+            tasks.append(asyncio.create_task(run_one(len(tasks), item)))
+
+        await asyncio.gather(*tasks)
+    finally:
+        progress.close()
+
+    return [outcomes[index] for index in range(len(outcomes))]
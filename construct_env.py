@@ -1,33 +1,24 @@
-import base64
 import datetime
-import json
+import functools
 import logging
 import subprocess
 
 from typing import List
-from cryptography.fernet import Fernet, MultiFernet
 from tqdm import tqdm
 
 from db_connections import Connection_Manager
+from decryption import TokenDecryptor
+from secret_store import secret_store
 
-from google.cloud import secretmanager
 
-secret_manager_client = secretmanager.SecretManagerServiceClient()
-
-keys = secret_manager_client.access_secret_version(
-    name=f"projects/eql-data-processing/secrets/pave-agent-decryption-keys/versions/latest"
-).payload.data.decode("UTF-8")
-keys = json.loads(keys)["KEYS"]
-
-
-def base64_decode(val: str) -> bytes:
-    return base64.urlsafe_b64decode(val.encode("ascii"))
+# Only built once there are users whose tokens need decrypting
+@functools.lru_cache(maxsize=None)
+def token_decryptor() -> TokenDecryptor:
+    return TokenDecryptor(secret_store.get_json("pave-agent-decryption-keys")["KEYS"])
 
 
 def decrypt(val: str) -> str:
-    fernet = MultiFernet(Fernet(k) for k in keys)
-    actual = fernet.decrypt(base64_decode(val))
-    return actual.decode()
+    return token_decryptor().decrypt(val)
 
 '''
     - collects user_ids and thier access tokens,
@@ -36,31 +27,26 @@ def decrypt(val: str) -> str:
 '''
 def run(user_ids: List[str] = []) -> bool:
 
+    # Nothing is connected to or resolved until there are users to write
     cm = Connection_Manager()
     process_start = datetime.datetime.now()
 
     try:
         with open("/home/langston/pave-prism/pave-agent/one-time-run.env", mode="w") as env_file:
-            # Open connection to postgres db
-            conn = cm.get_postgres_connection()
-
-
             if len(user_ids) < 1:
-                # Close db connection
-                cm.close_postgres_connection(conn)
-
                 process_end = datetime.datetime.now()
                 logging.info(f"No new users found. Ending process")
                 logging.info(f"\nTotal runtime: {process_end-process_start}")
                 return True
 
+            # Open connection to postgres db
+            conn = cm.get_postgres_connection()
+
             # Get pave secret values
-            env_file_start = secret_manager_client.access_secret_version(
-                name=f"projects/eql-data-processing/secrets/pave-agent-env-file/versions/latest"
-            ).payload.data.decode("UTF-8")
+            env_file_start = secret_store.get("pave-agent-env-file")
 
             env_file.write(env_file_start)
-            all_user_data = []
+            token_user_ids, encrypted_tokens = [], []
 
             # For user in user_ids add their user_id and decrypted access token to the env file
             logging.debug(f"Adding {len(user_ids)} users to docker env...\n")
@@ -70,10 +56,13 @@ def run(user_ids: List[str] = []) -> bool:
                 rows = conn.execute(
                     f"SELECT DISTINCT access_token FROM public.plaid_links WHERE user_id = '{user_id}'"
                 ).fetchall()
-                access_tokens = [decrypt(str(row[0])) for row in rows]
 
-                for access_token in access_tokens:
-                    all_user_data.append((user_id, access_token))
+                for row in rows:
+                    token_user_ids.append(user_id)
+                    encrypted_tokens.append(str(row[0]))
+
+            # Decrypt every token in one go so large runs are split across the thread pool
+            all_user_data = list(zip(token_user_ids, token_decryptor().decrypt_many(encrypted_tokens)))
 
             # Write to env
             env_file.write(
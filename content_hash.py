@@ -0,0 +1,77 @@
+import hashlib
+import json
+import threading
+
+from typing import Dict, Optional
+
+
+def _no_log(message: str, severity: str = "debug"):
+    pass
+
+
+def content_hash(content) -> str:
+    # Canonical JSON, key order and whitespace in pave's responses don't change the hash
+    canonical = json.dumps(content, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+'''
+    Change detection for the per user sections the weekly syncs replace (each
+    unified_insights title and attributes). The hash is stored on the section's own
+    document as content_hash, so it is written in the same replace as the data and a
+    failed write is simply retried next run.
+
+    The stored hashes of a collection are read once per run, user_id and content_hash
+    only, the first time the collection is seen. changed() returns the new hash when the
+    section has to be written and None when it matches what is stored.
+'''
+class SectionHashes:
+    def __init__(self, mongo_db, log=_no_log):
+        self.mongo_db = mongo_db
+        self.log = log
+
+        self._stored: Dict[str, Dict[str, str]] = {}
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def changed(self, collection_name: str, user_id: str, content) -> Optional[str]:
+        new_hash = content_hash(content)
+        stored = self._stored_hashes(collection_name)
+
+        with self._lock:
+            counts = self._counts.setdefault(collection_name, {"hits": 0, "misses": 0})
+            if stored.get(str(user_id)) == new_hash:
+                counts["hits"] += 1
+                return None
+
+            counts["misses"] += 1
+            return new_hash
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = sum(counts["hits"] for counts in self._counts.values())
+            misses = sum(counts["misses"] for counts in self._counts.values())
+            return {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / (hits + misses), 3) if hits + misses else 0.0,
+                "collections": {name: dict(counts) for name, counts in self._counts.items()},
+            }
+
+    def _stored_hashes(self, collection_name: str) -> Dict[str, str]:
+        with self._lock:
+            if collection_name in self._stored:
+                return self._stored[collection_name]
+
+            # Loaded under the lock so concurrent workers don't read the same collection twice
+            try:
+                cursor = self.mongo_db[collection_name].find(
+                    {"content_hash": {"$exists": True}}, projection={"_id": 0, "user_id": 1, "content_hash": 1}
+                )
+                stored = {str(document["user_id"]): document["content_hash"] for document in cursor}
+            except Exception as e:
+                # Every section of the collection is written, as before change detection
+                self.log(f"Could not read the stored content hashes of {collection_name}: {e}", "warning")
+                stored = {}
+
+            self._stored[collection_name] = stored
+            return stored
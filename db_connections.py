@@ -1,34 +1,27 @@
-import json
+import threading
 
 import pymongo
 import sqlalchemy
 
 from google.cloud.sql.connector import Connector
-from google.cloud import secretmanager
 from google.oauth2 import service_account
 
+from secret_store import SecretStore, secret_store
+
 # TODO: This class is not sophisticated enough to handle many connections at once,
 # Needs a better sence of pools and connection lifetimes
 class Connection_Manager:
-    def __init__(self):
-        client = secretmanager.SecretManagerServiceClient()
-
-        CREDS = client.access_secret_version(
-            name=f"projects/eql-data-processing/secrets/eql-backend-service-dev-creds/versions/latest"
-        ).payload.data.decode("UTF-8")
-
-        creds_obj = json.loads(CREDS)
+    def __init__(self, pool_size: int = 5, max_overflow: int = 10, secrets: SecretStore = secret_store):
+        self.secrets = secrets
 
-        DB_PARAMS = client.access_secret_version(
-            name=f"projects/eql-data-processing/secrets/eql-backend-service-dev-db/versions/latest"
-        ).payload.data.decode("UTF-8")
-
-        db_params_obj = json.loads(DB_PARAMS)
+        def get_psql_connection():
+            # Secrets are resolved on the first connection, not when the manager is built
+            creds_obj = secrets.get_json("eql-backend-service-dev-creds")
+            db_params_obj = secrets.get_json("eql-backend-service-dev-db")
 
-        g_credentials = service_account.Credentials.from_service_account_info(creds_obj)
-        instance_connection_name = f"{db_params_obj['PROJECT_ID']}:{db_params_obj['REGION']}:{db_params_obj['INSTANCE_NAME']}"
+            g_credentials = service_account.Credentials.from_service_account_info(creds_obj)
+            instance_connection_name = f"{db_params_obj['PROJECT_ID']}:{db_params_obj['REGION']}:{db_params_obj['INSTANCE_NAME']}"
 
-        def get_psql_connection():
             connector = Connector(credentials=g_credentials)
             conn = connector.connect(
                 instance_connection_name,
@@ -41,14 +34,18 @@ class Connection_Manager:
             return conn
 
         self.postgres_pool = sqlalchemy.create_engine(
-            "postgresql+pg8000://", creator=get_psql_connection
+            "postgresql+pg8000://", creator=get_psql_connection, pool_size=pool_size, max_overflow=max_overflow
         )
 
-        mongodb_uri = client.access_secret_version(
-            name=f"projects/eql-data-processing/secrets/mongodb-uri/versions/latest"
-        ).payload.data.decode("UTF-8")
+        self._mongo_client = None
+        self._mongo_lock = threading.Lock()
 
-        self.mongo_client = pymongo.MongoClient(mongodb_uri)
+    @property
+    def mongo_client(self) -> pymongo.MongoClient:
+        with self._mongo_lock:
+            if self._mongo_client is None:
+                self._mongo_client = pymongo.MongoClient(self.secrets.get("mongodb-uri"))
+            return self._mongo_client
 
     def get_postgres_connection(self):
         return self.postgres_pool.connect()
@@ -60,4 +57,5 @@ class Connection_Manager:
         return self.mongo_client[table_name]
 
     def close_pymongo_connection(self):
-        self.mongo_client.close()
+        if self._mongo_client is not None:
+            self._mongo_client.close()
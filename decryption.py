@@ -0,0 +1,100 @@
+import base64
+import multiprocessing
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
+
+from cryptography.fernet import Fernet, InvalidToken
+
+
+def base64_decode(val: str) -> bytes:
+    return base64.urlsafe_b64decode(val.encode("ascii"))
+
+'''
+    Decrypts pave agent access tokens. The key ring is built once and keys are
+    tried most-successful first, so tokens encrypted with the current key
+    don't pay for a failed attempt on every retired key.
+'''
+class TokenDecryptor:
+    def __init__(self, keys: Sequence[str], parallel_threshold: int = 2000, max_workers: Optional[int] = None):
+        self.keys = list(keys)
+        self.parallel_threshold = parallel_threshold
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+
+        self._fernets = [Fernet(k) for k in self.keys]
+        self._hits = [0] * len(self._fernets)
+        self._order = list(range(len(self._fernets)))
+        self._lock = threading.Lock()
+
+    def decrypt(self, val: str) -> Optional[str]:
+        if not val:
+            return None
+
+        actual, key_index = self._decrypt(base64_decode(val))
+        self._record_hits({key_index: 1})
+        return actual
+
+    '''
+        Decrypts a list of tokens, keeping the input order. Lists longer than
+        parallel_threshold are split across a thread pool.
+    '''
+    def decrypt_many(self, vals: Sequence[str]) -> List[Optional[str]]:
+        vals = list(vals)
+        if len(vals) < self.parallel_threshold or self.max_workers < 2:
+            plain, hits = _decrypt_chunk(self, vals)
+            self._record_hits(hits)
+            return plain
+
+        chunk_size = -(-len(vals) // self.max_workers)
+        chunks = [vals[i:i + chunk_size] for i in range(0, len(vals), chunk_size)]
+
+        # Threads, the callers run other threads that a forked child would copy mid-flight,
+        # and spawn/forkserver children re-run the calling sync script on import
+        with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+            results = list(executor.map(lambda chunk: _decrypt_chunk(self, chunk), chunks))
+
+        plain = []
+        for chunk_plain, chunk_hits in results:
+            plain.extend(chunk_plain)
+            self._record_hits(chunk_hits)
+
+        return plain
+
+    def key_order(self) -> List[int]:
+        with self._lock:
+            return list(self._order)
+
+    def _decrypt(self, token: bytes) -> Tuple[str, int]:
+        for key_index in self.key_order():
+            try:
+                return self._fernets[key_index].decrypt(token).decode(), key_index
+            except InvalidToken:
+                continue
+
+        raise InvalidToken
+
+    def _record_hits(self, hits: dict):
+        if not hits:
+            return
+
+        with self._lock:
+            for key_index, count in hits.items():
+                self._hits[key_index] += count
+
+            # Stable sort so keys with equal counts keep their configured order
+            self._order.sort(key=lambda i: -self._hits[i])
+
+
+def _decrypt_chunk(decryptor: TokenDecryptor, vals: List[str]) -> Tuple[List[Optional[str]], dict]:
+    plain, hits = [], {}
+    for val in vals:
+        if not val:
+            plain.append(None)
+            continue
+
+        actual, key_index = decryptor._decrypt(base64_decode(val))
+        plain.append(actual)
+        hits[key_index] = hits.get(key_index, 0) + 1
+
+    return plain, hits
@@ -13,6 +13,9 @@ log_this(f"Process start: {process_start}", "info")
 # Open connections
 conn = get_backend_connection()
 mongo_db = get_pymongo_connection()[pave_table]
+sink = MongoBulkSink(mongo_db, log=log_this)
+# Sections whose content hash matches the stored one aren't written again
+hashes = SectionHashes(mongo_db, log=log_this)
 
 rows = conn.execute(
     "SELECT DISTINCT id FROM public.users"
@@ -39,33 +42,35 @@ for user_id in tqdm(user_ids):
     response = handle_pave_request(
         user_id=user_id,
         method="get",
-        endpoint=f"{pave_base_url}/{user_id}/unified_insights",
+        endpoint=f"{pave_base_url()}/{user_id}/unified_insights",
         payload=None,
-        headers=pave_headers,
+        headers=pave_headers(),
         params=params,
     )
 
     if response.status_code == 200:
-        for title, object in response.json().items():
-            log_this("\tInserting response into: {}".format(title), "info")
-            mongo_collection = mongo_db[title]
+        for title, object in response_json(response).items():
+            section_hash = hashes.changed(title, user_id, object)
+            if section_hash is None:
+                log_this("\t{} unchanged, skipping the write".format(title))
+                continue
 
-            try:
-                mongo_collection.replace_one(
-                    {"user_id": user_id},
-                    {
-                        title: object,
-                        "user_id": user_id,
-                        "response_code": response.status_code,
-                        "date": datetime.datetime.now(),
-                    },
-                    upsert=True,
-                )
-            except Exception as e:
-                log_this(f"COULD NOT UPDATE {title} FOR USER {user_id} ON DAILY SYNC", "error")
-                log_this(f"{e}", "error")
+            log_this("\tInserting response into: {}".format(title), "info")
+            sink.replace_one(
+                title,
+                {"user_id": user_id},
+                {
+                    title: object,
+                    "user_id": user_id,
+                    "response_code": response.status_code,
+                    "date": datetime.datetime.now(),
+                    "content_hash": section_hash,
+                },
+                context=f"{title} of user {user_id} on weekly sync",
+                user_id=user_id,
+            )
     else:
-        log_this("\tCan't insert: {} {}\n".format(response.status_code, response.json()), "warning")
+        log_this("\tCan't insert: {} {}\n".format(response.status_code, response_json(response)), "warning")
     #####################################################################
 
     # We may actually want this data for decisioning so we can take the slowdown
@@ -74,9 +79,9 @@ for user_id in tqdm(user_ids):
     response = handle_pave_request(
         user_id=user_id,
         method="get",
-        endpoint=f"{pave_base_url}/{user_id}/attributes",
+        endpoint=f"{pave_base_url()}/{user_id}/attributes",
         payload=None,
-        headers=pave_headers,
+        headers=pave_headers(),
         params=params,
     )
     insert_response_into_db(
@@ -85,7 +90,13 @@ for user_id in tqdm(user_ids):
         mongo_db=mongo_db,
         collection_name="attributes",
         response_column_name="attributes",
+        sink=sink,
+        hashes=hashes,
     )
 
+sink.close()
+log_this(f"Unchanged sections skipped: {hashes.stats()}", "info")
+log_this(f"Pave request stats: {pave_client.stats()}", "info")
+log_this(f"Pave response cache: {response_cache.stats()}", "info")
 close_backend_connection()
 close_pymongo_connection()
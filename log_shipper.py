@@ -0,0 +1,179 @@
+import atexit
+import datetime
+import logging
+import queue
+import threading
+import time
+
+from typing import List, Optional, Tuple
+
+# (severity, message, unix timestamp of the log_this call)
+ShippedRecord = Tuple[str, str, float]
+
+_STOP = object()
+
+'''
+    Ships batches to Cloud Logging with one entries.write call per batch
+    instead of one `gcloud logging write` process per message
+'''
+class CloudLoggingSink:
+    def __init__(self, log_name: str):
+        self.log_name = log_name
+        self._cloud_logger = None
+
+    def write_batch(self, records: List[ShippedRecord]):
+        if self._cloud_logger is None:
+            # Imported here so jobs that never ship a batch don't pay for the client
+            from google.cloud import logging as cloud_logging
+            self._cloud_logger = cloud_logging.Client().logger(self.log_name)
+
+        batch = self._cloud_logger.batch()
+        for severity, message, created in records:
+            batch.log_text(
+                message,
+                severity=severity,
+                timestamp=datetime.datetime.fromtimestamp(created, tz=datetime.timezone.utc),
+            )
+        batch.commit()
+
+'''
+    Keeps every batch in memory, use this in place of CloudLoggingSink to run offline
+'''
+class MemorySink:
+    def __init__(self):
+        self.batches: List[List[ShippedRecord]] = []
+
+    def write_batch(self, records: List[ShippedRecord]):
+        self.batches.append(list(records))
+
+    @property
+    def records(self) -> List[ShippedRecord]:
+        return [record for batch in self.batches for record in batch]
+
+'''
+    Non-blocking log shipper, log_this puts records on the queue and a background
+    thread writes them to the sink once max_batch_size records are queued or
+    flush_interval seconds have passed since the first record of the batch.
+
+    If the sink fails the batch is written to fallback_handler (a local
+    RotatingFileHandler) and the sink is left alone for sink_retry_after seconds.
+'''
+class LogShipper:
+    def __init__(
+        self,
+        sink,
+        fallback_handler: Optional[logging.Handler] = None,
+        max_batch_size: int = 500,
+        flush_interval: float = 2.0,
+        max_queue_size: int = 100_000,
+        sink_retry_after: float = 60.0,
+    ):
+        self.sink = sink
+        self.fallback_handler = fallback_handler
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.sink_retry_after = sink_retry_after
+
+        self.shipped_count = 0
+        self.fallback_count = 0
+        self.dropped_count = 0
+
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._sink_down_until = 0.0
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+        self._worker.start()
+
+        atexit.register(self.close)
+
+    def ship(self, message: str, severity: str = "debug"):
+        if self._closed:
+            return
+
+        try:
+            self._queue.put_nowait((severity.upper(), message, time.time()))
+        except queue.Full:
+            # Never block the sync on logging, the local log file still has the message
+            self.dropped_count += 1
+
+    def flush(self, timeout: float = 30.0) -> bool:
+        if self._closed:
+            return True
+
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        return flushed.wait(timeout)
+
+    def close(self, timeout: float = 30.0):
+        if self._closed:
+            return
+
+        self._closed = True
+        self._queue.put(_STOP)
+        self._worker.join(timeout)
+
+    def _run(self):
+        batch: List[ShippedRecord] = []
+        batch_deadline = 0.0
+
+        while True:
+            try:
+                if batch:
+                    item = self._queue.get(timeout=max(0.0, batch_deadline - time.monotonic()))
+                else:
+                    item = self._queue.get()
+            except queue.Empty:
+                self._write(batch)
+                batch = []
+                continue
+
+            if item is _STOP:
+                self._write(batch)
+                return
+            elif isinstance(item, threading.Event):
+                self._write(batch)
+                batch = []
+                item.set()
+                continue
+
+            if not batch:
+                batch_deadline = time.monotonic() + self.flush_interval
+            batch.append(item)
+
+            if len(batch) >= self.max_batch_size:
+                self._write(batch)
+                batch = []
+
+    def _write(self, batch: List[ShippedRecord]):
+        if not batch:
+            return
+
+        if time.monotonic() >= self._sink_down_until:
+            try:
+                self.sink.write_batch(batch)
+                self.shipped_count += len(batch)
+                return
+            except Exception as e:
+                self._sink_down_until = time.monotonic() + self.sink_retry_after
+                self._write_fallback([("ERROR", f"Log sink unavailable, writing {len(batch)} record(s) locally: {e}", time.time())])
+
+        self._write_fallback(batch)
+        self.fallback_count += len(batch)
+
+    def _write_fallback(self, records: List[ShippedRecord]):
+        if self.fallback_handler is None:
+            return
+
+        for severity, message, created in records:
+            level = logging._nameToLevel.get(severity, logging.INFO)
+            record = logging.makeLogRecord({
+                "name": "log_shipper",
+                "levelno": level,
+                "levelname": logging.getLevelName(level),
+                "msg": message,
+                "created": created,
+            })
+            try:
+                self.fallback_handler.handle(record)
+            except Exception:
+                pass
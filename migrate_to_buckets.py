@@ -0,0 +1,87 @@
+import argparse
+import datetime
+import logging
+
+from tqdm import tqdm
+
+from db_connections import Connection_Manager
+from mongo_bulk_sink import MongoBulkSink
+from pave_store import PaveStore
+
+'''
+    One-off migration of the per user transactions/balances documents in
+    Pave-Production into pave_store's per transaction documents and
+    (user, account, month) balance buckets.
+
+    Writes are keyed upserts, so the migration can be stopped and run again, and it
+    can run while the syncs are writing to the new collections. The old documents are left
+    untouched.
+
+    python migrate_to_buckets.py [--dry-run] [--user-ids id1,id2] [--batch-size 500]
+'''
+
+logging.basicConfig(format="%(asctime)s: %(message)s", datefmt="%m-%d %H:%M:%S", level=logging.INFO)
+
+
+def log(message: str, severity: str = "info"):
+    logging.log(logging._nameToLevel[severity.upper()], message)
+
+
+def migrate(mongo_db, store: PaveStore, collection_name: str, user_ids, dry_run: bool) -> dict:
+    query = {"user_id": {"$in": user_ids}} if user_ids else {}
+    counts = {"documents": 0, "items": 0, "updates": 0}
+
+    # Only the arrays being migrated are pulled, a few documents at a time
+    cursor = mongo_db[collection_name].find(
+        query, projection={"user_id": 1, collection_name: 1}, no_cursor_timeout=True, batch_size=50
+    )
+    try:
+        for document in tqdm(cursor, desc=collection_name):
+            user_id = str(document["user_id"])
+            response = document.get(collection_name) or {}
+            counts["documents"] += 1
+
+            if collection_name == "transactions":
+                items = response.get("transactions") or []
+                updates = store.transaction_updates(user_id, items)
+                write = store.write_transactions
+            else:
+                items = response.get("accounts_balances") or []
+                updates = store.balance_updates(user_id, items)
+                write = store.write_balances
+
+            counts["items"] += len(items)
+            counts["updates"] += len(updates)
+            if not dry_run:
+                write(user_id, items)
+    finally:
+        cursor.close()
+
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true", help="Count what would be written without writing it")
+    parser.add_argument("--user-ids", default="", help="Comma separated users to migrate, defaults to everyone")
+    parser.add_argument("--batch-size", type=int, default=500, help="Updates per bulk write")
+    args = parser.parse_args()
+
+    start = datetime.datetime.now()
+    cm = Connection_Manager()
+    mongo_db = cm.get_pymongo_table("Pave-Production")
+    user_ids = [user_id.strip() for user_id in args.user_ids.split(",") if user_id.strip()]
+
+    sink = MongoBulkSink(mongo_db, log=log, batch_size=args.batch_size)
+    store = PaveStore(mongo_db, sink)
+    try:
+        for collection_name in ("transactions", "balances"):
+            counts = migrate(mongo_db, store, collection_name, user_ids, args.dry_run)
+            log(f"{collection_name}: {counts}{' (dry run)' if args.dry_run else ''}")
+    finally:
+        failures = sink.close()
+        cm.close_pymongo_connection()
+
+    if failures:
+        log(f"{len(failures)} update(s) failed, run the migration again to retry them", "error")
+    log(f"Migration took {datetime.datetime.now() - start}")
@@ -0,0 +1,159 @@
+import threading
+import time
+
+from typing import Callable, Dict, Iterable, List, Optional
+
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+def _no_log(message: str, severity: str = "debug"):
+    pass
+
+
+class BulkWriteFailure:
+    def __init__(self, collection_name: str, context: Optional[str], error: str, user_id: Optional[str] = None):
+        self.collection_name = collection_name
+        self.context = context
+        self.error = error
+        self.user_id = user_id
+
+    def __repr__(self):
+        return f"BulkWriteFailure({self.collection_name!r}, {self.context!r}, {self.error!r})"
+
+'''
+    Buffers ReplaceOne/UpdateOne operations per collection and writes them with one
+    unordered bulk_write once a collection has batch_size operations queued, or once
+    flush_interval seconds have passed since the last flush. close() writes whatever
+    is left, so it has to be called before the process exits.
+
+    Each operation carries a context (usually "{title} of user {user_id}") and the user it
+    belongs to, so failed writes can be reported back per operation and per user,
+    through on_error and the list flush() returns.
+'''
+class MongoBulkSink:
+    def __init__(
+        self,
+        mongo_db,
+        log: Callable[[str, str], None] = _no_log,
+        batch_size: int = 500,
+        flush_interval: float = 5.0,
+        on_error: Optional[Callable[[BulkWriteFailure], None]] = None,
+    ):
+        self.mongo_db = mongo_db
+        self.log = log
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error if on_error is not None else self._log_failure
+
+        self._pending: Dict[str, List[tuple]] = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._stats = {"queued": 0, "written": 0, "failed": 0, "bulk_writes": 0}
+        # None stands for a failure that can't be tied to a user
+        self._failed_user_ids = set()
+
+    def replace_one(
+        self, collection_name: str, filter: dict, replacement: dict, upsert: bool = True,
+        context: Optional[str] = None, user_id: Optional[str] = None,
+    ):
+        self.add(collection_name, ReplaceOne(filter, replacement, upsert=upsert), context, user_id)
+
+    def update_one(
+        self, collection_name: str, filter: dict, update: dict, upsert: bool = False,
+        context: Optional[str] = None, user_id: Optional[str] = None,
+    ):
+        self.add(collection_name, UpdateOne(filter, update, upsert=upsert), context, user_id)
+
+    def add(
+        self, collection_name: str, operation, context: Optional[str] = None, user_id: Optional[str] = None
+    ) -> List[BulkWriteFailure]:
+        with self._lock:
+            pending = self._pending.setdefault(collection_name, [])
+            pending.append((operation, context, user_id))
+            self._stats["queued"] += 1
+
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                batches = self._take_all()
+            elif len(pending) >= self.batch_size:
+                batches = {collection_name: self._pending.pop(collection_name)}
+            else:
+                return []
+
+        return self._write(batches)
+
+    def flush(self) -> List[BulkWriteFailure]:
+        with self._lock:
+            batches = self._take_all()
+
+        return self._write(batches)
+
+    def close(self) -> List[BulkWriteFailure]:
+        failures = self.flush()
+        self.log(f"Mongo bulk sink stats: {self.stats()}", "info")
+        return failures
+
+    def written_users(self, user_ids: Iterable[str]) -> List[str]:
+        # The users none of whose writes failed so far, none at all if a failure had no user
+        with self._lock:
+            failed = set(self._failed_user_ids)
+
+        if None in failed:
+            return []
+        return [user_id for user_id in user_ids if str(user_id) not in failed]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def _take_all(self) -> Dict[str, List[tuple]]:
+        batches, self._pending = self._pending, {}
+        self._last_flush = time.monotonic()
+        return batches
+
+    def _write(self, batches: Dict[str, List[tuple]]) -> List[BulkWriteFailure]:
+        failures = []
+        for collection_name, batch in batches.items():
+            for start in range(0, len(batch), self.batch_size):
+                failures.extend(self._write_batch(collection_name, batch[start:start + self.batch_size]))
+
+        with self._lock:
+            self._failed_user_ids.update(
+                str(failure.user_id) if failure.user_id is not None else None for failure in failures
+            )
+
+        for failure in failures:
+            self.on_error(failure)
+
+        return failures
+
+    def _write_batch(self, collection_name: str, batch: List[tuple]) -> List[BulkWriteFailure]:
+        write_start = time.monotonic()
+        try:
+            self.mongo_db[collection_name].bulk_write([operation for operation, _, _ in batch], ordered=False)
+            failures = []
+        except BulkWriteError as e:
+            # Unordered, so everything but the listed operations was still written
+            failures = [
+                BulkWriteFailure(
+                    collection_name, batch[error["index"]][1], error.get("errmsg", str(error)), batch[error["index"]][2]
+                )
+                for error in e.details.get("writeErrors", [])
+            ]
+            failures.extend(
+                BulkWriteFailure(collection_name, None, error.get("errmsg", str(error)))
+                for error in e.details.get("writeConcernErrors", [])
+            )
+        except Exception as e:
+            failures = [BulkWriteFailure(collection_name, context, str(e), user_id) for _, context, user_id in batch]
+
+        with self._lock:
+            self._stats["bulk_writes"] += 1
+            self._stats["written"] += len(batch) - len(failures)
+            self._stats["failed"] += len(failures)
+
+        self.log(f"Bulk write of {len(batch)} operation(s) to {collection_name} took {time.monotonic() - write_start:.3f}s", "info")
+        return failures
+
+    def _log_failure(self, failure: BulkWriteFailure):
+        self.log(f"COULD NOT WRITE to {failure.collection_name} FOR {failure.context}: {failure.error}", "error")
@@ -13,26 +13,34 @@ log_this(f"Process start: {process_start}", "info")
 # Open connections
 conn = get_backend_connection()
 mongo_db = get_pymongo_connection()[pave_table]
+store = PaveStore(mongo_db)
 
+# Every link created or revalidated since the last run, plus the links that failed on an earlier one
+checkpoint = SyncCheckpoint(mongo_db, "new_or_revalidated_link_sync", datetime.timedelta(minutes=30))
 rows = conn.execute(
-    "SELECT DISTINCT access_token, user_id FROM public.plaid_links WHERE created_at >= (NOW() - INTERVAL '30 minutes') OR last_validated_at >= (NOW() - INTERVAL '30 minutes')"
+    sqlalchemy.text(
+        "SELECT DISTINCT id, access_token, user_id, GREATEST(created_at, last_validated_at) AS changed_at "
+        "FROM public.plaid_links "
+        "WHERE created_at > :watermark OR last_validated_at > :watermark OR id IN :retry_link_ids"
+    ).bindparams(sqlalchemy.bindparam("retry_link_ids", expanding=True)),
+    {"watermark": checkpoint.load(), "retry_link_ids": checkpoint.retry_keys()},
 ).fetchall()
 
-for row in tqdm(rows):
-    row = row._asdict()
-    access_token, user_id = decrypt(row["access_token"]), str(row["user_id"])
+rows = [row._asdict() for row in rows]
+access_tokens = token_decryptor().decrypt_many([row["access_token"] for row in rows])
+
+# The next links upload and wait on pave while the current one is being stored,
+# uploads come back in the same order as rows
+links = ((str(row["user_id"]), [access_token]) for row, access_token in zip(rows, access_tokens))
+uploads = upload_coordinator.iter_uploaded(links)
+for row, (user_id, upload) in tqdm(zip(rows, uploads), total=len(rows)):
     time_in_days = 365 * 2
 
     log_this(f"{user_id=}")
-    pave_agent_start = datetime.datetime.now()
-    res = requests.post(
-        f"http://127.0.0.1:8123/v1/users/{user_id}/upload?num_transaction_days={time_in_days}",
-        json={"access_token": f"{access_token}"},
-    )
-    # Give pave agent some time to process transactions
-    time.sleep(2)
-    pave_agent_end = datetime.datetime.now()
-    log_this(f"  Pave Agent res code: {res.status_code}, took {pave_agent_end-pave_agent_start}", "debug")
+    log_this(f"  Pave Agent res codes: {upload.status_codes}, ready: {upload.ready} after {upload.waited:.1f}s", "debug")
+    # Whether everything for the link made it into mongo, for the checkpoint. An upload
+    # pave took but wasn't seen ingesting in time still stores what pave has.
+    synced = upload.uploaded
 
     # Date ranges for pave
     start_date_str = (
@@ -45,33 +53,28 @@ for row in tqdm(rows):
     response = handle_pave_request(
         user_id=user_id,
         method="get",
-        endpoint=f"{pave_base_url}/{user_id}/transactions",
+        endpoint=f"{pave_base_url()}/{user_id}/transactions",
         payload=None,
-        headers=pave_headers,
+        headers=pave_headers(),
         params=params,
     )
 
     if response.status_code != 200:
         log_this("        Non 200 return code on transactions", "exception")
+        synced = False
     else:
         mongo_timer = datetime.datetime.now()
-        mongo_collection = mongo_db["transactions"]
-        transactions = response.json()["transactions"]
+        transactions = response_json(response)["transactions"]
 
         if len(transactions) > 0:
             log_this(f"   Inserting {json.dumps(transactions)[:200]}... into transactions", "info")
 
             try:
-                mongo_collection.update_one(
-                    {"user_id": str(user_id)},
-                    {
-                        "$addToSet": {"transactions.transactions": {"$each": transactions}},
-                        "$set": {"transactions.to": end_date_str, "date": datetime.datetime.now()}
-                    }
-                )
+                store.write_transactions(user_id, transactions)
             except Exception as e:
                 log_this(f"        COULD NOT UPDATE TRANSACTIONS FOR USER {user_id} ON LINK SYNC", "error")
                 log_this(f"        {e}", "error")
+                synced = False
 
             mongo_timer_end = datetime.datetime.now()
             log_this(f"      Transaction insertion took: {mongo_timer_end-mongo_timer}", "info")
@@ -87,57 +90,37 @@ for row in tqdm(rows):
     response = handle_pave_request(
         user_id=user_id,
         method="get",
-        endpoint=f"{pave_base_url}/{user_id}/balances",
+        endpoint=f"{pave_base_url()}/{user_id}/balances",
         payload=None,
-        headers=pave_headers,
+        headers=pave_headers(),
         params=params,
     )
 
     if response.status_code != 200:
         log_this("    Non 200 return code on balances", "exception")
+        synced = False
     else:
         mongo_timer = datetime.datetime.now()
-        mongo_collection = mongo_db["balances"]
-        balances = response.json()["accounts_balances"]
+        balances = response_json(response)["accounts_balances"]
 
         if len(balances) > 0:
             log_this(f"    Inserting {json.dumps(balances)[:200]} into balances", "info")
 
             try:
-                for balance_obj in balances:
-                    # Add each balance object that isn't already listed in the account @ balance_obj["account_id"]
-                    result = mongo_collection.update_one(
-                        {"user_id": str(user_id), "balances.accounts_balances": {"$elemMatch": {"account_id": balance_obj["account_id"]}}},
-                        {"$addToSet": {"balances.accounts_balances.$.balances": {"$each": balance_obj["balances"]}},
-                         "$set":{"balances.accounts_balances.$.days_negative": balance_obj["days_negative"],
-                                "balances.accounts_balances.$.days_single_digit": balance_obj["days_single_digit"],
-                                "balances.accounts_balances.$.days_double_digit": balance_obj["days_double_digit"],
-                                "balances.accounts_balances.$.median_balance": balance_obj["median_balance"]}}
-                    )
-
-                    if result.matched_count == 0:
-                        log_this(f"\tInserting {json.dumps(balance_obj['balances'])} into balances", "info")
-                        mongo_collection.update_one(
-                            {"user_id": str(user_id)},
-                            {"$push": {"balances.accounts_balances": balances},
-                             "$set":{"balances.accounts_balances.$.days_negative": balance_obj["days_negative"],
-                                "balances.accounts_balances.$.days_single_digit": balance_obj["days_single_digit"],
-                                "balances.accounts_balances.$.days_double_digit": balance_obj["days_double_digit"],
-                                "balances.accounts_balances.$.median_balance": balance_obj["median_balance"]}}
-                        )
-
-                mongo_collection.update_one(
-                    {"user_id": str(user_id)},
-                    {"$set": {"balances.to": end_date_str, "date": datetime.datetime.now()}},
-                    bypass_document_validation = True
-                )
+                store.write_balances(user_id, balances)
             except Exception as e:
                 log_this(f"    COULD NOT UPDATE BALANCES FOR USER {user_id} ON LINK SYNC", "error")
                 log_this(f"    {e}", "error")
+                synced = False
 
             mongo_timer_end = datetime.datetime.now()
             log_this(f"    Balance insertion took: {mongo_timer_end-mongo_timer}", "info")
 
+    checkpoint.observe(row["changed_at"], synced, key=row["id"])
 
+checkpoint.commit()
+upload_coordinator.close()
+log_this(f"Pave request stats: {pave_client.stats()}", "info")
+log_this(f"Pave response cache: {response_cache.stats()}", "info")
 close_backend_connection()
 close_pymongo_connection()
@@ -12,34 +12,50 @@ log_this(f"Process start: {process_start}", "info")
 
 conn = get_backend_connection()
 mongo_db = get_pymongo_connection()[pave_table]
+sink = MongoBulkSink(mongo_db, log=log_this)
+store = PaveStore(mongo_db, sink)
 
+# Every user created since the last run, plus the users that failed on an earlier one
+checkpoint = SyncCheckpoint(mongo_db, "new_user_sync", datetime.timedelta(minutes=30))
 rows = conn.execute(
-    "SELECT DISTINCT id FROM public.users WHERE created_at >= (NOW() - INTERVAL '30 minutes')"
+    sqlalchemy.text(
+        "SELECT id, created_at FROM public.users WHERE created_at > :watermark OR id IN :retry_user_ids "
+        "ORDER BY created_at"
+    ).bindparams(sqlalchemy.bindparam("retry_user_ids", expanding=True)),
+    {"watermark": checkpoint.load(), "retry_user_ids": checkpoint.retry_keys()},
 ).fetchall()
+created_at = {str(row[0]): row[1] for row in rows}
 
 # Ensure that we only get user_ids that we haven't processed before
 # because this is an expensive sync
-pave_user_ids = [x["user_id"] for x in list(mongo_db["balances"].find({}))]
-user_ids = [str(row[0]) for row in rows if str(row[0]) not in pave_user_ids]
+processed_users = ProcessedUserRegistry(mongo_db)
+processed_users.backfill_from(mongo_db["balances"])
+user_ids = processed_users.not_synced(created_at)
+synced_user_ids = []
+
+# Users an overlapping run claimed first, that run syncs them
+claimed_elsewhere = set()
 
 start = datetime.datetime.now()
-# Get all user access tokens and upload transaction/balance them using the pave agent
-for user_id in tqdm(user_ids):
+def users_with_access_tokens():
+    for user_id in user_ids:
+        if not processed_users.claim(user_id):
+            log_this(f"\tUser {user_id} is being synced by another run, skipping", "info")
+            claimed_elsewhere.add(user_id)
+            continue
+
+        rows = conn.execute(
+            f"SELECT DISTINCT access_token FROM public.plaid_links WHERE user_id = '{user_id}'"
+        ).fetchall()
+
+        yield user_id, token_decryptor().decrypt_many([str(row[0]) for row in rows])
+
+# Get all user access tokens and upload transaction/balance them using the pave agent,
+# the next users upload and wait on pave while the current one is being stored
+for user_id, upload in tqdm(upload_coordinator.iter_uploaded(users_with_access_tokens()), total=len(user_ids)):
     loop_start = datetime.datetime.now()
-    rows = conn.execute(
-        f"SELECT DISTINCT access_token FROM public.plaid_links WHERE user_id = '{user_id}'"
-    ).fetchall()
-
-    access_tokens = [decrypt(str(row[0])) for row in rows]
     time_in_days = 365 * 2
-
-    for access_token in access_tokens:
-        requests.post(
-            f"http://127.0.0.1:8123/v1/users/{user_id}/upload?num_transaction_days={time_in_days}",
-            json={"access_token": f"{access_token}"},
-        )
-        # Give pave agent some time to process transactions
-        time.sleep(2)
+    log_this(f"\tPave agent upload: {upload}", "debug")
 
     # Date ranges for pave
     start_date_str = (
@@ -52,40 +68,36 @@ for user_id in tqdm(user_ids):
     response = handle_pave_request(
         user_id=user_id,
         method="get",
-        endpoint=f"{pave_base_url}/{user_id}/transactions",
+        endpoint=f"{pave_base_url()}/{user_id}/transactions",
         payload=None,
-        headers=pave_headers,
+        headers=pave_headers(),
         params=params,
     )
-    insert_response_into_db(
-        user_id=user_id,
-        res=response,
-        mongo_db=mongo_db,
-        collection_name="transactions",
-        response_column_name="transactions",
-    )
     if response.status_code == 200:
-        transactions = response.json()["transactions"]
+        transactions = response_json(response)["transactions"]
+        store.write_transactions(user_id, transactions)
         if len(transactions) > 0:
             transaction_date_str = transactions[len(transactions)-1]["date"]
             params["start_date"] = transaction_date_str
+    else:
+        log_this("\tCan't insert transactions: {} {}\n".format(response.status_code, response.text[:500]), "warning")
     #####################################################################
 
     response = handle_pave_request(
         user_id=user_id,
         method="get",
-        endpoint=f"{pave_base_url}/{user_id}/balances",
+        endpoint=f"{pave_base_url()}/{user_id}/balances",
         payload=None,
-        headers=pave_headers,
+        headers=pave_headers(),
         params=params,
     )
-    insert_response_into_db(
-        user_id=user_id,
-        res=response,
-        mongo_db=mongo_db,
-        collection_name="balances",
-        response_column_name="balances",
-    )
+    if response.status_code == 200:
+        store.write_balances(user_id, response_json(response)["accounts_balances"])
+    else:
+        log_this("\tCan't insert balances: {} {}\n".format(response.status_code, response.text[:500]), "warning")
+    # Users whose balances couldn't be stored are picked up again next run
+    if response.status_code == 200:
+        synced_user_ids.append(user_id)
     #####################################################################
 
     # Store the unified insights data from pave
@@ -97,37 +109,33 @@ for user_id in tqdm(user_ids):
     response = handle_pave_request(
         user_id=user_id,
         method="get",
-        endpoint=f"{pave_base_url}/{user_id}/unified_insights",
+        endpoint=f"{pave_base_url()}/{user_id}/unified_insights",
         payload=None,
-        headers=pave_headers,
+        headers=pave_headers(),
         params=params,
     )
 
     if response.status_code == 200:
         ui_start = datetime.datetime.now()
-        for title, obj in response.json().items():
+        for title, obj in response_json(response).items():
             log_this("\tInserting response into: {}".format(title), "info")
-            mongo_collection = mongo_db[title]
-
-            try:
-                mongo_collection.replace_one(
-                    {"user_id": user_id},
-                    {
-                        title: obj,
-                        "user_id": user_id,
-                        "response_code": response.status_code,
-                        "date": datetime.datetime.now(),
-                    },
-                    upsert=True,
-                )
-            except Exception as e:
-                log_this(f"COULD NOT INSERT {title} FOR USER {user_id} ON NEW USER SYNC", "error")
-                log_this(f"{e}", "error")
+            sink.replace_one(
+                title,
+                {"user_id": user_id},
+                {
+                    title: obj,
+                    "user_id": user_id,
+                    "response_code": response.status_code,
+                    "date": datetime.datetime.now(),
+                },
+                context=f"{title} of user {user_id} on new user sync",
+                user_id=user_id,
+            )
         ui_end = datetime.datetime.now()
         log_this(f" Unified insights entry took {ui_end-ui_start}")
 
     else:
-        log_this("\tCan't insert: {} {}\n".format(response.status_code, response.json()), "warning")
+        log_this("\tCan't insert: {} {}\n".format(response.status_code, response_json(response)), "warning")
     #####################################################################
 
     # Store the attribute data from pave
@@ -135,9 +143,9 @@ for user_id in tqdm(user_ids):
     response = handle_pave_request(
         user_id=user_id,
         method="get",
-        endpoint=f"{pave_base_url}/{user_id}/attributes",
+        endpoint=f"{pave_base_url()}/{user_id}/attributes",
         payload=None,
-        headers=pave_headers,
+        headers=pave_headers(),
         params=params,
     )
     insert_response_into_db(
@@ -146,6 +154,7 @@ for user_id in tqdm(user_ids):
         mongo_db=mongo_db,
         collection_name="attributes",
         response_column_name="attributes",
+        sink=sink,
     )
     #####################################################################
     finish = datetime.datetime.now()
@@ -155,5 +164,23 @@ for user_id in tqdm(user_ids):
     if finish - start > datetime.timedelta(hours=4):
         break
 
+# Users are only marked once their responses have actually been written, the rest
+# are retried on the next run
+upload_coordinator.close()
+sink.close()
+# Only the users whose own writes failed, at any flush, are synced again
+written_user_ids = sink.written_users(synced_user_ids)
+if len(written_user_ids) < len(synced_user_ids):
+    log_this(f"Responses of {len(synced_user_ids) - len(written_user_ids)} new user(s) could not be written, they will be synced again", "error")
+synced_user_ids = written_user_ids
+processed_users.mark_synced(synced_user_ids, "new_user_sync")
+processed_users.release_claims()
+
+synced = set(synced_user_ids) | claimed_elsewhere | (created_at.keys() - set(user_ids))
+for user_id, user_created_at in created_at.items():
+    checkpoint.observe(user_created_at, user_id in synced, key=user_id)
+checkpoint.commit()
+log_this(f"Pave request stats: {pave_client.stats()}", "info")
+log_this(f"Pave response cache: {response_cache.stats()}", "info")
 close_backend_connection()
 close_pymongo_connection()
@@ -3,6 +3,23 @@
 # Legacy, keep here if we need to use Pave DB Connector
 #sudo docker run -v /home/langston/pave-prism/pave-agent/pa-server-ca.pem:/pa-server-ca.pem -v /home/langston/pave-prism/pave-agent/pa-client-cert.pem:/pa-client-cert.pem -v /home/langston/pave-prism/pave-agent/pa-client-key.pem:/pa-client-key.pem --env-file /home/langston/pave-prism/pave-agent/.env -p 8123:8000 docker.io/pavedev/agent:latest
 
-sudo docker kill pave-agent
-sudo docker rm pave-agent
-sudo docker run -d --env-file /home/langston/pave-prism/pave-agent.env -p 8123:8000 docker.io/pavedev/agent:latest
+# Runs a pool of pave agents, pave-agent-0 on port 8123, pave-agent-1 on 8124 and so on.
+# The syncs read the same PAVE_AGENT_POOL_SIZE and PAVE_AGENT_BASE_PORT (see agent_pool.py)
+# to spread uploads over them and restart the ones that stop answering.
+# Defaults to one agent per core, the same os.cpu_count() agent_pool.py defaults to, so
+# neither side needs PAVE_AGENT_POOL_SIZE exported unless the count should differ.
+# Usage: ./pave_agent_docker_command.sh [pool size]
+POOL_SIZE="${1:-${PAVE_AGENT_POOL_SIZE:-$(nproc --all)}}"
+BASE_PORT="${PAVE_AGENT_BASE_PORT:-8123}"
+
+# Clear out the old single agent and any previous pool
+for name in pave-agent $(sudo docker ps -a --format '{{.Names}}' | grep '^pave-agent-'); do
+    sudo docker kill "$name" 2>/dev/null
+    sudo docker rm "$name" 2>/dev/null
+done
+
+for ((i = 0; i < POOL_SIZE; i++)); do
+    sudo docker run -d --name "pave-agent-$i" --restart unless-stopped \
+        --env-file /home/langston/pave-prism/pave-agent.env \
+        -p "$((BASE_PORT + i)):8000" docker.io/pavedev/agent:latest
+done
@@ -0,0 +1,146 @@
+import email.utils
+import random
+import threading
+import time
+
+from typing import Callable, Dict, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def endpoint_family(endpoint: str) -> str:
+    # ".../v1/users/{user_id}/unified_insights" -> "unified_insights"
+    return urlparse(endpoint).path.rstrip("/").rsplit("/", 1)[-1]
+
+
+def _no_log(message: str, severity: str = "debug"):
+    pass
+
+'''
+    Keep-alive client for the Pave API. Every sync shares one pooled session,
+    429/5xx responses and connection errors are retried a bounded number of
+    times with capped, jittered backoff that honours Retry-After.
+
+    With a rate_limiter every attempt waits for a token from its endpoint
+    family first, and a 429 pauses that family for every process on the host.
+'''
+class PaveClient:
+    def __init__(
+        self,
+        log: Callable[[str, str], None] = _no_log,
+        pool_size: int = 16,
+        max_retries: int = 6,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 60.0,
+        timeout: tuple = (10, 600),
+        rate_limiter=None,
+    ):
+        self.log = log
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        self.set_pool_size(pool_size)
+
+        self._stats: Dict[str, dict] = {}
+        self._stats_lock = threading.Lock()
+
+    def request(
+        self,
+        method: str,
+        endpoint: str,
+        payload: Optional[dict] = None,
+        headers: Optional[dict] = None,
+        params: Optional[dict] = None,
+    ) -> requests.Response:
+        if method not in ("get", "post"):
+            raise ValueError("Method not understood {}".format(method))
+
+        family = endpoint_family(endpoint)
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire(family)
+
+            request_start = time.monotonic()
+            try:
+                res = self.session.request(
+                    method.upper(), endpoint, json=payload, headers=headers, params=params, timeout=self.timeout
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self._record(family, time.monotonic() - request_start, failed=True, retried=attempt > 0)
+                if attempt == self.max_retries:
+                    raise
+
+                wait = self._backoff(attempt)
+                self.log(f"{method.upper()} {endpoint} failed ({e}), retrying in {wait:.2f} second(s)", "error")
+                time.sleep(wait)
+                continue
+
+            failed = res.status_code in RETRY_STATUS_CODES
+            self._record(family, time.monotonic() - request_start, failed=failed, retried=attempt > 0)
+            if not failed or attempt == self.max_retries:
+                return res
+
+            wait = self._retry_after(res, attempt)
+            if res.status_code == 429 and self.rate_limiter is not None:
+                self.rate_limiter.pause(family, wait)
+
+            if res.status_code == 429:
+                self.log(f"Request limit reached, waiting {wait:.2f} second(s)", "error")
+            else:
+                self.log(f"{method.upper()} {endpoint} returned {res.status_code}, retrying in {wait:.2f} second(s)", "error")
+            time.sleep(wait)
+
+    # Size the connection pool to the number of threads sharing the session
+    def set_pool_size(self, pool_size: int):
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def stats(self) -> Dict[str, dict]:
+        with self._stats_lock:
+            return {
+                family: {**counters, "mean_seconds": counters["total_seconds"] / counters["count"]}
+                for family, counters in self._stats.items()
+            }
+
+    def close(self):
+        self.session.close()
+
+    def _backoff(self, attempt: int) -> float:
+        ceiling = min(self.backoff_cap, self.backoff_base * 2 ** attempt)
+        return random.uniform(ceiling / 2, ceiling)
+
+    def _retry_after(self, res: requests.Response, attempt: int) -> float:
+        retry_after = res.headers.get("Retry-After")
+        if retry_after is None:
+            return self._backoff(attempt)
+
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            try:
+                wait = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError, AttributeError):
+                return self._backoff(attempt)
+
+        # Spread out callers that were all told the same Retry-After
+        return min(self.backoff_cap, max(0.0, wait) + random.uniform(0, self.backoff_base))
+
+    def _record(self, family: str, seconds: float, failed: bool, retried: bool):
+        with self._stats_lock:
+            counters = self._stats.setdefault(
+                family, {"count": 0, "failed": 0, "retries": 0, "total_seconds": 0.0, "max_seconds": 0.0}
+            )
+            counters["count"] += 1
+            counters["failed"] += int(failed)
+            counters["retries"] += int(retried)
+            counters["total_seconds"] += seconds
+            counters["max_seconds"] = max(counters["max_seconds"], seconds)
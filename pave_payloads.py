@@ -0,0 +1,33 @@
+from typing import Iterator, List
+
+# Largest number of transactions sent to pave in a single POST /{user_id}/transactions
+MAX_TRANSACTIONS_PER_POST = 500
+
+
+def pave_transaction_from_row(row: dict) -> dict:
+    return {
+        "transaction_id": str(row["plaid_transaction_id"]),
+        "account_id": str(row["plaid_account_id"]),
+        "amount": float(row["amount"]),
+        "date": str(row["authorized_date"]),
+        "memo": " ".join(
+            row["personal_finance_category"].values()
+        )
+        if row["personal_finance_category"]
+        else "",
+        "name": row["name"] if row["name"] else " ",
+        "pending": row["pending"],
+        "category": row["category"],
+        "category_id": row["category_id"],
+        "iso_currency_code": row["iso_currency_code"],
+        "merchant_name": row["merchant_name"],
+        "payment_channel": row["payment_channel"],
+        "transaction_type": row["transaction_type"],
+        "payment_meta": row["payment_meta"],
+        "location": row["location"]
+    }
+
+
+def chunked(items: List, size: int) -> Iterator[List]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
@@ -0,0 +1,153 @@
+import datetime
+
+from itertools import groupby
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import ASCENDING, UpdateOne
+
+# One document per (user_id, transaction_id), the legacy per user documents keep "transactions"
+TRANSACTIONS = "pave_transactions"
+BALANCE_BUCKETS = "balance_buckets"
+
+# Per account figures pave sends next to each account's daily balances
+BALANCE_SUMMARY_FIELDS = ("days_negative", "days_single_digit", "days_double_digit", "median_balance")
+
+_indexed_databases = set()
+
+
+def month_of(date_str: Optional[str]) -> str:
+    # "2023-04-17" -> "2023-04"
+    return str(date_str)[:7] if date_str else "unknown"
+
+'''
+    Reads and writes pave transactions and balances instead of one ever growing
+    document per user.
+
+    Transactions are one document per (user_id, transaction_id), upserted, so a
+    transaction whose amount or pending flag changes is updated in place and a user's
+    transactions are read with an indexed range scan over date.
+
+    Balances are one document per (user_id, account_id, month), with the daily
+    balances keyed by date so a write is a $set of only the new keys. Either way the
+    cost of a write depends on how much is written, not on how much history is
+    already stored.
+
+    Every sync writes through here. With a MongoBulkSink the updates are queued on
+    it, otherwise each call is one unordered bulk_write per collection.
+'''
+class PaveStore:
+    def __init__(self, mongo_db, sink=None):
+        self.mongo_db = mongo_db
+        self.sink = sink
+
+        if mongo_db.name not in _indexed_databases:
+            self.ensure_indexes()
+            _indexed_databases.add(mongo_db.name)
+
+    def ensure_indexes(self):
+        self.mongo_db[TRANSACTIONS].create_index(
+            [("user_id", ASCENDING), ("transaction_id", ASCENDING)],
+            name="user_id_1_transaction_id_1",
+            unique=True,
+        )
+        self.mongo_db[TRANSACTIONS].create_index(
+            [("user_id", ASCENDING), ("date", ASCENDING)],
+            name="user_id_1_date_1",
+        )
+        self.mongo_db[BALANCE_BUCKETS].create_index(
+            [("user_id", ASCENDING), ("account_id", ASCENDING), ("month", ASCENDING)],
+            name="user_id_1_account_id_1_month_1",
+            unique=True,
+        )
+
+    def transaction_updates(self, user_id: str, transactions: Iterable[dict]) -> List[UpdateOne]:
+        now = datetime.datetime.now()
+        return [
+            UpdateOne(
+                {"user_id": str(user_id), "transaction_id": str(transaction["transaction_id"])},
+                {
+                    "$set": {
+                        "account_id": str(transaction.get("account_id")),
+                        "date": transaction.get("date"),
+                        "transaction": transaction,
+                        "updated_at": now,
+                    },
+                    "$setOnInsert": {"created_at": now},
+                },
+                upsert=True,
+            )
+            for transaction in transactions
+        ]
+
+    def balance_updates(self, user_id: str, accounts_balances: Iterable[dict]) -> List[UpdateOne]:
+        now = datetime.datetime.now()
+        updates = []
+        for account in accounts_balances:
+            account_id = str(account["account_id"])
+            daily = sorted(account.get("balances") or [], key=lambda balance: str(balance.get("date")))
+
+            months = []
+            for month, month_balances in groupby(daily, key=lambda balance: month_of(balance.get("date"))):
+                entries = {f"balances.{balance['date']}": balance for balance in month_balances}
+                months.append((month, entries))
+
+            # The account's summary lives on its newest bucket
+            summary = {field: account[field] for field in BALANCE_SUMMARY_FIELDS if field in account}
+            if not months and summary:
+                months.append((month_of(now.strftime("%Y-%m-%d")), {}))
+            if months and summary:
+                months[-1][1]["summary"] = summary
+
+            updates.extend(
+                UpdateOne(
+                    {"user_id": str(user_id), "account_id": account_id, "month": month},
+                    {"$set": {**entries, "updated_at": now}},
+                    upsert=True,
+                )
+                for month, entries in months
+            )
+
+        return updates
+
+    def write_transactions(self, user_id: str, transactions: Iterable[dict]) -> int:
+        return self._write(TRANSACTIONS, self.transaction_updates(user_id, transactions), user_id, f"transactions of user {user_id}")
+
+    def write_balances(self, user_id: str, accounts_balances: Iterable[dict]) -> int:
+        return self._write(BALANCE_BUCKETS, self.balance_updates(user_id, accounts_balances), user_id, f"balances of user {user_id}")
+
+    def read_transactions(self, user_id: str, start_date: Optional[str] = None, end_date: Optional[str] = None) -> List[dict]:
+        query = {"user_id": str(user_id)}
+        if start_date or end_date:
+            query["date"] = {}
+            if start_date:
+                query["date"]["$gte"] = start_date
+            if end_date:
+                query["date"]["$lte"] = end_date
+
+        cursor = self.mongo_db[TRANSACTIONS].find(query, projection={"transaction": 1}).sort("date", ASCENDING)
+        return [document["transaction"] for document in cursor]
+
+    def read_balances(self, user_id: str) -> List[dict]:
+        # In the shape pave returns accounts_balances in
+        accounts: Dict[str, dict] = {}
+        for bucket in self.mongo_db[BALANCE_BUCKETS].find({"user_id": str(user_id)}).sort("month", ASCENDING):
+            account = accounts.setdefault(bucket["account_id"], {"account_id": bucket["account_id"], "balances": []})
+            account["balances"].extend(bucket.get("balances", {}).values())
+            account.update(bucket.get("summary", {}))
+
+        for account in accounts.values():
+            account["balances"].sort(key=lambda balance: str(balance.get("date")))
+
+        return list(accounts.values())
+
+    def _write(self, collection_name: str, updates: List[UpdateOne], user_id: str, context: str) -> int:
+        if not updates:
+            return 0
+
+        if self.sink is not None:
+            for update in updates:
+                self.sink.add(collection_name, update, context, str(user_id))
+        else:
+            self.mongo_db[collection_name].bulk_write(updates, ordered=False)
+
+        return len(updates)
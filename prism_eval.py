@@ -1,17 +1,21 @@
+import argparse
 import json
-import math
 import requests
 import datetime
 import logging
+import threading
 from logging.handlers import RotatingFileHandler
 
-from typing import Dict
+from typing import Dict, List
 import sqlalchemy
 from tqdm import tqdm
 
+from concurrent_runner import UserOutcome, run_concurrently
 from db_connections import Connection_Manager
+from sanitised_json import response_json
+from secret_store import secret_store
+from backend_queries import PRISM_ACCOUNTS_FOR_USER, PRISM_TRANSACTIONS_FOR_USER
 
-from google.cloud import secretmanager
 
 logging.basicConfig(
     handlers=[
@@ -22,19 +26,66 @@ logging.basicConfig(
     level=logging.DEBUG,
 )
 
-secret_manager_client = secretmanager.SecretManagerServiceClient()
+# Resolved the first time a user is sent to prism
+def prism_info() -> dict:
+    return secret_store.get_json("pave-prism-info")
 
-prism_str = secret_manager_client.access_secret_version(
-    name=f"projects/eql-data-processing/secrets/pave-prism-info/versions/latest"
-).payload.data.decode("UTF-8")
+cm = Connection_Manager()
 
-prism_data = json.loads(prism_str)
-prism_host = prism_data["PRISM-HOST"]
-prism_token = prism_data["PRISM_ACCESS_TOKEN"]
+# Mongo is only connected to, and its uri resolved, once something is read or written
+def prism_db():
+    return cm.get_pymongo_table("prism")
+
+# Caps how many /v2/evaluation requests are in flight at once when evaluating with --workers
+prism_requests = threading.BoundedSemaphore(1)
+
+# Account subtypes prism evaluates, everything else (credit cards, loans...) is left out
+PRISM_ACCOUNT_SUBTYPES = frozenset([
+    'SAVINGS', 'CHECKING', 'HSA', 'CD', 'MONEY MARKET', 'PAYPAL', 'PREPAID', 'CASH MANAGEMENT', 'EBT',
+    '529', '401A', '401K', '403B', '457B', 'BROKERAGE', 'EDUCATION SAVINGS ACCOUNT', 'FIXED ANNUITY',
+    'HEALTH REIMBURSEMENT ARRANGEMENT', 'IRA', 'KEOGH', 'LIFE INSURANCE', 'MUTUAL FUND',
+    'NON-TAXABLE BROKERAGE ACCOUNT', 'OTHER ANNUITY', 'OTHER INSURANCE', 'PENSION', 'PROFIT SHARING PLAN',
+    'QSHR', 'RETIREMENT', 'ROTH', 'ROTH 401K', 'SARSEP', 'SEP IRA', 'SIMPLE IRA', 'STOCK PLAN', 'TRUST',
+    'UGMA', 'UTMA', 'VARIABLE ANNUITY', 'THRIFT SAVINGS PLAN', 'OTHER',
+])
+
+
+def prism_account(account: dict) -> dict:
+    return {
+        "account_id": account["account_id"],
+        "account_type": account["subtype"],
+        "balance_date": account["balance_date"].strftime("%Y-%m-%d"),
+        "available_balance": account["available_balance"],
+        "current_balance": account["current_balance"],
+        "iso_currency_code": account["iso_currency_code"],
+        "institution_id": account["institution_id"],
+    }
 
-cm = Connection_Manager()
 
-mongo_db = cm.get_pymongo_table("prism")
+def prism_transaction(transaction: dict) -> dict:
+    return {
+        "transaction_id": transaction["transaction_id"],
+        "account_id": transaction["account_id"],
+        "amount": abs(float(transaction["amount"])),
+        "credit_or_debit": "CREDIT"
+        if float(transaction["amount"]) < 0
+        else "DEBIT",
+        "posted_date": transaction["date"],
+        "memo": " ".join(transaction["category"])
+        if transaction["category"]
+        else ""
+        + " ".join(
+            transaction["personal_finance_category"].values()
+        )
+        if transaction["personal_finance_category"]
+        else "",
+        "iso_currency_code": transaction["iso_currency_code"],
+        "authorized_date": transaction["authorized_date"],
+        "merchant_name": transaction["merchant_name"],
+        "payment_channel": transaction["payment_channel"],
+        "transaction_type": transaction["transaction_type"],
+    }
+
 
 # Pull transactions for 6 months from backend db
 def aggregate2(
@@ -45,111 +96,73 @@ def aggregate2(
     ).strftime("%Y-%m-%d"),
     end_date_str: str = datetime.datetime.now().strftime("%Y-%m-%d"),
 ):
-    cashflow_data = {"accounts": [], "transactions": []}
+    params = {"user_id": str(user_id), "start_date": start_date_str, "end_date": end_date_str}
 
-    link_select_string = (
-        f"SELECT id FROM public.plaid_links WHERE user_id = '{user_id}'"
+    # Postgres unpacks the raw sets and deduplicates them, only the fields prism needs
+    # for each unique transaction and the newest snapshot of each account come back
+    transactions = conn.execution_options(stream_results=True).execute(
+        sqlalchemy.text(PRISM_TRANSACTIONS_FOR_USER), params
     )
-    link_id_rows = conn.execute(link_select_string).fetchall()
-
-    sql_account_string = f"SELECT created_at, data FROM public.plaid_raw_transaction_sets WHERE start_date >= '{start_date_str}'::date AND end_date <= '{end_date_str}'::date "
+    cashflow_data = {"accounts": [], "transactions": [prism_transaction(row._mapping) for row in transactions]}
 
-    if len(link_id_rows) > 1:
-        link_ids = tuple([str(x[0]) for x in link_id_rows])
-        sql_account_string += f"AND link_id IN {link_ids}"
-    elif len(link_id_rows) == 1:
-        sql_account_string += f"AND link_id = '{(link_id_rows[0])[0]}'"
-    else:
-        return cashflow_data
-
-    raw_transactions = conn.execute(sql_account_string).fetchall()
-
-    # TODO: This is the main slowdown for the prism eval. Having to deduplicate transactions and accounts
-    # from the backend raw transaction sets sucks massively.
-    newest_account_dict = {}
-    trans_ids = []
-    for row in raw_transactions:
-        for item in row[1]:
-            for account in item["accounts"]:
-                if (
-                    (account["account_id"] not in newest_account_dict.keys()
-                    or account["account_id"] in newest_account_dict.keys()
-                    and newest_account_dict[account["account_id"]]["date"] < row[0])
-                    and account["subtype"] in ['SAVINGS', 'CHECKING', 'HSA', 'CD', 'MONEY MARKET', 'PAYPAL', 'PREPAID', 'CASH MANAGEMENT', 'EBT', '529', '401A', '401K', '403B', '457B', 'BROKERAGE', 'EDUCATION SAVINGS ACCOUNT', 'FIXED ANNUITY', 'HEALTH REIMBURSEMENT ARRANGEMENT', 'IRA', 'KEOGH', 'LIFE INSURANCE', 'MUTUAL FUND', 'NON-TAXABLE BROKERAGE ACCOUNT', 'OTHER ANNUITY', 'OTHER INSURANCE', 'PENSION', 'PROFIT SHARING PLAN', 'QSHR', 'RETIREMENT', 'ROTH', 'ROTH 401K', 'SARSEP', 'SEP IRA', 'SIMPLE IRA', 'STOCK PLAN', 'TRUST', 'UGMA', 'UTMA', 'VARIABLE ANNUITY', 'THRIFT SAVINGS PLAN', 'OTHER']
-                ):
-                    newest_account_dict[account["account_id"]] = {"date": row[0]}
-
-                    a = {
-                        "account_id": account["account_id"],
-                        "account_type": account["subtype"],
-                        "balance_date": row[0].strftime("%Y-%m-%d"),
-                        "available_balance": account["balances"]["available"],
-                        "current_balance": account["balances"]["current"],
-                        "iso_currency_code": account["balances"]["iso_currency_code"],
-                        "institution_id": item["item"]["institution_id"],
-                    }
-                    newest_account_dict[account["account_id"]]["account"] = a
-                else:
-                    pass
-
-            for transaction in item["transactions"]:
-                if transaction["transaction_id"] not in trans_ids:
-                    trans_ids.append(transaction["transaction_id"])
-
-                    # print(transaction, "\n")
-                    cashflow_data["transactions"].append(
-                        {
-                            "transaction_id": transaction["transaction_id"],
-                            "account_id": transaction["account_id"],
-                            "amount": abs(float(transaction["amount"])),
-                            "credit_or_debit": "CREDIT"
-                            if float(transaction["amount"]) < 0
-                            else "DEBIT",
-                            "posted_date": transaction["date"],
-                            "memo": " ".join(transaction["category"])
-                            if transaction["category"]
-                            else ""
-                            + " ".join(
-                                transaction["personal_finance_category"].values()
-                            )
-                            if transaction["personal_finance_category"]
-                            else "",
-                            "iso_currency_code": transaction["iso_currency_code"],
-                            "authorized_date": transaction["authorized_date"],
-                            "merchant_name": transaction["merchant_name"],
-                            "payment_channel": transaction["payment_channel"],
-                            "transaction_type": transaction["transaction_type"],
-                        }
-                    )
-
-    for account_data in newest_account_dict.values():
-        assert account_data["account"]["account_id"] not in [a["account_id"] for a in cashflow_data["accounts"]], f"Found a duplicate account: {account_data=}, {cashflow_data=}"
-        cashflow_data["accounts"].append(account_data["account"])
+    accounts = conn.execute(
+        sqlalchemy.text(PRISM_ACCOUNTS_FOR_USER),
+        {**params, "subtypes": sorted(PRISM_ACCOUNT_SUBTYPES)},
+    )
+    cashflow_data["accounts"] = [prism_account(row._mapping) for row in accounts]
 
     return cashflow_data
 
 
-def calculate_new_cashscore(user_id: str, conn: sqlalchemy.engine.Connection):
-    # This ensures that the eval is only done for the user once a month
-    responses = mongo_db["responses"]
-    cashscore_data = responses.find_one(
-        {"user_id": str(user_id), "status_code": 200}, sort=[("created_at", -1)]
+def ensure_responses_index():
+    # Lets latest_evaluations walk each user's newest successful response straight off the index
+    prism_db().responses.create_index(
+        [("status_code", 1), ("user_id", 1), ("created_at", -1)],
+        name="status_code_1_user_id_1_created_at_-1",
     )
 
-    thirty_days_ago = datetime.datetime.now() - datetime.timedelta(days=30)
-    if cashscore_data is None or cashscore_data["created_at"].replace(
-        tzinfo=datetime.timezone.utc
-    ) < thirty_days_ago.replace(tzinfo=datetime.timezone.utc):
-        logging.info("Calculating new cashscore for user: {}".format(user_id))
-    else:
-        logging.warning(
-            "\tCashscore calcaluted recently for user {} -> Score:{} @ {}\n".format(
-                user_id,
-                cashscore_data["response"]["products"]["cashscore"],
-                cashscore_data["created_at"].strftime("%Y-%m-%d"),
+
+# The newest successful prism response of every user, in a single aggregation
+def latest_evaluations() -> Dict[str, dict]:
+    pipeline = [
+        {"$match": {"status_code": 200}},
+        {"$sort": {"user_id": 1, "created_at": -1}},
+        {
+            "$group": {
+                "_id": "$user_id",
+                "created_at": {"$first": "$created_at"},
+                "cashscore": {"$first": "$response.products.cashscore"},
+            }
+        },
+    ]
+    return {str(evaluation["_id"]): evaluation for evaluation in prism_db().responses.aggregate(pipeline, allowDiskUse=True)}
+
+
+# This ensures that the eval is only done for the user once a month
+def users_due_for_eval(user_ids: List[str]) -> List[str]:
+    ensure_responses_index()
+    evaluations = latest_evaluations()
+    thirty_days_ago = (datetime.datetime.now() - datetime.timedelta(days=30)).replace(tzinfo=datetime.timezone.utc)
+
+    due = []
+    for user_id in user_ids:
+        evaluation = evaluations.get(str(user_id))
+        if evaluation is None or evaluation["created_at"].replace(tzinfo=datetime.timezone.utc) < thirty_days_ago:
+            due.append(user_id)
+        else:
+            logging.warning(
+                "\tCashscore calcaluted recently for user {} -> Score:{} @ {}\n".format(
+                    user_id,
+                    evaluation.get("cashscore"),
+                    evaluation["created_at"].strftime("%Y-%m-%d"),
+                )
             )
-        )
-        return
+
+    return due
+
+
+def calculate_new_cashscore(user_id: str, conn: sqlalchemy.engine.Connection) -> str:
+    logging.info("Calculating new cashscore for user: {}".format(user_id))
 
     # If we're calculating a new cashscore aggregate transaction and account data
     cashflow_data = aggregate2(user_id, conn)
@@ -157,13 +170,13 @@ def calculate_new_cashscore(user_id: str, conn: sqlalchemy.engine.Connection):
 
     if len(cashflow_data["accounts"]) == 0:
         logging.info("\tNo accounts, skipping eval...")
-        return
+        return "no accounts"
     if len(cashflow_data["transactions"]) == 0:
         logging.info("\tNo transactions, skipping eval...")
-        return
+        return "no transactions"
     elif len(cashflow_data["transactions"]) < 25:
         logging.warning("\tNot enough transactions, skipping eval...")
-        return
+        return "not enough transactions"
 
     # This is done just to see what prism transaction-per-date-range threshold is
     # if the amount of transactions is too low or too infrequent for a given range of time
@@ -192,17 +205,18 @@ def calculate_new_cashscore(user_id: str, conn: sqlalchemy.engine.Connection):
 
     headers = {
         "Content-Type": "application/json",
-        "Authorization": f"Bearer {prism_token}",
+        "Authorization": f"Bearer {prism_info()['PRISM_ACCESS_TOKEN']}",
     }
 
     endpoint = (
-        prism_host + "/v2/evaluation?cashscore=1&insights=1&income=1"
+        prism_info()["PRISM-HOST"] + "/v2/evaluation?cashscore=1&insights=1&income=1"
     )
-    res = requests.post(endpoint, data=json.dumps(payload), headers=headers)
-    response = convert_nans(res.json())
+    with prism_requests:
+        res = requests.post(endpoint, data=json.dumps(payload), headers=headers)
+    response = response_json(res)
     logging.debug(f"Adding response: {json.dumps(response)[:500]}")
 
-    mongo_db.responses.insert_one(
+    prism_db().responses.insert_one(
         {
             "created_at": datetime.datetime.now(),
             "status_code": res.status_code,
@@ -218,7 +232,7 @@ def calculate_new_cashscore(user_id: str, conn: sqlalchemy.engine.Connection):
         categories = response["products"]["categories"]["result"]
         income = response["products"]["income"]["result"]
 
-        mongo_db.cashscores.insert_one(
+        prism_db().cashscores.insert_one(
             {
                 "created_at": datetime.datetime.now(),
                 "cashscore": cashscore,
@@ -226,7 +240,7 @@ def calculate_new_cashscore(user_id: str, conn: sqlalchemy.engine.Connection):
             }
         )
 
-        mongo_db.insights.insert_one(
+        prism_db().insights.insert_one(
             {
                 "created_at": datetime.datetime.now(),
                 "insights": insights,
@@ -234,7 +248,7 @@ def calculate_new_cashscore(user_id: str, conn: sqlalchemy.engine.Connection):
             }
         )
 
-        mongo_db.categories.insert_one(
+        prism_db().categories.insert_one(
             {
                 "created_at": datetime.datetime.now(),
                 "categories": categories,
@@ -242,7 +256,7 @@ def calculate_new_cashscore(user_id: str, conn: sqlalchemy.engine.Connection):
             }
         )
 
-        mongo_db.incomes.insert_one(
+        prism_db().incomes.insert_one(
             {
                 "created_at": datetime.datetime.now(),
                 "income": income,
@@ -251,21 +265,40 @@ def calculate_new_cashscore(user_id: str, conn: sqlalchemy.engine.Connection):
         )
 
         logging.debug("Inserted into tables!")
+        return "evaluated"
     except:
         logging.debug(f"No products recieved for user: {user_id}")
+        return f"no products (status {res.status_code})"
 
-# Prism returns Nans (bruh)
-def convert_nans(obj: Dict):
-    for key, value in obj.items():
-        if type(value) == dict:
-            obj[key] = convert_nans(value)
-        elif type(value) not in [str, list] and math.isnan(value):
-            obj[key] = ""
 
-    return obj
+def log_summary(outcomes: List[UserOutcome]):
+    counts = {}
+    for outcome in outcomes:
+        result = "failed" if outcome.error is not None else outcome.result
+        counts[result] = counts.get(result, 0) + 1
+
+    logging.info(f"Eval summary: {counts}")
+    for outcome in outcomes:
+        if outcome.error is not None:
+            logging.info(f"\t{outcome.user_id}: failed -> {outcome.error!r}")
+        else:
+            logging.info(f"\t{outcome.user_id}: {outcome.result}")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="Number of users to aggregate and evaluate at once",
+    )
+    parser.add_argument(
+        "--max-prism-requests", type=int, default=None,
+        help="Most /v2/evaluation requests in flight at once, defaults to --workers",
+    )
+    args = parser.parse_args()
+    workers = max(1, args.workers)
+    prism_requests = threading.BoundedSemaphore(max(1, args.max_prism_requests or workers))
+
     param_user_ids = ""
 
     conn = cm.get_postgres_connection()
@@ -277,14 +310,40 @@ if __name__ == "__main__":
         rows = conn.execute("SELECT id FROM public.users").fetchall()
         user_ids = [str(u[0]) for u in rows]
 
+    user_ids = users_due_for_eval(user_ids)
+
     logging.debug(f"Running eval for {len(user_ids)} user(s)\n")
-    for user_id in tqdm(user_ids):
-        # Add rudimentary error handling so we don't leave the connection open
-        try:
-            calculate_new_cashscore(user_id, conn)
-        except Exception as e:
-            logging.exception(e)
+    if workers > 1:
+        cm.close_postgres_connection(conn)
+
+        # One pooled connection per worker, checked out for each user it evaluates
+        worker_cm = Connection_Manager(pool_size=workers, max_overflow=0)
+
+        def evaluate(user_id: str) -> str:
+            user_conn = worker_cm.get_postgres_connection()
+            try:
+                return calculate_new_cashscore(user_id, user_conn)
+            finally:
+                worker_cm.close_postgres_connection(user_conn)
+
+        outcomes = run_concurrently(
+            evaluate, user_ids, workers,
+            lambda message, severity: getattr(logging, severity)(message),
+        )
+        worker_cm.close_pymongo_connection()
+    else:
+        outcomes = []
+        for user_id in tqdm(user_ids):
+            # Add rudimentary error handling so we don't leave the connection open
+            try:
+                outcomes.append(UserOutcome(user_id, result=calculate_new_cashscore(user_id, conn)))
+            except Exception as e:
+                logging.exception(e)
+                outcomes.append(UserOutcome(user_id, error=e))
+
+        cm.close_postgres_connection(conn)
+
+    log_summary(outcomes)
 
     end = datetime.datetime.now()
     logging.info(f"\nTotal runtime: {end-start}")
-    cm.close_postgres_connection(conn)
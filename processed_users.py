@@ -0,0 +1,104 @@
+import datetime
+import os
+import socket
+import uuid
+
+from typing import Iterable, List, Set
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+# Largest $in list sent to mongo in one query
+MAX_IDS_PER_QUERY = 10_000
+
+'''
+    Registry of users the new user sync has already handled, one small document per
+    user keyed by _id = user_id. _id is always uniquely indexed, so checking a batch
+    of ids is one indexed $in query that never touches the balance payloads, and
+    marking a user is an atomic upsert that several processes can run at once.
+
+    Overlapping runs claim() a user right before uploading them, an atomic upsert of a
+    claimed_by/claimed_until lease, and skip users another process holds. Claims are
+    dropped by mark_synced and release_claims, or run out after claim_lease.
+'''
+class ProcessedUserRegistry:
+    def __init__(
+        self, mongo_db, collection_name: str = "processed_users", claim_lease: datetime.timedelta = datetime.timedelta(hours=1)
+    ):
+        self.collection = mongo_db[collection_name]
+        self.claim_lease = claim_lease
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def already_synced(self, user_ids: Iterable[str]) -> Set[str]:
+        user_ids = [str(user_id) for user_id in user_ids]
+
+        synced = set()
+        for start in range(0, len(user_ids), MAX_IDS_PER_QUERY):
+            # Users only claimed so far have no last_synced_at
+            cursor = self.collection.find(
+                {"_id": {"$in": user_ids[start:start + MAX_IDS_PER_QUERY]}, "last_synced_at": {"$exists": True}},
+                projection={"_id": 1},
+            )
+            synced.update(document["_id"] for document in cursor)
+
+        return synced
+
+    def not_synced(self, user_ids: Iterable[str]) -> List[str]:
+        user_ids = [str(user_id) for user_id in user_ids]
+        synced = self.already_synced(user_ids)
+        return [user_id for user_id in user_ids if user_id not in synced]
+
+    def claim(self, user_id: str) -> bool:
+        now = datetime.datetime.now()
+        try:
+            # Matches an unsynced user nobody else holds, otherwise the upsert hits the existing _id
+            self.collection.find_one_and_update(
+                {
+                    "_id": str(user_id),
+                    "last_synced_at": {"$exists": False},
+                    "$or": [
+                        {"claimed_until": {"$exists": False}},
+                        {"claimed_until": {"$lt": now}},
+                        {"claimed_by": self.owner},
+                    ],
+                },
+                {"$set": {"claimed_by": self.owner, "claimed_until": now + self.claim_lease}},
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            return False
+
+        return True
+
+    def release_claims(self):
+        self.collection.update_many(
+            {"claimed_by": self.owner}, {"$unset": {"claimed_by": "", "claimed_until": ""}}
+        )
+
+    def mark_synced(self, user_ids: Iterable[str], job: str):
+        now = datetime.datetime.now()
+        operations = [
+            UpdateOne(
+                {"_id": str(user_id)},
+                {
+                    "$set": {"last_synced_at": now, "job": job},
+                    "$setOnInsert": {"first_synced_at": now},
+                    "$unset": {"claimed_by": "", "claimed_until": ""},
+                },
+                upsert=True,
+            )
+            for user_id in user_ids
+        ]
+        if operations:
+            self.collection.bulk_write(operations, ordered=False)
+
+    '''
+        Seeds an empty registry with every user that already has a document in
+        `collection` (balances, before the registry existed). Only the user_id
+        values are read, through distinct, never the documents themselves.
+    '''
+    def backfill_from(self, collection, job: str = "backfill"):
+        if self.collection.estimated_document_count() > 0:
+            return
+
+        self.mark_synced(collection.distinct("user_id"), job)
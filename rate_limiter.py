@@ -0,0 +1,108 @@
+import fcntl
+import json
+import os
+import time
+
+from typing import Dict, Optional, Tuple
+
+# Requests per second and burst size for each pave endpoint family.
+# Override with PAVE_RATE_LIMITS='{"transactions": [10, 20], ...}'
+DEFAULT_LIMITS: Dict[str, Tuple[float, float]] = {
+    "transactions": (10.0, 20.0),
+    "balances": (10.0, 20.0),
+    "unified_insights": (2.0, 5.0),
+    "attributes": (2.0, 5.0),
+    "default": (5.0, 10.0),
+}
+
+DEFAULT_STATE_PATH = "/tmp/pave-rate-limiter.json"
+
+'''
+    Token bucket shared by every process on the host that calls pave. The buckets
+    live in a small JSON file and every read-modify-write holds an exclusive flock,
+    so the user, link, hourly, daily and weekly jobs draw from the same budget and
+    wait for a token before sending instead of finding out from a 429.
+'''
+class RateLimiter:
+    def __init__(self, limits: Optional[Dict[str, Tuple[float, float]]] = None, state_path: Optional[str] = None):
+        self.limits = dict(DEFAULT_LIMITS)
+        if os.environ.get("PAVE_RATE_LIMITS"):
+            self.limits.update({k: tuple(v) for k, v in json.loads(os.environ["PAVE_RATE_LIMITS"]).items()})
+        if limits:
+            self.limits.update(limits)
+
+        self.state_path = state_path or os.environ.get("PAVE_RATE_LIMIT_FILE", DEFAULT_STATE_PATH)
+
+    def acquire(self, family: str) -> float:
+        family = family if family in self.limits else "default"
+        waited = 0.0
+
+        while True:
+            with _LockedState(self.state_path) as state:
+                bucket = self._refill(state, family)
+                now = time.time()
+
+                if bucket["paused_until"] <= now and bucket["tokens"] >= 1:
+                    bucket["tokens"] -= 1
+                    return waited
+
+                rate, _ = self.limits[family]
+                wait = max(bucket["paused_until"] - now, (1 - bucket["tokens"]) / rate)
+
+            time.sleep(wait)
+            waited += wait
+
+    '''
+        Holds every process back from a family, used when pave answers 429 anyway
+    '''
+    def pause(self, family: str, seconds: float):
+        family = family if family in self.limits else "default"
+
+        with _LockedState(self.state_path) as state:
+            bucket = self._refill(state, family)
+            bucket["paused_until"] = max(bucket["paused_until"], time.time() + seconds)
+            bucket["tokens"] = 0.0
+
+    def _refill(self, state: dict, family: str) -> dict:
+        rate, burst = self.limits[family]
+        now = time.time()
+
+        bucket = state.setdefault(family, {"tokens": burst, "updated": now, "paused_until": 0.0})
+        bucket["tokens"] = min(burst, bucket["tokens"] + max(0.0, now - bucket["updated"]) * rate)
+        bucket["updated"] = now
+        return bucket
+
+
+class _LockedState:
+    def __init__(self, path: str):
+        self.path = path
+
+    def __enter__(self) -> dict:
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+
+        raw = b""
+        while True:
+            chunk = os.read(self.fd, 65536)
+            if not chunk:
+                break
+            raw += chunk
+
+        try:
+            self.state = json.loads(raw) if raw else {}
+        except ValueError:
+            # A half-written file from a killed process, start the buckets over
+            self.state = {}
+
+        return self.state
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                data = json.dumps(self.state).encode()
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                os.ftruncate(self.fd, 0)
+                os.write(self.fd, data)
+        finally:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
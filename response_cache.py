@@ -0,0 +1,232 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from typing import Callable, Dict, Optional
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from pave_client import endpoint_family
+
+# Seconds a GET response of each pave endpoint family is served from the cache, 0 turns
+# a family off. Override with PAVE_CACHE_TTLS='{"transactions": 3600, ...}'
+DEFAULT_TTLS: Dict[str, float] = {
+    "transactions": 6 * 3600.0,
+    "balances": 3600.0,
+    "unified_insights": 12 * 3600.0,
+    "attributes": 12 * 3600.0,
+    "default": 0.0,
+}
+
+# Holds every user's financial data, kept in a directory only the user running the jobs can read
+DEFAULT_CACHE_PATH = os.path.expanduser("~/.cache/pave-prism/responses.sqlite")
+DEFAULT_MAX_BYTES = 512 * 1024**2
+
+# Pave ingests POSTs and agent uploads in the background, responses read this soon after
+# one may not include it yet and aren't stored
+DEFAULT_WRITE_GRACE = 300.0
+
+
+def _no_log(message: str, severity: str = "debug"):
+    pass
+
+
+def normalised_params(params: Optional[dict]) -> str:
+    return json.dumps(params or {}, sort_keys=True, separators=(",", ":"), default=str)
+
+'''
+    Response cache for pave GETs shared by every process on the host, in a small
+    sqlite file. Entries are keyed by (user_id, endpoint, normalised params), hold
+    the zlib compressed body of a 200 response and expire after their endpoint
+    family's TTL. Once the bodies add up to more than max_bytes the least recently
+    used entries are evicted.
+
+    invalidate_user() drops every entry of a user, handle_pave_request calls it for
+    each POST and the upload coordinator after each agent upload.
+
+    The cache never fails a request, a sqlite error is logged and the request goes
+    to pave as it would without the cache.
+'''
+class ResponseCache:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttls: Optional[Dict[str, float]] = None,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        write_grace: float = DEFAULT_WRITE_GRACE,
+        log: Callable[[str, str], None] = _no_log,
+    ):
+        self.ttls = dict(DEFAULT_TTLS)
+        if os.environ.get("PAVE_CACHE_TTLS"):
+            self.ttls.update({k: float(v) for k, v in json.loads(os.environ["PAVE_CACHE_TTLS"]).items()})
+        if ttls:
+            self.ttls.update(ttls)
+
+        self.path = path or os.environ.get("PAVE_RESPONSE_CACHE_FILE", DEFAULT_CACHE_PATH)
+        self.max_bytes = max_bytes
+        self.write_grace = write_grace
+        self.log = log
+
+        self._lock = threading.Lock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._stats: Dict[str, dict] = {}
+
+    def ttl(self, family: str) -> float:
+        return self.ttls.get(family, self.ttls["default"])
+
+    def get(self, user_id: str, endpoint: str, params: Optional[dict]) -> Optional[requests.Response]:
+        family = endpoint_family(endpoint)
+        if self.ttl(family) <= 0:
+            return None
+
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute(
+                    "SELECT body, headers, expires_at FROM responses WHERE user_id = ? AND endpoint = ? AND params = ?",
+                    (str(user_id), endpoint, normalised_params(params)),
+                ).fetchone()
+
+                if row is not None and row[2] > time.time():
+                    conn.execute(
+                        "UPDATE responses SET last_used = ? WHERE user_id = ? AND endpoint = ? AND params = ?",
+                        (time.time(), str(user_id), endpoint, normalised_params(params)),
+                    )
+                    conn.commit()
+        except sqlite3.Error as e:
+            self.log(f"Pave response cache read failed: {e}", "warning")
+            return None
+
+        if row is None or row[2] <= time.time():
+            self._count(family, "misses")
+            return None
+
+        self._count(family, "hits")
+        return self._response(endpoint, params, zlib.decompress(row[0]), json.loads(row[1]))
+
+    def put(self, user_id: str, endpoint: str, params: Optional[dict], res: requests.Response):
+        family = endpoint_family(endpoint)
+        ttl = self.ttl(family)
+        if ttl <= 0 or res.status_code != 200:
+            return
+
+        body = zlib.compress(res.content)
+        headers = {name: value for name, value in res.headers.items() if name.lower() == "content-type"}
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                written = conn.execute("SELECT written_at FROM user_writes WHERE user_id = ?", (str(user_id),)).fetchone()
+                if written is not None and now - written[0] < self.write_grace:
+                    return
+
+                conn.execute(
+                    "INSERT OR REPLACE INTO responses (user_id, endpoint, params, body, headers, size, expires_at, last_used)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (str(user_id), endpoint, normalised_params(params), body, json.dumps(headers), len(body), now + ttl, now),
+                )
+                evicted = self._evict(conn)
+                conn.commit()
+        except sqlite3.Error as e:
+            self.log(f"Pave response cache write failed: {e}", "warning")
+            return
+
+        self._count(family, "stores")
+        if evicted:
+            self._count(family, "evictions", evicted)
+
+    def invalidate_user(self, user_id: str):
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute("DELETE FROM responses WHERE user_id = ?", (str(user_id),))
+                conn.execute("INSERT OR REPLACE INTO user_writes (user_id, written_at) VALUES (?, ?)", (str(user_id), time.time()))
+                conn.execute("DELETE FROM user_writes WHERE written_at < ?", (time.time() - self.write_grace,))
+                conn.commit()
+        except sqlite3.Error as e:
+            self.log(f"Pave response cache invalidation failed for user {user_id}: {e}", "warning")
+            return
+
+        self._count("all", "invalidations")
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            stats = {family: dict(counters) for family, counters in self._stats.items()}
+
+        for counters in stats.values():
+            lookups = counters["hits"] + counters["misses"]
+            counters["hit_rate"] = round(counters["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # Called with self._lock held, the one connection is shared by the process's threads
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+            # sqlite creates its files with the umask, they are created (or narrowed) to 0600 first
+            for path in (self.path, self.path + "-wal", self.path + "-shm"):
+                fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    os.fchmod(fd, 0o600)
+                finally:
+                    os.close(fd)
+
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " user_id TEXT, endpoint TEXT, params TEXT, body BLOB, headers TEXT,"
+                " size INTEGER, expires_at REAL, last_used REAL,"
+                " PRIMARY KEY (user_id, endpoint, params))"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            conn.execute("CREATE TABLE IF NOT EXISTS user_writes (user_id TEXT PRIMARY KEY, written_at REAL)")
+            conn.commit()
+            self._conn = conn
+
+        return self._conn
+
+    def _evict(self, conn: sqlite3.Connection) -> int:
+        conn.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+
+        evicted = 0
+        for user_id, endpoint, params, size in conn.execute(
+            "SELECT user_id, endpoint, params, size FROM responses ORDER BY last_used"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute(
+                "DELETE FROM responses WHERE user_id = ? AND endpoint = ? AND params = ?", (user_id, endpoint, params)
+            )
+            total -= size
+            evicted += 1
+
+        return evicted
+
+    def _response(self, endpoint: str, params: Optional[dict], body: bytes, headers: dict) -> requests.Response:
+        res = requests.Response()
+        res.status_code = 200
+        res._content = body
+        res.headers = CaseInsensitiveDict(headers)
+        res.encoding = "utf-8"
+        res.url = requests.Request("GET", endpoint, params=params).prepare().url
+        return res
+
+    def _count(self, family: str, counter: str, amount: int = 1):
+        with self._lock:
+            counters = self._stats.setdefault(
+                family, {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+            )
+            counters[counter] += amount
@@ -0,0 +1,21 @@
+import json
+
+from typing import Any
+
+# Prism and Pave both send NaN/Infinity/-Infinity, which aren't valid JSON. They are
+# swapped for "" while decoding so what gets stored in Mongo is plain JSON, nested dicts
+# and lists included, without walking the parsed response a second time.
+SANITISED_CONSTANT = ""
+
+
+def _sanitise_constant(constant: str) -> Any:
+    return SANITISED_CONSTANT
+
+
+def loads(text: str) -> Any:
+    return json.loads(text, parse_constant=_sanitise_constant)
+
+
+# Decodes a requests.Response body the same way
+def response_json(response) -> Any:
+    return response.json(parse_constant=_sanitise_constant)
@@ -0,0 +1,249 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+from typing import Any, Callable, Dict, Optional
+
+from cryptography.fernet import Fernet, InvalidToken
+
+SECRET_PROJECT = "projects/eql-data-processing"
+
+DEFAULT_CACHE_PATH = os.path.expanduser("~/.cache/pave-prism/secrets.enc")
+
+
+def _log_to_logging(message: str, severity: str = "debug"):
+    logging.getLogger("secret_store").log(logging._nameToLevel[severity.upper()], message)
+
+'''
+    Secret Manager values for the sync scripts, resolved the first time each one is
+    used instead of when a module is imported.
+
+    Resolved values are kept in a Fernet encrypted file readable only by the user
+    running the jobs, so most runs don't talk to Secret Manager at all. The key never
+    lives next to the cache: it comes from PAVE_SECRET_CACHE_KEY, or from the file at
+    PAVE_SECRET_CACHE_KEY_FILE (e.g. a provisioned /etc/pave-prism/secrets-cache.key,
+    created on first use if missing). Without a key nothing is written to disk and
+    every run fetches its secrets. A "latest"
+    value older than ttl is still used, and refreshed for the next run on a background
+    thread. Past max_stale it is fetched again before it is returned. Versions pinned
+    through `versions` or PAVE_SECRET_VERSIONS='{"mongodb-uri": "7"}' never change, so
+    they never expire.
+'''
+class SecretStore:
+    def __init__(
+        self,
+        project: str = SECRET_PROJECT,
+        cache_path: Optional[str] = None,
+        key_path: Optional[str] = None,
+        ttl: float = 3600.0,
+        max_stale: float = 7 * 24 * 3600.0,
+        versions: Optional[Dict[str, str]] = None,
+        timeout: float = 10.0,
+        log: Callable[[str, str], None] = _log_to_logging,
+    ):
+        self.project = project
+        self.cache_path = cache_path or os.environ.get("PAVE_SECRET_CACHE_FILE", DEFAULT_CACHE_PATH)
+        self.key_path = key_path or os.environ.get("PAVE_SECRET_CACHE_KEY_FILE")
+        self.ttl = float(os.environ.get("PAVE_SECRET_TTL", ttl))
+        self.max_stale = max_stale
+        self.timeout = timeout
+        self.log = log
+
+        self.versions = {}
+        if os.environ.get("PAVE_SECRET_VERSIONS"):
+            self.versions.update({k: str(v) for k, v in json.loads(os.environ["PAVE_SECRET_VERSIONS"]).items()})
+        if versions:
+            self.versions.update({k: str(v) for k, v in versions.items()})
+
+        self._lock = threading.Lock()
+        self._client = None
+        self._fernet_key: Optional[Fernet] = None
+        self._key_loaded = False
+        self._entries: Optional[Dict[str, dict]] = None
+        # What this process resolved, a refresh only changes what the next run sees
+        self._values: Dict[str, str] = {}
+        self._refreshing: Dict[str, threading.Thread] = {}
+
+    def version(self, name: str) -> str:
+        return self.versions.get(name, "latest")
+
+    def get(self, name: str) -> str:
+        key = f"{name}/{self.version(name)}"
+        with self._lock:
+            if key in self._values:
+                return self._values[key]
+
+        entry = self._cached_entries().get(key)
+        age = time.time() - entry["fetched_at"] if entry is not None else None
+
+        if entry is not None and (self.version(name) != "latest" or age < self.ttl):
+            value = entry["value"]
+        elif entry is not None and age < self.max_stale:
+            value = entry["value"]
+            self._refresh_in_background(name)
+        else:
+            value = self._fetch_and_store(name)["value"]
+
+        with self._lock:
+            return self._values.setdefault(key, value)
+
+    def get_json(self, name: str) -> Any:
+        return json.loads(self.get(name))
+
+    def _fetch(self, name: str) -> dict:
+        # Only imported and set up when a secret actually has to be fetched
+        from google.cloud import secretmanager
+
+        with self._lock:
+            if self._client is None:
+                self._client = secretmanager.SecretManagerServiceClient()
+            client = self._client
+
+        response = client.access_secret_version(
+            name=f"{self.project}/secrets/{name}/versions/{self.version(name)}", timeout=self.timeout
+        )
+        return {
+            "value": response.payload.data.decode("UTF-8"),
+            # "latest" resolved to a version number, kept to see which version a run used
+            "resolved_version": response.name.rsplit("/", 1)[-1],
+            "fetched_at": time.time(),
+        }
+
+    def _fetch_and_store(self, name: str) -> dict:
+        entry = self._fetch(name)
+        try:
+            self._store(f"{name}/{self.version(name)}", entry)
+        except OSError as e:
+            self.log(f"Could not cache secret {name}: {e}", "warning")
+
+        return entry
+
+    def _refresh_in_background(self, name: str):
+        with self._lock:
+            if name in self._refreshing:
+                return
+
+            # Not a daemon, a short run waits for the refresh instead of dropping it at exit
+            thread = threading.Thread(target=self._refresh, args=(name,), name=f"secret-refresh-{name}")
+            self._refreshing[name] = thread
+
+        thread.start()
+
+    def _refresh(self, name: str):
+        try:
+            entry = self._fetch_and_store(name)
+            self.log(f"Refreshed secret {name} (version {entry['resolved_version']})", "debug")
+        except Exception as e:
+            self.log(f"Could not refresh secret {name}, the cached value is used until it is: {e}", "warning")
+
+    def _cached_entries(self) -> Dict[str, dict]:
+        with self._lock:
+            if self._entries is None:
+                self._entries = self._read_file()
+            return self._entries
+
+    def _read_file(self) -> Dict[str, dict]:
+        if self._fernet() is None:
+            return {}
+
+        try:
+            with open(self.cache_path, "rb") as cache_file:
+                token = cache_file.read()
+        except FileNotFoundError:
+            return {}
+        except OSError as e:
+            self.log(f"Could not read the secret cache {self.cache_path}: {e}", "warning")
+            return {}
+
+        try:
+            return json.loads(self._fernet().decrypt(token))
+        except (InvalidToken, ValueError, OSError) as e:
+            # Written with another key or damaged, every secret is fetched again
+            self.log(f"Could not decrypt the secret cache {self.cache_path}: {e}", "warning")
+            return {}
+
+    def _store(self, key: str, entry: dict):
+        if self._fernet() is None:
+            return
+
+        os.makedirs(os.path.dirname(self.cache_path), mode=0o700, exist_ok=True)
+
+        # Other jobs on the host write the same file, re-read it under the lock so their entries are kept
+        with open(self.cache_path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                entries = self._read_file()
+                entries[key] = entry
+
+                tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "wb") as tmp_file:
+                    tmp_file.write(self._fernet().encrypt(json.dumps(entries).encode("utf-8")))
+                os.replace(tmp_path, self.cache_path)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _fernet(self) -> Optional[Fernet]:
+        if not self._key_loaded:
+            self._fernet_key = self._load_key()
+            self._key_loaded = True
+
+        return self._fernet_key
+
+    def _load_key(self) -> Optional[Fernet]:
+        if os.environ.get("PAVE_SECRET_CACHE_KEY"):
+            key = os.environ["PAVE_SECRET_CACHE_KEY"].encode("ascii")
+        elif self.key_path:
+            key_dir = os.path.dirname(os.path.realpath(self.key_path))
+            if key_dir == os.path.dirname(os.path.realpath(self.cache_path)):
+                self.log(f"The secret cache key {self.key_path} is next to the cache, secrets are not cached", "warning")
+                return None
+
+            try:
+                if not os.path.exists(self.key_path):
+                    _create_key_file(self.key_path)
+
+                with open(self.key_path, "rb") as key_file:
+                    if os.fstat(key_file.fileno()).st_mode & 0o077:
+                        self.log(f"The secret cache key {self.key_path} is readable by other users, secrets are not cached", "warning")
+                        return None
+                    key = key_file.read().strip()
+            except OSError as e:
+                self.log(f"Could not read the secret cache key {self.key_path}, secrets are not cached: {e}", "warning")
+                return None
+        else:
+            self.log("No secret cache key configured, secrets are fetched on every run", "debug")
+            return None
+
+        try:
+            return Fernet(key)
+        except ValueError as e:
+            self.log(f"The secret cache key is not a Fernet key, secrets are not cached: {e}", "warning")
+            return None
+
+
+def _create_key_file(key_path: str):
+    os.makedirs(os.path.dirname(key_path), mode=0o700, exist_ok=True)
+
+    # The key is written in full before link() puts it in place, so a process losing the
+    # race never reads an empty or half written key, and link() never replaces one
+    tmp_path = f"{key_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            tmp_file.write(Fernet.generate_key())
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+
+        os.link(tmp_path, key_path)
+    except FileExistsError:
+        pass
+    finally:
+        os.unlink(tmp_path)
+
+
+# Shared by every module of a process, nothing is resolved until a secret is asked for
+secret_store = SecretStore()
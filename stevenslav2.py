@@ -1,62 +1,126 @@
+import argparse
 import datetime
-import subprocess
+import functools
 import requests
 import json
+import os
 import logging
 from logging.handlers import RotatingFileHandler
 import time
 import requests
+import sqlalchemy
 import sys
-import base64
 import sys
 import uuid
 
+from itertools import groupby
+from typing import List, Optional
 from tqdm import tqdm
-from cryptography.fernet import Fernet, MultiFernet
 
+from backend_queries import LATEST_BALANCE_ACCOUNTS_PER_USER, USER_LINK_ACCOUNT_COUNTS, iter_latest_balance_accounts
+from checkpoints import SyncCheckpoint, as_utc
+from concurrent_runner import log_buffer, run_concurrently
+from content_hash import SectionHashes, content_hash
 from db_connections import Connection_Manager
-
-from google.cloud import secretmanager
-
-# Get pave secret values
-secret_manager_client = secretmanager.SecretManagerServiceClient()
+from decryption import TokenDecryptor
+from log_shipper import CloudLoggingSink, LogShipper
+from mongo_bulk_sink import MongoBulkSink
+from pave_client import PaveClient
+from pave_payloads import MAX_TRANSACTIONS_PER_POST, chunked, pave_transaction_from_row
+from pave_store import PaveStore
+from processed_users import ProcessedUserRegistry
+from rate_limiter import RateLimiter
+from response_cache import ResponseCache
+from sanitised_json import response_json
+from secret_store import secret_store
+from upload_coordinator import UploadCoordinator, UploadResult
 
 pave_table = "Pave-Production"
 
-# Decrpytion keys
-keys = secret_manager_client.access_secret_version(
-    name=f"projects/eql-data-processing/secrets/pave-agent-decryption-keys/versions/latest"
-).payload.data.decode("UTF-8")
-keys = json.loads(keys)["KEYS"]
+# Secrets are resolved on first use, a run with nothing to do never asks for them
+@functools.lru_cache(maxsize=None)
+def token_decryptor() -> TokenDecryptor:
+    return TokenDecryptor(secret_store.get_json("pave-agent-decryption-keys")["KEYS"])
 
 # Pave url necessities
-pave_str = secret_manager_client.access_secret_version(
-    name=f"projects/eql-data-processing/secrets/pave-prism-info/versions/latest"
-).payload.data.decode("UTF-8")
-
-pave_data = json.loads(pave_str)
-pave_base_url = pave_data["PAVE_HOST"]
-pave_x_api_key = pave_data["PAVE_X_API_KEY"]
-pave_headers = {
-    "Content-Type": "application/plaid+json",
-    "x-api-key": pave_x_api_key,
-}
+def pave_base_url() -> str:
+    # PAVE_HOST can point the syncs at a local fake pave server
+    return os.environ.get("PAVE_HOST") or secret_store.get_json("pave-prism-info")["PAVE_HOST"]
 
-def log_this(message:str, severity:str = "debug"):
-    logger.log(logging._nameToLevel[severity.upper()], message)
-    subprocess.run(["gcloud", "logging", "write", "stevenslav", message, f"--severity={severity.upper()}", "--quiet", "--verbosity=none", "--no-user-output-enabled"], stdout=subprocess.PIPE)
+def pave_headers() -> dict:
+    return {
+        "Content-Type": "application/plaid+json",
+        "x-api-key": secret_store.get_json("pave-prism-info")["PAVE_X_API_KEY"],
+    }
 
-def base64_decode(val: str) -> bytes:
-    return base64.urlsafe_b64decode(val.encode("ascii"))
+def log_this(message:str, severity:str = "debug"):
+    # Users synced concurrently have their lines written out in order when they finish
+    buffer = log_buffer.get()
+    if buffer is not None:
+        buffer.append((message, severity))
+        return
 
+    logger.log(logging._nameToLevel[severity.upper()], message)
+    log_shipper.ship(message, severity)
+
+# One pooled, keep-alive session shared by every Pave call in the process,
+# rate limited together with every other pave job on the host
+pave_client = PaveClient(log=log_this, rate_limiter=RateLimiter())
+# Pave GETs repeated by the jobs on this host within a day are answered locally
+response_cache = ResponseCache(log=log_this)
+
+def pave_data_snapshot(user_id: str) -> Optional[dict]:
+    # What pave reports for the user over the window the syncs read, taken before and after an upload
+    params = {
+        "start_date": (datetime.datetime.now() - datetime.timedelta(days=365*2)).strftime("%Y-%m-%d"),
+        "end_date": datetime.datetime.now().strftime("%Y-%m-%d"),
+    }
+    res = pave_client.request("get", f"{pave_base_url()}/{user_id}/balances", headers=pave_headers(), params=params)
+    if res.status_code != 200:
+        return None
+    accounts = response_json(res).get("accounts_balances") or []
 
-def decrypt(val: str) -> str:
-    if not val:
+    res = pave_client.request("get", f"{pave_base_url()}/{user_id}/transactions", headers=pave_headers(), params=params)
+    if res.status_code != 200:
         return None
+    transactions = response_json(res).get("transactions") or []
+
+    return {
+        "accounts": len(accounts),
+        "balances": content_hash(accounts),
+        "transactions": len(transactions),
+        "newest_transaction": max((t["date"] for t in transactions if t.get("date")), default=None),
+    }
+
+def pave_has_new_data(user_id: str, before: Optional[dict]) -> bool:
+    # Balances land before the transactions are ingested, so the transactions the syncs
+    # read decide. A user pave didn't know needs accounts and transactions, a known one
+    # counts once its transactions differ from the snapshot.
+    after = pave_data_snapshot(user_id)
+    if after is None or after["accounts"] == 0:
+        return False
+    if before is None:
+        return after["transactions"] > 0
+    return (after["transactions"], after["newest_transaction"]) != (before["transactions"], before["newest_transaction"])
+
+def user_links_have_accounts(user_id: str) -> bool:
+    with cm.postgres_pool.connect() as connection:
+        counts = connection.execute(sqlalchemy.text(USER_LINK_ACCOUNT_COUNTS), {"user_id": user_id}).fetchone()
+    # Links without a raw set yet might still bring accounts
+    return counts.accounts > 0 or counts.links_with_raw_sets < counts.links
+
+# Uploads through the pave-agent and waits until pave actually has the data
+upload_coordinator = UploadCoordinator(
+    pave_client.session,
+    pave_data_snapshot,
+    pave_has_new_data,
+    on_upload=response_cache.invalidate_user,
+    expects_data=user_links_have_accounts,
+    log=log_this,
+)
 
-    fernet = MultiFernet(Fernet(k) for k in keys)
-    actual = fernet.decrypt(base64_decode(val))
-    return actual.decode()
+def decrypt(val: str) -> str:
+    return token_decryptor().decrypt(val)
 
 
 def handle_pave_request(
@@ -66,50 +130,62 @@ def handle_pave_request(
     payload: dict,
     headers: dict,
     params: dict,
-    last_wait: float = 0,
 ) -> requests.Response:
-
-    #log_this(f"Making pave request to {endpoint}", "info")
     request_timer = datetime.datetime.now()
 
     if method == "get":
-        res = requests.get(f"{endpoint}", json=payload, headers=headers, params=params)
-    elif method == "post":
-        res = requests.post(f"{endpoint}", json=payload, headers=headers, params=params)
+        res = response_cache.get(user_id, endpoint, params)
+        if res is not None:
+            log_this(f"GET {endpoint} served from the response cache", "info")
+            return res
+
+    res = pave_client.request(method, endpoint, payload=payload, headers=headers, params=params)
+
+    if method == "get":
+        response_cache.put(user_id, endpoint, params, res)
     else:
-        raise ValueError("Method not understood {}".format(method))
+        # Anything cached for the user predates what was just sent
+        response_cache.invalidate_user(user_id)
 
     res_code = res.status_code
-    res_json_string = json.dumps(res.json())
-
-    if res_code == 429:
-        sleep = 1 if last_wait == 0 else last_wait * 2
-        log_this(f"Request limit reached, waiting {sleep} second(s)", "error")
-        time.sleep(sleep)
-        return handle_pave_request(
-            user_id, method, endpoint, payload, headers, params, sleep
-        )
-    else:
-        request_timer_end = datetime.datetime.now()
-        log_this(f"{method.upper()} {endpoint} took: {request_timer_end-request_timer}", "info")
-        log_this(f"        Response: {res_code} -> {res_json_string[:100]}{f'... {res_json_string[-100:]}' if len(res_json_string) > 100 else ''}\n", "info")
+    res_text = res.text
 
-        return res
+    request_timer_end = datetime.datetime.now()
+    log_this(f"{method.upper()} {endpoint} took: {request_timer_end-request_timer}", "info")
+    log_this(f"        Response: {res_code} -> {res_text[:100]}{f'... {res_text[-100:]}' if len(res_text) > 100 else ''}\n", "info")
+
+    return res
 
 def insert_response_into_db(
-    user_id: str, res, mongo_db, collection_name: str, response_column_name: str
+    user_id: str, res, mongo_db, collection_name: str, response_column_name: str, sink: MongoBulkSink = None,
+    hashes: SectionHashes = None,
 ):
     log_this("Inserting response into: {}.{}".format(collection_name, response_column_name), "info")
     mongo_timer = datetime.datetime.now()
     mongo_collection = mongo_db[collection_name]
     res_code = res.status_code
 
-    if res_code == 200:
+    if res_code == 200 and sink is not None:
+        document = {
+            response_column_name: response_json(res),
+            "user_id": user_id,
+            "response_code": res.status_code,
+            "date": datetime.datetime.now(),
+        }
+        if hashes is not None:
+            document["content_hash"] = hashes.changed(collection_name, user_id, document[response_column_name])
+
+        if hashes is not None and document["content_hash"] is None:
+            log_this(f"        {response_column_name} of user {user_id} unchanged, skipping the write")
+        else:
+            # Written with the next bulk_write of the collection, failures are reported by the sink
+            sink.replace_one(collection_name, {"user_id": user_id}, document, context=f"{response_column_name} of user {user_id}", user_id=user_id)
+    elif res_code == 200:
         try:
             res = mongo_collection.replace_one(
                 {"user_id": user_id},
                 {
-                    response_column_name: res.json(),
+                    response_column_name: response_json(res),
                     "user_id": user_id,
                     "response_code": res.status_code,
                     "date": datetime.datetime.now(),
@@ -124,7 +200,7 @@ def insert_response_into_db(
             log_this(f"COULD NOT INSERT response into {response_column_name} FOR USER {user_id}", "error")
             log_this(f"{e}", "error")
     else:
-        log_this("\tCan't insert to {}: {} {}\n".format(collection_name, res_code, res.json()), "warning")
+        log_this("\tCan't insert to {}: {} {}\n".format(collection_name, res_code, response_json(res)), "warning")
 
     mongo_timer_end = datetime.datetime.now()
     log_this(f"DB insertion to {collection_name} took: {mongo_timer_end-mongo_timer}\n", "warning")
@@ -140,25 +216,31 @@ def new_link_sync():
     # Open connection to postgres db
     conn = cm.get_postgres_connection()
 
+    # Every link created since the last run, plus the links that failed on an earlier one
+    checkpoint = SyncCheckpoint(cm.get_pymongo_table(pave_table), "new_link_sync", datetime.timedelta(minutes=35))
     rows = conn.execute(
-        "SELECT DISTINCT access_token, user_id FROM public.plaid_links WHERE created_at >= (NOW() - INTERVAL '35 minutes')"
+        sqlalchemy.text(
+            "SELECT DISTINCT id, access_token, user_id, created_at AS changed_at FROM public.plaid_links "
+            "WHERE created_at > :watermark OR id IN :retry_link_ids"
+        ).bindparams(sqlalchemy.bindparam("retry_link_ids", expanding=True)),
+        {"watermark": checkpoint.load(), "retry_link_ids": checkpoint.retry_keys()},
     ).fetchall()
 
-    for row in tqdm(rows):
-        row = row._asdict()
-        access_token, user_id = decrypt(row["access_token"]), str(row["user_id"])
+    rows = [row._asdict() for row in rows]
+    access_tokens = token_decryptor().decrypt_many([row["access_token"] for row in rows])
+
+    # The next links upload and wait on pave while the current one is being stored,
+    # uploads come back in the same order as rows
+    links = ((str(row["user_id"]), [access_token]) for row, access_token in zip(rows, access_tokens))
+    uploads = upload_coordinator.iter_uploaded(links)
+    for row, (user_id, upload) in tqdm(zip(rows, uploads), total=len(rows)):
         time_in_days = 365 * 2
 
         log_this(f"{user_id=}")
-        pave_agent_start = datetime.datetime.now()
-        res = requests.post(
-            f"http://127.0.0.1:8123/v1/users/{user_id}/upload?num_transaction_days={time_in_days}",
-            json={"access_token": f"{access_token}"},
-        )
-        # Give pave agent some time to process transactions
-        time.sleep(2)
-        pave_agent_end = datetime.datetime.now()
-        log_this(f"  Pave Agent res code: {res.status_code}, took {pave_agent_end-pave_agent_start}", "debug")
+        log_this(f"  Pave Agent res codes: {upload.status_codes}, ready: {upload.ready} after {upload.waited:.1f}s", "debug")
+        # Whether everything for the link made it into mongo, for the checkpoint. An upload
+        # pave took but wasn't seen ingesting in time still stores what pave has.
+        synced = upload.uploaded
 
         # Date ranges for pave
         start_date_str = (
@@ -173,33 +255,28 @@ def new_link_sync():
         response = handle_pave_request(
             user_id=user_id,
             method="get",
-            endpoint=f"{pave_base_url}/{user_id}/transactions",
+            endpoint=f"{pave_base_url()}/{user_id}/transactions",
             payload=None,
-            headers=pave_headers,
+            headers=pave_headers(),
             params=params,
         )
 
         if response.status_code != 200:
             log_this("        Non 200 return code on transactions", "exception")
+            synced = False
         else:
             mongo_timer = datetime.datetime.now()
-            mongo_collection = mongo_db["transactions"]
-            transactions = response.json()["transactions"]
+            transactions = response_json(response)["transactions"]
 
             if len(transactions) > 0:
                 log_this(f"   Inserting {json.dumps(transactions)[:200]}... into transactions", "info")
 
                 try:
-                    mongo_collection.update_one(
-                        {"user_id": str(user_id)},
-                        {
-                            "$addToSet": {"transactions.transactions": {"$each": transactions}},
-                            "$set": {"transactions.to": end_date_str, "date": datetime.datetime.now()}
-                        }
-                    )
+                    PaveStore(mongo_db).write_transactions(user_id, transactions)
                 except Exception as e:
                     log_this(f"        COULD NOT UPDATE TRANSACTIONS FOR USER {user_id} ON LINK SYNC", "error")
                     log_this(f"        {e}", "error")
+                    synced = False
 
                 mongo_timer_end = datetime.datetime.now()
                 log_this(f"      Transaction insertion took: {mongo_timer_end-mongo_timer}", "info")
@@ -215,424 +292,526 @@ def new_link_sync():
         response = handle_pave_request(
             user_id=user_id,
             method="get",
-            endpoint=f"{pave_base_url}/{user_id}/balances",
+            endpoint=f"{pave_base_url()}/{user_id}/balances",
             payload=None,
-            headers=pave_headers,
+            headers=pave_headers(),
             params=params,
         )
 
         if response.status_code != 200:
             log_this("    Non 200 return code on balances", "exception")
+            synced = False
         else:
             mongo_timer = datetime.datetime.now()
-            mongo_collection = mongo_db["balances"]
-            balances = response.json()["accounts_balances"]
+            balances = response_json(response)["accounts_balances"]
 
 
             if len(balances) > 0:
                 log_this(f"    Inserting {json.dumps(balances)[:200]} into balances", "info")
 
                 try:
-                    mongo_collection.update_one(
-                        {"user_id": str(user_id)},
-                        {"$set": {"balances.accounts_balances": balances}}
-                    )
-
-                    mongo_collection.update_one(
-                        {"user_id": str(user_id)},
-                        {"$set": {"balances.to": end_date_str, "date": datetime.datetime.now()}},
-                        bypass_document_validation = True
-                    )
+                    PaveStore(mongo_db).write_balances(user_id, balances)
                 except Exception as e:
                     log_this(f"    COULD NOT UPDATE BALANCES FOR USER {user_id} ON LINK SYNC", "error")
                     log_this(f"    {e}", "error")
+                    synced = False
 
                 mongo_timer_end = datetime.datetime.now()
                 log_this(f"    Balance insertion took: {mongo_timer_end-mongo_timer}", "info")
             #####################################################################
 
+        checkpoint.observe(row["changed_at"], synced, key=row["id"])
+
+    checkpoint.commit()
+
 ##################################################################################################################################################################################################
 
+'''
+    Uploads a new user's links through the pave agent and stores everything pave has for them
+'''
+def user_access_tokens(user_id: str, conn) -> List[str]:
+    rows = conn.execute(
+        f"SELECT DISTINCT access_token FROM public.plaid_links WHERE user_id = '{user_id}'"
+    ).fetchall()
+
+    return token_decryptor().decrypt_many([str(row[0]) for row in rows])
+
+
+'''
+    Stores everything pave has for a new user once their links are uploaded. Without an
+    upload from the coordinator already in hand the links are uploaded here first.
+'''
+def sync_new_user(user_id: str, conn, mongo_db, sink: MongoBulkSink, upload: UploadResult = None) -> bool:
+    loop_start = datetime.datetime.now()
+    time_in_days = 365 * 2
+    store = PaveStore(mongo_db, sink)
+
+    if upload is None:
+        # Returns once pave has the uploaded data, or the coordinator's deadline passes
+        upload = upload_coordinator.upload(user_id, user_access_tokens(user_id, conn))
+    log_this(f"\tPave agent upload: {upload}", "debug")
+
+    # Date ranges for pave
+    start_date_str = (
+        datetime.datetime.now() - datetime.timedelta(days=time_in_days)
+    ).strftime("%Y-%m-%d")
+    end_date_str: str = datetime.datetime.now().strftime("%Y-%m-%d")
+    params = {"start_date": start_date_str, "end_date": end_date_str}
+
+    # Store the transaction data from pave
+    response = handle_pave_request(
+        user_id=user_id,
+        method="get",
+        endpoint=f"{pave_base_url()}/{user_id}/transactions",
+        payload=None,
+        headers=pave_headers(),
+        params=params,
+    )
+    if response.status_code == 200:
+        transactions = response_json(response)["transactions"]
+        store.write_transactions(user_id, transactions)
+        if len(transactions) > 0:
+            transaction_date_str = transactions[len(transactions)-1]["date"]
+            params["start_date"] = transaction_date_str
+    else:
+        log_this("\tCan't insert transactions: {} {}\n".format(response.status_code, response.text[:500]), "warning")
+    #####################################################################
+
+    response = handle_pave_request(
+        user_id=user_id,
+        method="get",
+        endpoint=f"{pave_base_url()}/{user_id}/balances",
+        payload=None,
+        headers=pave_headers(),
+        params=params,
+    )
+    if response.status_code == 200:
+        store.write_balances(user_id, response_json(response)["accounts_balances"])
+    else:
+        log_this("\tCan't insert balances: {} {}\n".format(response.status_code, response.text[:500]), "warning")
+    # Users whose balances couldn't be stored are picked up again next run
+    balances_stored = response.status_code == 200
+    #####################################################################
+
+    # Store the unified insights data from pave
+    params = {
+        "start_date": start_date_str,
+        "end_date": end_date_str,
+        "with_transactions": True,
+    }
+    response = handle_pave_request(
+        user_id=user_id,
+        method="get",
+        endpoint=f"{pave_base_url()}/{user_id}/unified_insights",
+        payload=None,
+        headers=pave_headers(),
+        params=params,
+    )
+
+    if response.status_code == 200:
+        ui_start = datetime.datetime.now()
+        for title, obj in response_json(response).items():
+            log_this("\tInserting response into: {}".format(title), "info")
+            sink.replace_one(
+                title,
+                {"user_id": user_id},
+                {
+                    title: obj,
+                    "user_id": user_id,
+                    "response_code": response.status_code,
+                    "date": datetime.datetime.now(),
+                },
+                context=f"{title} of user {user_id} on new user sync",
+                user_id=user_id,
+            )
+        ui_end = datetime.datetime.now()
+        log_this(f" Unified insights entry took {ui_end-ui_start}")
+
+    else:
+        log_this("\tCan't insert: {} {}\n".format(response.status_code, response_json(response)), "warning")
+    #####################################################################
+
+    # Store the attribute data from pave
+    # params = {"date": end_date_str}
+    # response = handle_pave_request(
+    #     user_id=user_id,
+    #     method="get",
+    #     endpoint=f"{pave_base_url()}/{user_id}/attributes",
+    #     payload=None,
+    #     headers=pave_headers(),
+    #     params=params,
+    # )
+    # insert_response_into_db(
+    #     user_id=user_id,
+    #     res=response,
+    #     mongo_db=mongo_db,
+    #     collection_name="attributes",
+    #     response_column_name="attributes",
+    # )
+    #####################################################################
+
+    finish = datetime.datetime.now()
+
+    log_this(f"    > Loop time took {finish-loop_start}")
+    return balances_stored
+
+
 '''
     Ran every 30 minutes
 '''
-def new_user_sync():
+def new_user_sync(concurrency: int = 1):
     log_this("Runinng new user sync:\n", "info")
-    cm = Connection_Manager()
+    cm = Connection_Manager(pool_size=max(5, concurrency + 1))
 
     # Open connection to postgres db and mongodb
     conn = cm.get_postgres_connection()
     mongo_db = cm.get_pymongo_table(pave_table)
 
+    # Every user created since the last run, plus the users that failed on an earlier one
+    checkpoint = SyncCheckpoint(mongo_db, "new_user_sync", datetime.timedelta(minutes=35))
     rows = conn.execute(
-        "SELECT DISTINCT id FROM public.users WHERE created_at >= (NOW() - INTERVAL '35 minutes')"
+        sqlalchemy.text(
+            "SELECT id, created_at FROM public.users WHERE created_at > :watermark OR id IN :retry_user_ids "
+            "ORDER BY created_at"
+        ).bindparams(sqlalchemy.bindparam("retry_user_ids", expanding=True)),
+        {"watermark": checkpoint.load(), "retry_user_ids": checkpoint.retry_keys()},
     ).fetchall()
+    created_at = {str(row[0]): row[1] for row in rows}
 
     # Ensure that we only get user_ids that we haven't processed before
     # because this is an expensive sync
-    pave_user_ids = [x["user_id"] for x in list(mongo_db["balances"].find({}))]
-    user_ids = [str(row[0]) for row in rows if str(row[0]) not in pave_user_ids]
+    processed_users = ProcessedUserRegistry(mongo_db)
+    processed_users.backfill_from(mongo_db["balances"])
+    user_ids = processed_users.not_synced(created_at)
 
     start = datetime.datetime.now()
-    # Get all user access tokens and upload transaction/balance them using the pave agent
-    for user_id in tqdm(user_ids):
-        loop_start = datetime.datetime.now()
-        rows = conn.execute(
-            f"SELECT DISTINCT access_token FROM public.plaid_links WHERE user_id = '{user_id}'"
-        ).fetchall()
-
-        access_tokens = [decrypt(str(row[0])) for row in rows]
-        time_in_days = 365 * 2
+    sink = MongoBulkSink(mongo_db, log=log_this)
+    synced_user_ids = []
+    # Users an overlapping run claimed first, that run syncs them
+    claimed_elsewhere = set()
+
+    def claim(user_id: str) -> bool:
+        if processed_users.claim(user_id):
+            return True
+        log_this(f"\tUser {user_id} is being synced by another run, skipping", "info")
+        claimed_elsewhere.add(user_id)
+        return False
 
-        for access_token in access_tokens:
-            res = requests.post(
-                f"http://127.0.0.1:8123/v1/users/{user_id}/upload?num_transaction_days={time_in_days}",
-                json={"access_token": f"{access_token}"},
+    try:
+        # Get all user access tokens and upload transaction/balance them using the pave agent
+        if concurrency > 1:
+            def sync_user(user_id: str):
+                if not claim(user_id):
+                    return False
+
+                # Each task checks out its own connection from the pool
+                user_conn = cm.get_postgres_connection()
+                try:
+                    return sync_new_user(user_id, user_conn, mongo_db, sink)
+                finally:
+                    cm.close_postgres_connection(user_conn)
+
+            # If this has taken 4 hours it probably got stuck somewhere
+            outcomes = run_concurrently(
+                sync_user, user_ids, concurrency, log_this,
+                should_continue=lambda: datetime.datetime.now() - start <= datetime.timedelta(hours=4),
             )
-            res = res.json()
-            #log_this(f"\tGot response from pave-agent: {res}", "debug")
+            synced_user_ids = [outcome.user_id for outcome in outcomes if outcome.result]
+            return not any(outcome.skipped for outcome in outcomes)
 
-            # Give pave agent some time to process transactions
-            time.sleep(2)
+        # The next users upload and wait on pave while the current one is being stored
+        uploads = upload_coordinator.iter_uploaded(
+            (user_id, user_access_tokens(user_id, conn)) for user_id in user_ids if claim(user_id)
+        )
+        for user_id, upload in tqdm(uploads, total=len(user_ids)):
+            if sync_new_user(user_id, conn, mongo_db, sink, upload):
+                synced_user_ids.append(user_id)
+
+            # If this has taken 4 hours it probably got stuck somewhere
+            if datetime.datetime.now() - start > datetime.timedelta(hours=4):
+                return False
+
+        return True
+    finally:
+        # Users are only marked once their responses have actually been written, the
+        # rest are retried on the next run
+        sink.close()
+        # Only the users whose own writes failed, at any flush, are synced again
+        written_user_ids = sink.written_users(synced_user_ids)
+        if len(written_user_ids) < len(synced_user_ids):
+            log_this(f"Responses of {len(synced_user_ids) - len(written_user_ids)} new user(s) could not be written, they will be synced again", "error")
+        synced_user_ids = written_user_ids
+        processed_users.mark_synced(synced_user_ids, "new_user_sync")
+        processed_users.release_claims()
+
+        synced = set(synced_user_ids) | claimed_elsewhere | (created_at.keys() - set(user_ids))
+        for user_id, user_created_at in created_at.items():
+            checkpoint.observe(user_created_at, user_id in synced, key=user_id)
+        checkpoint.commit()
 
-        # Date ranges for pave
-        start_date_str = (
-            datetime.datetime.now() - datetime.timedelta(days=time_in_days)
-        ).strftime("%Y-%m-%d")
-        end_date_str: str = datetime.datetime.now().strftime("%Y-%m-%d")
-        params = {"start_date": start_date_str, "end_date": end_date_str}
 
-        # Store the transaction data from pave
-        response = handle_pave_request(
-            user_id=user_id,
-            method="get",
-            endpoint=f"{pave_base_url}/{user_id}/transactions",
-            payload=None,
-            headers=pave_headers,
-            params=params,
-        )
-        insert_response_into_db(
-            user_id=user_id,
-            res=response,
-            mongo_db=mongo_db,
-            collection_name="transactions",
-            response_column_name="transactions",
-        )
-        if response.status_code == 200:
-            transactions = response.json()["transactions"]
-            if len(transactions) > 0:
-                transaction_date_str = transactions[len(transactions)-1]["date"]
-                params["start_date"] = transaction_date_str
-        #####################################################################
+##################################################################################################################################################################################################
 
-        response = handle_pave_request(
-            user_id=user_id,
-            method="get",
-            endpoint=f"{pave_base_url}/{user_id}/balances",
-            payload=None,
-            headers=pave_headers,
-            params=params,
-        )
-        insert_response_into_db(
-            user_id=user_id,
-            res=response,
-            mongo_db=mongo_db,
-            collection_name="balances",
-            response_column_name="balances",
-        )
-        #####################################################################
+'''
+    Uploads every new transaction for a user to pave, in as few POSTs as pave allows,
+    then stores pave's view of the last day with a single mongo update
+'''
+def sync_user_transactions(user_id: str, new_transactions: list, mongo_db) -> bool:
+    # Date ranges for pave
+    start_date_str = (
+        datetime.datetime.now() - datetime.timedelta(days=1)
+    ).strftime("%Y-%m-%d")
+    end_date_str: str = datetime.datetime.now().strftime("%Y-%m-%d")
+    params = {"start_date": start_date_str, "end_date": end_date_str, "resolve_duplicates": True}
 
-        # Store the unified insights data from pave
-        params = {
-            "start_date": start_date_str,
-            "end_date": end_date_str,
-            "with_transactions": True,
-        }
+    for chunk in chunked(new_transactions, MAX_TRANSACTIONS_PER_POST):
         response = handle_pave_request(
             user_id=user_id,
-            method="get",
-            endpoint=f"{pave_base_url}/{user_id}/unified_insights",
-            payload=None,
-            headers=pave_headers,
+            method="post",
+            endpoint=f"{pave_base_url()}/{user_id}/transactions",
+            payload={"transactions": chunk},
+            headers=pave_headers(),
             params=params,
         )
 
-        if response.status_code == 200:
-            ui_start = datetime.datetime.now()
-            for title, obj in response.json().items():
-                log_this("\tInserting response into: {}".format(title), "info")
-                mongo_collection = mongo_db[title]
-
-                try:
-                    mongo_collection.replace_one(
-                        {"user_id": user_id},
-                        {
-                            title: obj,
-                            "user_id": user_id,
-                            "response_code": response.status_code,
-                            "date": datetime.datetime.now(),
-                        },
-                        upsert=True,
-                    )
-                except Exception as e:
-                    log_this(f"COULD NOT INSERT {title} FOR USER {user_id} ON NEW USER SYNC", "error")
-                    log_this(f"{e}", "error")
-            ui_end = datetime.datetime.now()
-            log_this(f" Unified insights entry took {ui_end-ui_start}")
+        if response.status_code != 200:
+            log_this(f"Could not upload {len(chunk)} transaction(s) for user {user_id} to pave", "error")
+            return False
+    #####################################################################
+
+    # Store the transaction data from pave
+    response = handle_pave_request(
+        user_id=user_id,
+        method="get",
+        endpoint=f"{pave_base_url()}/{user_id}/transactions",
+        payload=None,
+        headers=pave_headers(),
+        params=params,
+    )
+
+    if response.status_code != 200:
+        log_this("Could not upload transactions to mongodb", "error")
+        return False
 
-        else:
-            log_this("\tCan't insert: {} {}\n".format(response.status_code, response.json()), "warning")
-        #####################################################################
+    mongo_timer = datetime.datetime.now()
+    transactions = response_json(response)["transactions"]
 
-        # Store the attribute data from pave
-        # params = {"date": end_date_str}
-        # response = handle_pave_request(
-        #     user_id=user_id,
-        #     method="get",
-        #     endpoint=f"{pave_base_url}/{user_id}/attributes",
-        #     payload=None,
-        #     headers=pave_headers,
-        #     params=params,
-        # )
-        # insert_response_into_db(
-        #     user_id=user_id,
-        #     res=response,
-        #     mongo_db=mongo_db,
-        #     collection_name="attributes",
-        #     response_column_name="attributes",
-        # )
-        #####################################################################
+    if len(transactions) > 0:
+        log_this(f"\tInserting {json.dumps(transactions)[:100]} into transactions", "info")
 
-        with open('seen_user_ids.txt', 'a') as file:
-            file.write(f"{user_id}\n")
-        finish = datetime.datetime.now()
+        PaveStore(mongo_db).write_transactions(user_id, transactions)
 
-        log_this(f"    > Loop time took {finish-loop_start}")
-        # If this has taken 4 hours it probably got stuck somewhere
-        if finish - start > datetime.timedelta(hours=4):
-            return False
+        mongo_timer_end = datetime.datetime.now()
+        log_this(f"\tDB insertion took: {mongo_timer_end-mongo_timer}", "info")
+    else:
+        log_this("\tGot to hourly db insertion but no transactions were found for the date range", "warning")
 
     return True
 
 
-##################################################################################################################################################################################################
-
 '''
     Hourly sync to update transactions created in the last hour
 '''
 def hourly_sync():
     log_this("Runinng Hourly Sync:\n", "info")
 
-    rows = conn.execute(
-        "SELECT * FROM public.plaid_transactions WHERE plaid_transactions.date >= (NOW() - INTERVAL '70 minutes')"
-    ).fetchall()
+    mongo_db = cm.get_pymongo_table(pave_table)
+    checkpoint = SyncCheckpoint(mongo_db, "hourly_sync", datetime.timedelta(minutes=70))
+    watermark = checkpoint.load()
+    # Users whose upload failed on an earlier run are sent again from their oldest failed transaction
+    retries = checkpoint.retries()
+    retry_since = min((as_utc(retry["since"]) for retry in retries), default=watermark)
+
+    # Every transaction stored since the last run plus the retried users',
+    # with its user resolved in the same statement and streamed in user order
+    rows = backend_connection().execution_options(stream_results=True).execute(
+        sqlalchemy.text(
+            "SELECT plaid_transactions.*, plaid_links.user_id AS link_user_id FROM public.plaid_transactions "
+            "JOIN public.plaid_links ON plaid_links.id = plaid_transactions.link_id "
+            "WHERE plaid_transactions.created_at > :watermark "
+            "OR (plaid_links.user_id IN :retry_user_ids AND plaid_transactions.created_at >= :retry_since) "
+            "ORDER BY plaid_links.user_id"
+        ).bindparams(sqlalchemy.bindparam("retry_user_ids", expanding=True)),
+        {"watermark": watermark, "retry_user_ids": [retry["key"] for retry in retries], "retry_since": retry_since},
+    )
+
+    # Each user costs one upload, one download and one mongo update
+    for user_id, user_rows in tqdm(groupby(rows, key=lambda row: str(row.link_user_id))):
+        user_rows = list(user_rows)
+        new_transactions = [pave_transaction_from_row(row._asdict()) for row in user_rows]
+        try:
+            synced = sync_user_transactions(user_id, new_transactions, mongo_db)
+        except Exception as e:
+            log_this(f"Could not sync transactions for user {user_id}: {e}", "error")
+            synced = False
 
-    for row in tqdm(rows):
-        row:dict = row._asdict()
-        transaction = {
-            "transaction_id": str(row["plaid_transaction_id"]),
-            "account_id": str(row["plaid_account_id"]),
-            "amount": float(row["amount"]),
-            "date": str(row["authorized_date"]),
-            "memo": " ".join(
-                row["personal_finance_category"].values()
-            )
-            if row["personal_finance_category"]
-            else "",
-            "name": row["name"] if row["name"] else " ",
-            "pending": row["pending"],
-            "category": row["category"],
-            "category_id": row["category_id"],
-            "iso_currency_code": row["iso_currency_code"],
-            "merchant_name": row["merchant_name"],
-            "payment_channel": row["payment_channel"],
-            "transaction_type": row["transaction_type"],
-            "payment_meta": row["payment_meta"],
-            "location": row["location"]
-        }
+        for row in user_rows:
+            checkpoint.observe(row.created_at, synced, key=user_id)
+
+    checkpoint.commit()
+
+##################################################################################################################################################################################################
 
-        user_id = conn.execute(f"SELECT user_id FROM public.plaid_links WHERE id = \'{str(row['link_id'])}\'").fetchone()[0]
+'''
+    Posts a user's newest balances from the backend to pave and stores pave's balances
+'''
+def sync_user_balances(user_id: str, link_id, accounts: list):
+    if link_id is None:
+        log_this(f"\tNo plaid links for user {user_id}", "warning")
+        return
+
+    response = handle_pave_request(
+        user_id=user_id,
+        method="post",
+        endpoint=f"{pave_base_url()}/{user_id}/balances",
+        payload={"run_timestamp": str(datetime.datetime.now()), "accounts": accounts},
+        headers=pave_headers(),
+        params=None,
+    )
+    #####################################################################
+
+    if response.status_code == 200:
+        mongo_db = cm.get_pymongo_table(pave_table)
 
         # Date ranges for pave
         start_date_str = (
             datetime.datetime.now() - datetime.timedelta(days=1)
         ).strftime("%Y-%m-%d")
         end_date_str: str = datetime.datetime.now().strftime("%Y-%m-%d")
-        params = {"start_date": start_date_str, "end_date": end_date_str, "resolve_duplicates": True}
+        params = {"start_date": start_date_str, "end_date": end_date_str}
 
+        # Store the transaction data from pave
         response = handle_pave_request(
             user_id=user_id,
-            method="post",
-            endpoint=f"{pave_base_url}/{user_id}/transactions",
-            payload={"transactions": [transaction]},
-            headers=pave_headers,
+            method="get",
+            endpoint=f"{pave_base_url()}/{user_id}/balances",
+            payload=None,
+            headers=pave_headers(),
             params=params,
         )
 
-        #####################################################################
-
-        if response.status_code == 200:
-            mongo_db = cm.get_pymongo_table(pave_table)
+        mongo_timer = datetime.datetime.now()
+        try:
+            balances = response_json(response)["accounts_balances"]
 
-            # Store the transaction data from pave
-            response = handle_pave_request(
-                user_id=user_id,
-                method="get",
-                endpoint=f"{pave_base_url}/{user_id}/transactions",
-                payload=None,
-                headers=pave_headers,
-                params=params,
-            )
+            if len(balances) > 0:
 
-            mongo_timer = datetime.datetime.now()
-            mongo_collection = mongo_db["transactions"]
-            transactions = response.json()["transactions"]
+                try:
+                    for balance in balances:
+                        log_this(f"\tInserting {json.dumps(balance['balances'])[:100]} into balances", "info")
+                    PaveStore(mongo_db).write_balances(user_id, balances)
+                except Exception as e:
+                    log_this(f"COULD NOT UPDATE BALANCE FOR USER {user_id} ON DAILY SYNC", "error")
+                    log_this(f"{e}", "error")
 
-            if len(transactions) > 0:
-                log_this(f"\tInserting {json.dumps(transactions)[:100]} into transactions", "info")
+            else:
+                log_this("\tGot to daily db insertion but no transactions were found for the date range", "warning")
+        except Exception as e:
+            log_this("\tCould not find user after uploading balances", "error")
+            log_this(f"{e}", "error")
 
-                mongo_collection.update_one(
-                    {"user_id": str(user_id)},
-                    {
-                        "$addToSet": {"transactions.transactions": {"$each": transactions}},
-                        "$set": {"transactions.to": end_date_str, "date": datetime.datetime.now()}
-                    }
-                )
+        mongo_timer_end = datetime.datetime.now()
+        log_this(f"\tDB insertion took: {mongo_timer_end-mongo_timer}", "info")
 
-                mongo_timer_end = datetime.datetime.now()
-                log_this(f"\tDB insertion took: {mongo_timer_end-mongo_timer}", "info")
-            else:
-                log_this("\tGot to hourly db insertion but no transactions were found for the date range", "warning")
-        else:
-            log_this("Could not upload transactions to mongodb", "error")
-        #####################################################################
+    else:
+        log_this("\tCould not upload balances to mongodb", "error")
+    #####################################################################
 
-##################################################################################################################################################################################################
 
 '''
     Daily sync to update user balances for all users in the db for yesterday
 '''
-def daily_sync():
+def daily_sync(concurrency: int = 1):
     log_this("Runinng Daily Balance Sync:\n", "error")
 
-    rows = conn.execute(
-        "SELECT DISTINCT id FROM public.users"
-    ).fetchall()
-
-    user_ids = [str(row[0]) for row in rows]
-
-    # Get all user access tokens and upload transaction/balance them using the pave agent
-    for user_id in tqdm(user_ids):
-        rows = conn.execute(
-            f"SELECT DISTINCT id FROM public.plaid_links WHERE user_id = '{user_id}'"
-        ).fetchall()
-        plaid_link_ids = [str(row[0]) for row in rows]
-
-        if len(plaid_link_ids) == 0:
-            log_this(f"\tNo plaid links for user {user_id}", "warning")
-            continue
-
-        rows = conn.execute(
-            f"SELECT data FROM public.plaid_raw_transaction_sets WHERE link_id IN {str(tuple(plaid_link_ids)).replace(',)', ')')} ORDER BY end_date DESC LIMIT 1"
-        ).fetchall()
-
-        accounts = []
-        for row in rows:
-            row = row._asdict()['data']
-            for item in row:
-                _accounts = item["accounts"]
-                for account in _accounts:
-
-                    if account["account_id"] not in [x["account_id"] for x in accounts]:
-                        accounts.append({
-                            "account_id": str(account["account_id"]),
-                            "balances": {
-                                "available": account["balances"]["available"],
-                                "current": account["balances"]["current"],
-                                "iso_currency_code": account["balances"]["iso_currency_code"],
-                                "limit": account["balances"]["limit"],
-                                "unofficial_currency_code": account["balances"]["unofficial_currency_code"]
-                            },
-                            "mask": account["mask"],
-                            "name": account["name"],
-                            "official_name": account["official_name"],
-                            "type": account["type"],
-                            "subtype": account["subtype"]
-                        })
+    # Every user's accounts from their newest raw transaction set, unpacked in postgres and streamed
+    rows = backend_connection().execution_options(stream_results=True).execute(LATEST_BALANCE_ACCOUNTS_PER_USER)
+    user_accounts = iter_latest_balance_accounts(rows)
 
-        response = handle_pave_request(
-            user_id=user_id,
-            method="post",
-            endpoint=f"{pave_base_url}/{user_id}/balances",
-            payload={"run_timestamp": str(datetime.datetime.now()), "accounts": accounts},
-            headers=pave_headers,
-            params=None,
+    if concurrency > 1:
+        run_concurrently(
+            lambda user: sync_user_balances(*user),
+            user_accounts, concurrency, log_this, key=lambda user: user[0],
         )
-        #####################################################################
+        return
 
-        if response.status_code == 200:
-            mongo_db = cm.get_pymongo_table(pave_table)
+    for user_id, link_id, accounts in tqdm(user_accounts):
+        sync_user_balances(user_id, link_id, accounts)
 
-            # Date ranges for pave
-            start_date_str = (
-                datetime.datetime.now() - datetime.timedelta(days=1)
-            ).strftime("%Y-%m-%d")
-            end_date_str: str = datetime.datetime.now().strftime("%Y-%m-%d")
-            params = {"start_date": start_date_str, "end_date": end_date_str}
 
-            # Store the transaction data from pave
-            response = handle_pave_request(
+##################################################################################################################################################################################################
+
+'''
+    Stores a user's unified insights and attributes from pave
+'''
+def sync_user_insights(user_id: str, mongo_db, sink: MongoBulkSink, hashes: SectionHashes, start_date_str: str, end_date_str: str):
+    # Store the unified insights data from pave
+    params = {
+        "start_date": start_date_str,
+        "end_date": end_date_str,
+        "with_transactions": True,
+    }
+    response = handle_pave_request(
+        user_id=user_id,
+        method="get",
+        endpoint=f"{pave_base_url()}/{user_id}/unified_insights",
+        payload=None,
+        headers=pave_headers(),
+        params=params,
+    )
+
+    if response.status_code == 200:
+        for title, object in response_json(response).items():
+            section_hash = hashes.changed(title, user_id, object)
+            if section_hash is None:
+                log_this("\t{} unchanged, skipping the write".format(title))
+                continue
+
+            log_this("\tInserting response into: {}".format(title), "info")
+            sink.replace_one(
+                title,
+                {"user_id": user_id},
+                {
+                    title: object,
+                    "user_id": user_id,
+                    "response_code": response.status_code,
+                    "date": datetime.datetime.now(),
+                    "content_hash": section_hash,
+                },
+                context=f"{title} of user {user_id} on weekly sync",
                 user_id=user_id,
-                method="get",
-                endpoint=f"{pave_base_url}/{user_id}/balances",
-                payload=None,
-                headers=pave_headers,
-                params=params,
             )
+    else:
+        log_this("\tCan't insert: {} {}\n".format(response.status_code, response_json(response)), "warning")
+    #####################################################################
+
+    # We may actually want this data for decisioning so we can take the slowdown
+    # Store the attribute data from pave
+    params = {"date": end_date_str}
+    response = handle_pave_request(
+        user_id=user_id,
+        method="get",
+        endpoint=f"{pave_base_url()}/{user_id}/attributes",
+        payload=None,
+        headers=pave_headers(),
+        params=params,
+    )
+    insert_response_into_db(
+        user_id=user_id,
+        res=response,
+        mongo_db=mongo_db,
+        collection_name="attributes",
+        response_column_name="attributes",
+        sink=sink,
+        hashes=hashes,
+    )
+    #####################################################################
 
-            mongo_timer = datetime.datetime.now()
-            try:
-                mongo_collection = mongo_db["balances"]
-                balances = response.json()["accounts_balances"]
-
-                if len(balances) > 0:
-
-                    try:
-                        for balance in balances:
-                            log_this(f"\tInserting {json.dumps(balance['balances'])[:100]} into balances", "info")
-                            mongo_collection.update_one(
-                                {"user_id": str(user_id), "balances.accounts_balances": {"$elemMatch": {"account_id": balance["account_id"]}}},
-                                {"$addToSet": {"balances.accounts_balances.$.balances": {"$each": balance["balances"]}}}
-                            )
-
-                        mongo_collection.update_one(
-                            {"user_id": str(user_id)},
-                            {"$set": {"balances.to": end_date_str, "date": datetime.datetime.now()}},
-                            bypass_document_validation = True
-                        )
-                    except Exception as e:
-                        log_this(f"COULD NOT UPDATE BALANCE FOR USER {user_id} ON DAILY SYNC", "error")
-                        log_this(f"{e}", "error")
-
-                else:
-                    log_this("\tGot to daily db insertion but no transactions were found for the date range", "warning")
-            except Exception as e:
-                log_this("\tCould not find user after uploading balances", "error")
-                log_this(f"{e}", "error")
-
-            mongo_timer_end = datetime.datetime.now()
-            log_this(f"\tDB insertion took: {mongo_timer_end-mongo_timer}", "info")
-
-        else:
-            log_this("\tCould not upload balances to mongodb", "error")
-        #####################################################################
-
-##################################################################################################################################################################################################
 
 '''
     Weekly/Daily 2 sync to update unified insight data
 '''
-def weekly_sync():
+def weekly_sync(concurrency: int = 1):
     log_this("Runinng weekly sync:\n", "info")
     cm = Connection_Manager()
 
@@ -653,73 +832,33 @@ def weekly_sync():
     params = {"start_date": start_date_str, "end_date": end_date_str}
 
     # Get all users unified insight data
-    for user_id in tqdm(user_ids):
-        # Get all transactions and upload them to mongodb
-        mongo_db = cm.get_pymongo_table(pave_table)
-
-        # Store the unified insights data from pave
-        params = {
-            "start_date": start_date_str,
-            "end_date": end_date_str,
-            "with_transactions": True,
-        }
-        response = handle_pave_request(
-            user_id=user_id,
-            method="get",
-            endpoint=f"{pave_base_url}/{user_id}/unified_insights",
-            payload=None,
-            headers=pave_headers,
-            params=params,
-        )
+    mongo_db = cm.get_pymongo_table(pave_table)
+    sink = MongoBulkSink(mongo_db, log=log_this)
+    # Sections whose content hash matches the stored one aren't written again
+    hashes = SectionHashes(mongo_db, log=log_this)
+    try:
+        if concurrency > 1:
+            run_concurrently(
+                lambda user_id: sync_user_insights(user_id, mongo_db, sink, hashes, start_date_str, end_date_str),
+                user_ids, concurrency, log_this,
+            )
+            return
 
-        if response.status_code == 200:
-            for title, object in response.json().items():
-                log_this("\tInserting response into: {}".format(title), "info")
-                mongo_collection = mongo_db[title]
+        for user_id in tqdm(user_ids):
+            sync_user_insights(user_id, mongo_db, sink, hashes, start_date_str, end_date_str)
+    finally:
+        sink.close()
+        log_this(f"Unchanged sections skipped: {hashes.stats()}", "info")
 
-                try:
-                    mongo_collection.replace_one(
-                        {"user_id": user_id},
-                        {
-                            title: object,
-                            "user_id": user_id,
-                            "response_code": response.status_code,
-                            "date": datetime.datetime.now(),
-                        },
-                        upsert=True,
-                    )
-                except Exception as e:
-                    log_this(f"COULD NOT UPDATE {title} FOR USER {user_id} ON DAILY SYNC", "error")
-                    log_this(f"{e}", "error")
-        else:
-            log_this("\tCan't insert: {} {}\n".format(response.status_code, response.json()), "warning")
-        #####################################################################
-
-        # We may actually want this data for decisioning so we can take the slowdown
-        # Store the attribute data from pave
-        params = {"date": end_date_str}
-        response = handle_pave_request(
-            user_id=user_id,
-            method="get",
-            endpoint=f"{pave_base_url}/{user_id}/attributes",
-            payload=None,
-            headers=pave_headers,
-            params=params,
-        )
-        insert_response_into_db(
-            user_id=user_id,
-            res=response,
-            mongo_db=mongo_db,
-            collection_name="attributes",
-            response_column_name="attributes",
-        )
-        #####################################################################
 
 ##################################################################################################################################################################################################
 
-# Open connection to postgres db
 cm = Connection_Manager()
-conn = cm.get_postgres_connection()
+
+# Opened by the first job that reads through it, the user, link and weekly syncs open their own
+@functools.lru_cache(maxsize=None)
+def backend_connection() -> sqlalchemy.engine.Connection:
+    return cm.get_postgres_connection()
 
 logger = logging.getLogger("stevenslav2")
 logger.setLevel(logging.DEBUG)
@@ -732,13 +871,28 @@ normal_log_handler.setFormatter(formatter)
 normal_log_handler.setLevel(logging.DEBUG)
 logger.addHandler(normal_log_handler)
 
+# Anything that can't be shipped to Cloud Logging ends up here
+unshipped_log_handler = RotatingFileHandler('/home/langston/pave-prism/logs/unshipped-cloud-logs.log', 'a', (1000**2)*200, 2)
+unshipped_log_handler.setFormatter(formatter)
+log_shipper = LogShipper(CloudLoggingSink("stevenslav"), fallback_handler=unshipped_log_handler)
+
 if __name__ == "__main__":
     process_start = datetime.datetime.now()
     try:
-        if len(sys.argv) == 1:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("which", nargs="?")
+        parser.add_argument(
+            "--concurrency", type=int, default=1,
+            help="Number of users to sync at once for the user, daily and weekly syncs",
+        )
+        args = parser.parse_args()
+
+        if args.which is None:
             raise Exception("You must provide either user, link, hourly, daily, or weekly")
 
-        which = sys.argv[1]
+        which = args.which
+        concurrency = max(1, args.concurrency)
+        pave_client.set_pool_size(max(16, concurrency))
 
         if which == "user":
             handler = RotatingFileHandler('/home/langston/pave-prism/logs/new-user-data-sync.log', 'a', (1000**2)*200, 2)
@@ -747,7 +901,7 @@ if __name__ == "__main__":
             logger.addHandler(handler)
 
             log_this(f"Process start: {process_start}", "info")
-            while not new_user_sync():
+            while not new_user_sync(concurrency):
                 time.sleep(120) # Give everything time to cool off
                 log_this("        Starting another cycle \n\n")
         elif which == "link":
@@ -773,7 +927,7 @@ if __name__ == "__main__":
             logger.addHandler(handler)
 
             log_this(f"Process start: {process_start}", "info")
-            daily_sync()
+            daily_sync(concurrency)
         elif which == "weekly":
             handler = RotatingFileHandler('/home/langston/pave-prism/logs/weekly-recurring-data-sync.log', 'a', (1000**2)*200, 2)
             handler.setFormatter(formatter)
@@ -781,13 +935,18 @@ if __name__ == "__main__":
             logger.addHandler(handler)
 
             log_this(f"Process start: {process_start}", "info")
-            weekly_sync()
+            weekly_sync(concurrency)
         else:
             raise Exception("You must provide either user, link, hourly, daily, or weekly")
     except Exception as e:
         logger.exception(e)
 
+    upload_coordinator.close()
+    log_this(f"Pave request stats: {pave_client.stats()}", "info")
+    log_this(f"Pave response cache: {response_cache.stats()}", "info")
+    response_cache.close()
     cm.close_pymongo_connection()
-    cm.close_postgres_connection(conn)
+    if backend_connection.cache_info().currsize:
+        cm.close_postgres_connection(backend_connection())
     process_end = datetime.datetime.now()
     log_this(f"Total runtime: {process_end-process_start}\n\n", "info")
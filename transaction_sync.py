@@ -1,3 +1,6 @@
+from itertools import groupby
+
+from pave_payloads import MAX_TRANSACTIONS_PER_POST, chunked, pave_transaction_from_row
 from utils import *
 
 handler = RotatingFileHandler('/home/langston/pave-prism/logs/hourly-transaction-data-sync.log', 'a', (1000**2)*200, 2)
@@ -13,36 +16,31 @@ log_this(f"Process start: {process_start}", "info")
 # Open connections
 conn = get_backend_connection()
 mongo_db = get_pymongo_connection()[pave_table]
-
-rows = conn.execute(
-    "SELECT * FROM public.plaid_transactions WHERE plaid_transactions.date >= (NOW() - INTERVAL '1 hours')"
-).fetchall()
-
-for row in tqdm(rows):
-    row:dict = row._asdict()
-    transaction = {
-        "transaction_id": str(row["plaid_transaction_id"]),
-        "account_id": str(row["plaid_account_id"]),
-        "amount": float(row["amount"]),
-        "date": str(row["authorized_date"]),
-        "memo": " ".join(
-            row["personal_finance_category"].values()
-        )
-        if row["personal_finance_category"]
-        else "",
-        "name": row["name"] if row["name"] else " ",
-        "pending": row["pending"],
-        "category": row["category"],
-        "category_id": row["category_id"],
-        "iso_currency_code": row["iso_currency_code"],
-        "merchant_name": row["merchant_name"],
-        "payment_channel": row["payment_channel"],
-        "transaction_type": row["transaction_type"],
-        "payment_meta": row["payment_meta"],
-        "location": row["location"]
-    }
-
-    user_id = conn.execute(f"SELECT user_id FROM public.plaid_links WHERE id = \'{str(row['link_id'])}\'").fetchone()[0]
+store = PaveStore(mongo_db)
+
+checkpoint = SyncCheckpoint(mongo_db, "transaction_sync", datetime.timedelta(hours=1))
+watermark = checkpoint.load()
+# Users whose upload failed on an earlier run are sent again from their oldest failed transaction
+retries = checkpoint.retries()
+retry_since = min((as_utc(retry["since"]) for retry in retries), default=watermark)
+
+# Every transaction stored since the last run plus the retried users',
+# with its user resolved in the same statement and streamed in user order
+rows = conn.execution_options(stream_results=True).execute(
+    sqlalchemy.text(
+        "SELECT plaid_transactions.*, plaid_links.user_id AS link_user_id FROM public.plaid_transactions "
+        "JOIN public.plaid_links ON plaid_links.id = plaid_transactions.link_id "
+        "WHERE plaid_transactions.created_at > :watermark "
+        "OR (plaid_links.user_id IN :retry_user_ids AND plaid_transactions.created_at >= :retry_since) "
+        "ORDER BY plaid_links.user_id"
+    ).bindparams(sqlalchemy.bindparam("retry_user_ids", expanding=True)),
+    {"watermark": watermark, "retry_user_ids": [retry["key"] for retry in retries], "retry_since": retry_since},
+)
+
+# Each user costs one upload, one download and one mongo update
+for user_id, user_rows in tqdm(groupby(rows, key=lambda row: str(row.link_user_id))):
+    user_rows = list(user_rows)
+    new_transactions = [pave_transaction_from_row(row._asdict()) for row in user_rows]
 
     # Date ranges for pave
     start_date_str = (
@@ -51,50 +49,68 @@ for row in tqdm(rows):
     end_date_str: str = datetime.datetime.now().strftime("%Y-%m-%d")
     params = {"start_date": start_date_str, "end_date": end_date_str, "resolve_duplicates": True}
 
-    response = handle_pave_request(
-        user_id=user_id,
-        method="post",
-        endpoint=f"{pave_base_url}/{user_id}/transactions",
-        payload={"transactions": [transaction]},
-        headers=pave_headers,
-        params=params,
-    )
+    uploaded = True
+    for chunk in chunked(new_transactions, MAX_TRANSACTIONS_PER_POST):
+        response = handle_pave_request(
+            user_id=user_id,
+            method="post",
+            endpoint=f"{pave_base_url()}/{user_id}/transactions",
+            payload={"transactions": chunk},
+            headers=pave_headers(),
+            params=params,
+        )
+
+        if response.status_code != 200:
+            log_this(f"Could not upload {len(chunk)} transaction(s) for user {user_id} to pave", "error")
+            uploaded = False
+            break
 
     #####################################################################
 
-    if response.status_code == 200:
+    stored = False
+    if uploaded:
         # Store the transaction data from pave
         response = handle_pave_request(
             user_id=user_id,
             method="get",
-            endpoint=f"{pave_base_url}/{user_id}/transactions",
+            endpoint=f"{pave_base_url()}/{user_id}/transactions",
             payload=None,
-            headers=pave_headers,
+            headers=pave_headers(),
             params=params,
         )
 
-        mongo_timer = datetime.datetime.now()
-        mongo_collection = mongo_db["transactions"]
-        transactions = response.json()["transactions"]
-
-        if len(transactions) > 0:
-            log_this(f"\tInserting {json.dumps(transactions)[:100]} into transactions", "info")
-
-            mongo_collection.update_one(
-                {"user_id": str(user_id)},
-                {
-                    "$addToSet": {"transactions.transactions": {"$each": transactions}},
-                    "$set": {"transactions.to": end_date_str, "date": datetime.datetime.now()}
-                }
-            )
-
-            mongo_timer_end = datetime.datetime.now()
-            log_this(f"\tDB insertion took: {mongo_timer_end-mongo_timer}", "info")
+        if response.status_code != 200:
+            # Left in sync_retries, the user is sent again on the next run
+            log_this(f"Non 200 return code on transactions for user {user_id}: {response.status_code}", "error")
         else:
-            log_this("\tGot to hourly db insertion but no transactions were found for the date range", "warning")
+            mongo_timer = datetime.datetime.now()
+            transactions = response_json(response)["transactions"]
+
+            if len(transactions) > 0:
+                log_this(f"\tInserting {json.dumps(transactions)[:100]} into transactions", "info")
+
+                try:
+                    store.write_transactions(user_id, transactions)
+                    stored = True
+                except Exception as e:
+                    log_this(f"COULD NOT UPDATE TRANSACTIONS FOR USER {user_id} ON TRANSACTION SYNC", "error")
+                    log_this(f"{e}", "error")
+
+                mongo_timer_end = datetime.datetime.now()
+                log_this(f"\tDB insertion took: {mongo_timer_end-mongo_timer}", "info")
+            else:
+                log_this("\tGot to hourly db insertion but no transactions were found for the date range", "warning")
+                stored = True
     else:
         log_this("Could not upload transactions to mongodb", "error")
 
+    for row in user_rows:
+        checkpoint.observe(row.created_at, stored, key=user_id)
+
+checkpoint.commit()
+
 
+log_this(f"Pave request stats: {pave_client.stats()}", "info")
+log_this(f"Pave response cache: {response_cache.stats()}", "info")
 close_backend_connection()
 close_pymongo_connection()
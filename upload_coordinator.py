@@ -0,0 +1,196 @@
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple
+
+from agent_pool import PaveAgentPool, agent_urls_from_env
+
+# Attempts at uploading one access token, each on the least loaded healthy agent
+UPLOAD_ATTEMPTS = 2
+
+
+def _no_log(message: str, severity: str = "debug"):
+    pass
+
+
+class UploadResult:
+    def __init__(self, user_id: str, status_codes: List[int], ready: bool, waited: float, polls: int):
+        self.user_id = user_id
+        self.status_codes = status_codes
+        self.ready = ready
+        self.waited = waited
+        self.polls = polls
+
+    @property
+    def uploaded(self) -> bool:
+        # Pave took at least one link, whether or not it was seen ingesting it before the deadline
+        return any(200 <= code < 300 for code in self.status_codes)
+
+    def __repr__(self):
+        return f"UploadResult({self.user_id!r}, {self.status_codes}, ready={self.ready}, waited={self.waited:.1f}s, polls={self.polls})"
+
+'''
+    Uploads a user's plaid links through the pave-agent pool, then polls
+    is_ready(user_id, before) until pave has the data instead of sleeping a fixed time.
+    `before` is snapshot(user_id) taken just before the upload, so users pave already
+    knows only count as ready once what pave reports has changed. Users that
+    expects_data(user_id) says have nothing to ingest aren't waited on. Polls back off from
+    initial_wait by backoff_factor up to max_wait and give up once deadline seconds
+    have passed, or known_deadline for users pave already had data for: a revalidated
+    link usually brings nothing new, and what pave has is still worth storing. Giving
+    up only means ready is False, callers judge an upload by `uploaded`. The first poll
+    is pushed back towards how long recent users took to become ready, so big backlogs
+    don't spend their time on polls that can't succeed.
+
+    iter_uploaded keeps the next `lookahead` users (by default one per agent, at least
+    two) uploading and waiting on a thread pool while the caller works on the current one.
+    on_upload(user_id) is called once a user's data has been uploaded.
+'''
+class UploadCoordinator:
+    def __init__(
+        self,
+        session,
+        snapshot: Callable[[str], Any],
+        is_ready: Callable[[str, Any], bool],
+        agent_pool: Optional[PaveAgentPool] = None,
+        num_transaction_days: int = 365 * 2,
+        initial_wait: float = 0.5,
+        max_wait: float = 15.0,
+        backoff_factor: float = 1.5,
+        deadline: float = 180.0,
+        known_deadline: float = 30.0,
+        lookahead: Optional[int] = None,
+        on_upload: Optional[Callable[[str], None]] = None,
+        expects_data: Optional[Callable[[str], bool]] = None,
+        log: Callable[[str, str], None] = _no_log,
+    ):
+        self.session = session
+        self.snapshot = snapshot
+        self.is_ready = is_ready
+        # Built on the first upload, jobs that never upload don't health check or restart agents
+        self._agent_pool = agent_pool
+        self.num_transaction_days = num_transaction_days
+        self.initial_wait = initial_wait
+        self.max_wait = max_wait
+        self.backoff_factor = backoff_factor
+        self.deadline = deadline
+        self.known_deadline = known_deadline
+        pool_size = len(agent_pool) if agent_pool is not None else len(agent_urls_from_env())
+        self.lookahead = lookahead if lookahead is not None else max(2, pool_size)
+        self.on_upload = on_upload
+        self.expects_data = expects_data
+        self.log = log
+
+        self._executor = ThreadPoolExecutor(max_workers=max(1, self.lookahead), thread_name_prefix="pave-upload")
+        # Moving average of how long users took to become ready
+        self._ready_after: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def agent_pool(self) -> PaveAgentPool:
+        with self._lock:
+            if self._agent_pool is None:
+                self._agent_pool = PaveAgentPool(self.session, log=self.log)
+            return self._agent_pool
+
+    def upload_url(self, agent_url: str, user_id: str) -> str:
+        return f"{agent_url}/v1/users/{user_id}/upload?num_transaction_days={self.num_transaction_days}"
+
+    def upload(self, user_id: str, access_tokens: List[str]) -> UploadResult:
+        try:
+            before = self.snapshot(user_id)
+        except Exception as e:
+            self.log(f"Could not snapshot user {user_id} before the upload: {e}", "warning")
+            before = None
+
+        status_codes = []
+        for access_token in access_tokens:
+            for attempt in range(UPLOAD_ATTEMPTS):
+                with self.agent_pool.lease() as agent:
+                    try:
+                        res = self.session.post(self.upload_url(agent.url, user_id), json={"access_token": f"{access_token}"})
+                    except Exception as e:
+                        self.log(f"Pave agent upload failed for user {user_id} on {agent.url}: {e}", "error")
+                        self.agent_pool.report_failure(agent, str(e))
+                        continue
+
+                if res.status_code >= 500:
+                    self.agent_pool.report_failure(agent, f"upload returned {res.status_code}")
+                    if attempt + 1 < UPLOAD_ATTEMPTS:
+                        continue
+
+                status_codes.append(res.status_code)
+                break
+
+        if not any(200 <= code < 300 for code in status_codes):
+            self.log(f"  No successful pave agent uploads for user {user_id}: {status_codes}", "warning")
+            return UploadResult(user_id, status_codes, ready=False, waited=0.0, polls=0)
+
+        if self.on_upload is not None:
+            self.on_upload(user_id)
+
+        if self.expects_data is not None and not self._expects_data(user_id):
+            self.log(f"  Links of user {user_id} have no accounts, not waiting on pave", "debug")
+            return UploadResult(user_id, status_codes, ready=True, waited=0.0, polls=0)
+
+        deadline = self.deadline if before is None else self.known_deadline
+        result = self._wait_until_ready(user_id, status_codes, before, deadline)
+        self.log(f"  Pave agent upload for user {user_id}: {result}", "debug" if result.ready else "info")
+        return result
+
+    def submit(self, user_id: str, access_tokens: List[str]) -> Future:
+        return self._executor.submit(self.upload, user_id, access_tokens)
+
+    def iter_uploaded(self, users: Iterable[Tuple[str, List[str]]]) -> Iterator[Tuple[str, UploadResult]]:
+        in_flight = deque()
+        for user_id, access_tokens in users:
+            in_flight.append((user_id, self.submit(user_id, access_tokens)))
+            if len(in_flight) > self.lookahead:
+                user_id, future = in_flight.popleft()
+                yield user_id, future.result()
+
+        while in_flight:
+            user_id, future = in_flight.popleft()
+            yield user_id, future.result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._agent_pool is not None:
+            self.log(f"Pave agent pool: {self._agent_pool.stats()}", "info")
+            self._agent_pool.close()
+
+    def _expects_data(self, user_id: str) -> bool:
+        try:
+            return self.expects_data(user_id)
+        except Exception as e:
+            self.log(f"Could not tell whether user {user_id} has accounts, waiting on pave: {e}", "warning")
+            return True
+
+    def _wait_until_ready(self, user_id: str, status_codes: List[int], before: Any, deadline: float) -> UploadResult:
+        start = time.monotonic()
+        with self._lock:
+            wait = self.initial_wait if self._ready_after is None else max(self.initial_wait, self._ready_after / 2)
+
+        polls = 0
+        while True:
+            remaining = deadline - (time.monotonic() - start)
+            if remaining <= 0:
+                return UploadResult(user_id, status_codes, ready=False, waited=time.monotonic() - start, polls=polls)
+
+            time.sleep(min(wait, remaining))
+            polls += 1
+            try:
+                ready = self.is_ready(user_id, before)
+            except Exception as e:
+                self.log(f"Readiness check failed for user {user_id}: {e}", "warning")
+                ready = False
+
+            if ready:
+                waited = time.monotonic() - start
+                with self._lock:
+                    self._ready_after = waited if self._ready_after is None else 0.8 * self._ready_after + 0.2 * waited
+                return UploadResult(user_id, status_codes, ready=True, waited=waited, polls=polls)
+
+            wait = min(wait * self.backoff_factor, self.max_wait)
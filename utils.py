@@ -1,44 +1,50 @@
-import base64
 import datetime
+import functools
 import json
 import logging
-import subprocess
 import time
 import uuid
 import pymongo
 import requests
 import sqlalchemy
 from tqdm import tqdm
+from typing import Optional
 from logging.handlers import RotatingFileHandler
-from cryptography.fernet import Fernet, MultiFernet
+
+from backend_queries import USER_LINK_ACCOUNT_COUNTS
+from checkpoints import SyncCheckpoint, as_utc
+from content_hash import SectionHashes, content_hash
+from decryption import TokenDecryptor, base64_decode
+from log_shipper import CloudLoggingSink, LogShipper
+from mongo_bulk_sink import MongoBulkSink
+from pave_client import PaveClient
+from pave_store import PaveStore
+from processed_users import ProcessedUserRegistry
+from rate_limiter import RateLimiter
+from response_cache import ResponseCache
+from sanitised_json import response_json
+from secret_store import secret_store
+from upload_coordinator import UploadCoordinator
 
 from google.cloud.sql.connector import Connector
 from google.oauth2 import service_account
-from google.cloud import secretmanager
-
-# Get pave secret values
-secret_manager_client = secretmanager.SecretManagerServiceClient()
 
 pave_table = "Pave-Production"
 
-# Decrpytion keys
-keys = secret_manager_client.access_secret_version(
-    name=f"projects/eql-data-processing/secrets/pave-agent-decryption-keys/versions/latest"
-).payload.data.decode("UTF-8")
-keys = json.loads(keys)["KEYS"]
+# Secrets are resolved on first use, a run with nothing to do never asks for them
+@functools.lru_cache(maxsize=None)
+def token_decryptor() -> TokenDecryptor:
+    return TokenDecryptor(secret_store.get_json("pave-agent-decryption-keys")["KEYS"])
 
 # Pave url necessities
-pave_str = secret_manager_client.access_secret_version(
-    name=f"projects/eql-data-processing/secrets/pave-prism-info/versions/latest"
-).payload.data.decode("UTF-8")
-
-pave_data = json.loads(pave_str)
-pave_base_url = pave_data["PAVE_HOST"]
-pave_x_api_key = pave_data["PAVE_X_API_KEY"]
-pave_headers = {
-    "Content-Type": "application/plaid+json",
-    "x-api-key": pave_x_api_key,
-}
+def pave_base_url() -> str:
+    return secret_store.get_json("pave-prism-info")["PAVE_HOST"]
+
+def pave_headers() -> dict:
+    return {
+        "Content-Type": "application/plaid+json",
+        "x-api-key": secret_store.get_json("pave-prism-info")["PAVE_X_API_KEY"],
+    }
 
 logger = logging.getLogger("stevenslav2")
 logger.setLevel(logging.DEBUG)
@@ -51,25 +57,17 @@ normal_log_handler.setFormatter(formatter)
 normal_log_handler.setLevel(logging.DEBUG)
 logger.addHandler(normal_log_handler)
 
-client = secretmanager.SecretManagerServiceClient()
-
-CREDS = client.access_secret_version(
-    name=f"projects/eql-data-processing/secrets/eql-backend-service-dev-creds/versions/latest"
-).payload.data.decode("UTF-8")
-
-creds_obj = json.loads(CREDS)
-
-DB_PARAMS = client.access_secret_version(
-    name=f"projects/eql-data-processing/secrets/eql-backend-service-dev-db/versions/latest"
-).payload.data.decode("UTF-8")
-
-db_params_obj = json.loads(DB_PARAMS)
-
-g_credentials = service_account.Credentials.from_service_account_info(creds_obj)
-instance_connection_name = f"{db_params_obj['PROJECT_ID']}:{db_params_obj['REGION']}:{db_params_obj['INSTANCE_NAME']}"
+# Anything that can't be shipped to Cloud Logging ends up here
+unshipped_log_handler = RotatingFileHandler('/home/langston/pave-prism/logs/unshipped-cloud-logs.log', 'a', (1000**2)*200, 2)
+unshipped_log_handler.setFormatter(formatter)
+log_shipper = LogShipper(CloudLoggingSink("stevenslav"), fallback_handler=unshipped_log_handler)
 
 def get_psql_connection():
-    global g_credentials, instance_connection_name, db_params_obj
+    creds_obj = secret_store.get_json("eql-backend-service-dev-creds")
+    db_params_obj = secret_store.get_json("eql-backend-service-dev-db")
+
+    g_credentials = service_account.Credentials.from_service_account_info(creds_obj)
+    instance_connection_name = f"{db_params_obj['PROJECT_ID']}:{db_params_obj['REGION']}:{db_params_obj['INSTANCE_NAME']}"
 
     connector = Connector(credentials=g_credentials)
     conn = connector.connect(
@@ -86,17 +84,13 @@ postgres_pool = sqlalchemy.create_engine(
     "postgresql+pg8000://", creator=get_psql_connection
 )
 
-mongodb_uri = client.access_secret_version(
-    name=f"projects/eql-data-processing/secrets/mongodb-uri/versions/latest"
-).payload.data.decode("UTF-8")
-
 current_mongo_connection:pymongo.MongoClient = None
 def get_pymongo_connection() -> pymongo.MongoClient:
     global current_mongo_connection
 
     if current_mongo_connection: return current_mongo_connection
     else:
-        current_mongo_connection = pymongo.MongoClient(mongodb_uri)
+        current_mongo_connection = pymongo.MongoClient(secret_store.get("mongodb-uri"))
         return current_mongo_connection
 
 def close_pymongo_connection():
@@ -119,19 +113,66 @@ def close_backend_connection():
 def log_this(message:str, severity:str = "debug"):
     global logger
     logger.log(logging._nameToLevel[severity.upper()], message)
-    subprocess.run(["gcloud", "logging", "write", "stevenslav", message, f"--severity={severity.upper()}", "--quiet", "--verbosity=none", "--no-user-output-enabled"], stdout=subprocess.PIPE)
-
-def base64_decode(val: str) -> bytes:
-    return base64.urlsafe_b64decode(val.encode("ascii"))
-
+    log_shipper.ship(message, severity)
+
+# One pooled, keep-alive session shared by every Pave call in the process,
+# rate limited together with every other pave job on the host
+pave_client = PaveClient(log=log_this, rate_limiter=RateLimiter())
+# Pave GETs repeated by the jobs on this host within a day are answered locally
+response_cache = ResponseCache(log=log_this)
+
+def pave_data_snapshot(user_id: str) -> Optional[dict]:
+    # What pave reports for the user over the window the syncs read, taken before and after an upload
+    params = {
+        "start_date": (datetime.datetime.now() - datetime.timedelta(days=365*2)).strftime("%Y-%m-%d"),
+        "end_date": datetime.datetime.now().strftime("%Y-%m-%d"),
+    }
+    res = pave_client.request("get", f"{pave_base_url()}/{user_id}/balances", headers=pave_headers(), params=params)
+    if res.status_code != 200:
+        return None
+    accounts = response_json(res).get("accounts_balances") or []
 
-def decrypt(val: str) -> str:
-    if val is None:
+    res = pave_client.request("get", f"{pave_base_url()}/{user_id}/transactions", headers=pave_headers(), params=params)
+    if res.status_code != 200:
         return None
+    transactions = response_json(res).get("transactions") or []
+
+    return {
+        "accounts": len(accounts),
+        "balances": content_hash(accounts),
+        "transactions": len(transactions),
+        "newest_transaction": max((t["date"] for t in transactions if t.get("date")), default=None),
+    }
+
+def pave_has_new_data(user_id: str, before: Optional[dict]) -> bool:
+    # Balances land before the transactions are ingested, so the transactions the syncs
+    # read decide. A user pave didn't know needs accounts and transactions, a known one
+    # counts once its transactions differ from the snapshot.
+    after = pave_data_snapshot(user_id)
+    if after is None or after["accounts"] == 0:
+        return False
+    if before is None:
+        return after["transactions"] > 0
+    return (after["transactions"], after["newest_transaction"]) != (before["transactions"], before["newest_transaction"])
+
+def user_links_have_accounts(user_id: str) -> bool:
+    with postgres_pool.connect() as connection:
+        counts = connection.execute(sqlalchemy.text(USER_LINK_ACCOUNT_COUNTS), {"user_id": user_id}).fetchone()
+    # Links without a raw set yet might still bring accounts
+    return counts.accounts > 0 or counts.links_with_raw_sets < counts.links
+
+# Uploads through the pave-agent and waits until pave actually has the data
+upload_coordinator = UploadCoordinator(
+    pave_client.session,
+    pave_data_snapshot,
+    pave_has_new_data,
+    on_upload=response_cache.invalidate_user,
+    expects_data=user_links_have_accounts,
+    log=log_this,
+)
 
-    fernet = MultiFernet(Fernet(k) for k in keys)
-    actual = fernet.decrypt(base64_decode(val))
-    return actual.decode()
+def decrypt(val: str) -> str:
+    return token_decryptor().decrypt(val)
 
 
 def handle_pave_request(
@@ -141,48 +182,62 @@ def handle_pave_request(
     payload: dict,
     headers: dict,
     params: dict,
-    last_wait: float = 0,
 ) -> requests.Response:
     request_timer = datetime.datetime.now()
 
     if method == "get":
-        res = requests.get(f"{endpoint}", json=payload, headers=headers, params=params)
-    elif method == "post":
-        res = requests.post(f"{endpoint}", json=payload, headers=headers, params=params)
+        res = response_cache.get(user_id, endpoint, params)
+        if res is not None:
+            log_this(f"GET {endpoint} served from the response cache", "info")
+            return res
+
+    res = pave_client.request(method, endpoint, payload=payload, headers=headers, params=params)
+
+    if method == "get":
+        response_cache.put(user_id, endpoint, params, res)
     else:
-        raise ValueError("Method not understood {}".format(method))
+        # Anything cached for the user predates what was just sent
+        response_cache.invalidate_user(user_id)
 
     res_code = res.status_code
-    res_json_string = json.dumps(res.json())
-
-    if res_code == 429:
-        sleep = 1 if last_wait == 0 else last_wait * 2
-        log_this(f"Request limit reached, waiting {sleep} second(s)", "error")
-        time.sleep(sleep)
-        return handle_pave_request(
-            user_id, method, endpoint, payload, headers, params, sleep
-        )
-    else:
-        request_timer_end = datetime.datetime.now()
-        log_this(f"{method.upper()} {endpoint} took: {request_timer_end-request_timer}", "info")
-        log_this(f"        Response: {res_code} -> {res_json_string[:100]}{f'... {res_json_string[-100:]}' if len(res_json_string) > 100 else ''}\n", "info")
+    res_text = res.text
+
+    request_timer_end = datetime.datetime.now()
+    log_this(f"{method.upper()} {endpoint} took: {request_timer_end-request_timer}", "info")
+    log_this(f"        Response: {res_code} -> {res_text[:100]}{f'... {res_text[-100:]}' if len(res_text) > 100 else ''}\n", "info")
 
-        return res
+    return res
 
 def insert_response_into_db(
-    user_id: str, res, mongo_db, collection_name: str, response_column_name: str
+    user_id: str, res, mongo_db, collection_name: str, response_column_name: str, sink: MongoBulkSink = None,
+    hashes: SectionHashes = None,
 ):
     log_this("Inserting response into: {}.{}".format(collection_name, response_column_name), "info")
     mongo_timer = datetime.datetime.now()
     mongo_collection = mongo_db[collection_name]
     res_code = res.status_code
 
-    if res_code == 200:
+    if res_code == 200 and sink is not None:
+        document = {
+            response_column_name: response_json(res),
+            "user_id": user_id,
+            "response_code": res.status_code,
+            "date": datetime.datetime.now(),
+        }
+        if hashes is not None:
+            document["content_hash"] = hashes.changed(collection_name, user_id, document[response_column_name])
+
+        if hashes is not None and document["content_hash"] is None:
+            log_this(f"        {response_column_name} of user {user_id} unchanged, skipping the write")
+        else:
+            # Written with the next bulk_write of the collection, failures are reported by the sink
+            sink.replace_one(collection_name, {"user_id": user_id}, document, context=f"{response_column_name} of user {user_id}", user_id=user_id)
+    elif res_code == 200:
         try:
             res = mongo_collection.replace_one(
                 {"user_id": user_id},
                 {
-                    response_column_name: res.json(),
+                    response_column_name: response_json(res),
                     "user_id": user_id,
                     "response_code": res.status_code,
                     "date": datetime.datetime.now(),
@@ -197,7 +252,7 @@ def insert_response_into_db(
             log_this(f"COULD NOT INSERT response into {response_column_name} FOR USER {user_id}", "error")
             log_this(f"{e}", "error")
     else:
-        log_this("\tCan't insert to {}: {} {}\n".format(collection_name, res_code, res.json()), "warning")
+        log_this("\tCan't insert to {}: {} {}\n".format(collection_name, res_code, response_json(res)), "warning")
 
     mongo_timer_end = datetime.datetime.now()
     log_this(f"DB insertion to {collection_name} took: {mongo_timer_end-mongo_timer}\n", "warning")